@@ -2,6 +2,7 @@
 SkinCare AI Assistant - FastAPI Backend
 主应用入口
 """
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -9,12 +10,39 @@ import os
 
 # Import routers
 from api.routes import analysis, chat, products, search, image_analysis, weather
+from api.services.cache import cache_stats
+from api.services.retrieval import RetrievalService
+from api.services.lexical_index import load_lexical_index
+from api.services.catalog import load_catalog
+from api.services.answer_cache import answer_cache
+from api.services.image_preprocess import shutdown_image_pool
+from api.services.product_images import product_image_resolver
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用级资源：检索服务（Chroma 连接池 + 集合句柄 / 进程内索引）在启动时创建，关闭时释放"""
+    app.state.retrieval = RetrievalService()
+    app.state.retrieval.warm()
+    # 产品级 BM25 倒排索引（混合检索 + embedding 不可用时的降级检索）
+    app.state.lexical = load_lexical_index()
+    # 产品目录（/api/products），数据文件更新后在下一次请求时重新加载
+    load_catalog()
+    # 持久化的 /api/chat 语义回答缓存
+    answer_cache.load()
+    yield
+    answer_cache.save()
+    shutdown_image_pool()
+    await product_image_resolver.close()
+    app.state.retrieval.close()
+
 
 # Create FastAPI app
 app = FastAPI(
     title="SkinCare AI Assistant API",
     description="AI-powered skincare analysis and product recommendation system",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -48,6 +76,12 @@ async def health_check():
         "version": "1.0.0"
     }
 
+# Cache metrics endpoint
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """进程内缓存的条目数、字节数和命中率（每个 worker 进程独立统计）"""
+    return cache_stats()
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -8,8 +8,12 @@ from typing import Optional
 import uuid
 from datetime import datetime
 import base64
-from io import BytesIO
-from PIL import Image
+import os
+import sys
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from api.services.image_preprocess import InvalidImage, UploadTooLarge, prepare_image, read_upload
 
 # 这里导入你的服务
 # from services.vertex_ai_service import VertexAIService
@@ -64,18 +68,11 @@ async def analyze_image(
 
     # 读取图片
     try:
-        contents = await image.read()
-
-        # 验证文件大小（5MB限制）
-        if len(contents) > 5 * 1024 * 1024:
-            raise HTTPException(
-                status_code=400,
-                detail="File size too large. Maximum 5MB allowed."
-            )
+        # 分块读取（5MB限制），超过上限立即中止
+        contents = await read_upload(image, max_bytes=5 * 1024 * 1024)
 
-        # 验证是否为有效图片
-        img = Image.open(BytesIO(contents))
-        img.verify()
+        # 解码验证并预处理（旋转、缩小、重新编码为 JPEG），在进程池中执行
+        contents = await prepare_image(contents)
 
         # 生成分析ID
         analysis_id = str(uuid.uuid4())
@@ -103,6 +100,10 @@ async def analyze_image(
 
         return JSONResponse(content=response)
 
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
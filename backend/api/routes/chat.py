@@ -3,34 +3,46 @@
 处理与 AI 的对话交互
 集成OpenAI GPT + ChromaDB RAG
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import uuid
+import json
 from datetime import datetime
 import os
 import sys
-import chromadb
 
 # 添加backend目录到路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from cli import generate_text_embeddings
+from api.services.query_embeddings import embed_query
+from api.services.retrieval import RetrievalService, get_retrieval, product_key
+from api.services.blocking import run_blocking
+from api.services.answer_cache import answer_cache
+from api.services.context_packing import pack_chat_messages
 
-# OpenAI配置
+# OpenAI配置（异步客户端，等待模型回复时不阻塞事件循环）
 try:
-    from openai import OpenAI
-    OPENAI_CLIENT = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    from openai import AsyncOpenAI
+    OPENAI_CLIENT = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
     USE_OPENAI = True
 except Exception as e:
     print(f"OpenAI not available: {e}")
     USE_OPENAI = False
 
-# ChromaDB配置
-CHROMADB_HOST = os.getenv("CHROMADB_HOST", "chromadb")
-CHROMADB_PORT = int(os.getenv("CHROMADB_PORT", "8000"))
-
 router = APIRouter()
 
+CHAT_MODEL = "gpt-4o-mini"  # 使用GPT-4o-mini，性价比高
+
+# GPT 调用失败时的降级回复（不写入语义缓存）
+GPT_UNAVAILABLE_MESSAGE = "抱歉，AI服务暂时不可用。让我用基础知识为您解答..."
+
+FOLLOW_UP_QUESTIONS = [
+    "您想了解这些产品的具体成分吗？",
+    "需要我推荐其他类型的护肤品吗？",
+    "您有其他肌肤问题需要咨询吗？"
+]
+
 # 请求模型
 class ChatMessage(BaseModel):
     message: str
@@ -53,7 +65,7 @@ class ChatResponse(BaseModel):
 
 @router.post("/", response_model=ChatResponse)
 @router.post("/message", response_model=ChatResponse)
-async def chat_with_ai(request: ChatMessage):
+async def chat_with_ai(request: ChatMessage, retrieval: RetrievalService = Depends(get_retrieval)):
     """
     与 AI 对话 - 使用 OpenAI GPT + ChromaDB RAG
 
@@ -72,15 +84,21 @@ async def chat_with_ai(request: ChatMessage):
         user_message = request.message
 
         # 1. 使用ChromaDB检索相关护肤品信息（RAG）
-        relevant_context = await retrieve_skincare_context(user_message)
+        query_embedding, relevant_context = await retrieve_with_embedding(user_message, retrieval)
 
-        # 2. 使用OpenAI GPT生成回复
+        # 2. 使用OpenAI GPT生成回复（相近的问题检索到相同产品时直接使用缓存的回答）
         if USE_OPENAI and OPENAI_CLIENT:
-            response_text = await generate_gpt_response(
-                user_message=user_message,
-                context=relevant_context,
-                history=request.history or []
-            )
+            cache_key = await answer_cache_key(request, query_embedding, relevant_context, retrieval)
+            response_text = answer_cache.get(*cache_key) if cache_key else None
+            if response_text is None:
+                outcome = {}
+                response_text = await generate_gpt_response(
+                    user_message=user_message,
+                    context=relevant_context,
+                    history=request.history or [],
+                    outcome=outcome
+                )
+                await remember_answer(cache_key, response_text, outcome)
         else:
             # 降级到规则响应
             response_text = generate_mock_response(user_message.lower(), request.context or {})
@@ -89,11 +107,7 @@ async def chat_with_ai(request: ChatMessage):
         suggested_products = extract_product_names(relevant_context)
 
         # 4. 生成后续问题
-        follow_up_questions = [
-            "您想了解这些产品的具体成分吗？",
-            "需要我推荐其他类型的护肤品吗？",
-            "您有其他肌肤问题需要咨询吗？"
-        ]
+        follow_up_questions = FOLLOW_UP_QUESTIONS
 
         return ChatResponse(
             message_id=message_id,
@@ -111,26 +125,148 @@ async def chat_with_ai(request: ChatMessage):
             detail=f"Error processing chat message: {str(e)}"
         )
 
-async def retrieve_skincare_context(user_message: str) -> List[Dict]:
+def sse_event(event: str, data: Dict) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/stream")
+async def chat_with_ai_stream(request: ChatMessage, retrieval: RetrievalService = Depends(get_retrieval)):
+    """
+    与 AI 对话（SSE 流式版本），请求体与 /api/chat 相同
+
+    事件顺序:
+    - context: 检索到的产品信息（在生成开始前发送）
+    - token:   GPT 生成的增量文本 {"delta": "..."}
+    - done:    与 /api/chat 相同结构的完整回复（含 suggested_products 和 follow_up_questions）
+    - error:   出错时发送，随后结束流
+    """
+    message_id = str(uuid.uuid4())
+    user_message = request.message
+
+    async def event_stream():
+        try:
+            # 1. 先检索并立即发送上下文
+            query_embedding, relevant_context = await retrieve_with_embedding(user_message, retrieval)
+            yield sse_event("context", {
+                "message_id": message_id,
+                "sources": [
+                    {
+                        "product_name": item['metadata'].get('product_name', item['metadata'].get('book', '')),
+                        "text": item['text'][:200],
+                        "distance": item['distance'],
+                    }
+                    for item in relevant_context
+                ],
+            })
+
+            # 2. 逐个 token 转发 GPT 输出
+            parts = []
+            if USE_OPENAI and OPENAI_CLIENT:
+                cache_key = await answer_cache_key(request, query_embedding, relevant_context, retrieval)
+                cached = answer_cache.get(*cache_key) if cache_key else None
+                if cached is not None:
+                    # 语义缓存命中：整段回答作为一个 token 发送
+                    parts.append(cached)
+                    yield sse_event("token", {"delta": cached})
+                else:
+                    outcome = {}
+                    async for delta in stream_gpt_response(
+                        user_message=user_message,
+                        context=relevant_context,
+                        history=request.history or [],
+                        outcome=outcome
+                    ):
+                        parts.append(delta)
+                        yield sse_event("token", {"delta": delta})
+                    await remember_answer(cache_key, "".join(parts), outcome)
+            else:
+                # 降级到规则响应，作为一个 token 发送
+                parts.append(generate_mock_response(user_message.lower(), request.context or {}))
+                yield sse_event("token", {"delta": parts[-1]})
+
+            # 3. 最后发送完整回复和推荐
+            response = ChatResponse(
+                message_id=message_id,
+                response="".join(parts),
+                suggested_products=extract_product_names(relevant_context)[:3],
+                follow_up_questions=FOLLOW_UP_QUESTIONS,
+                timestamp=datetime.utcnow().isoformat()
+            )
+            yield sse_event("done", response.model_dump())
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield sse_event("error", {"message_id": message_id, "detail": f"Error processing chat message: {str(e)}"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def answer_cache_key(request: ChatMessage, query_embedding, context: List[Dict],
+                           retrieval: RetrievalService) -> Optional[tuple]:
+    """
+    语义缓存的查找参数 (查询向量, 产品集合, 集合版本)
+
+    有对话历史时回答依赖上下文，检索失败或集合版本不可用时，都不使用缓存（返回 None）
+    """
+    if request.history or query_embedding is None or not context:
+        return None
+    try:
+        version = await run_blocking(retrieval.version)
+    except Exception as e:
+        print(f"Collection version unavailable, skipping answer cache: {e}")
+        return None
+    products = {product_key(item['metadata']) for item in context}
+    return query_embedding, products, version
+
+async def remember_answer(cache_key: Optional[tuple], answer: str, outcome: Dict) -> None:
+    """
+    把 GPT 的回答写入语义缓存，到期时在线程池中持久化
+
+    只缓存正常结束的回答（outcome["complete"]）：调用失败（含流式中途失败）的降级回复、
+    因 max_tokens 被截断的回答都不写入
+    """
+    if not cache_key or not answer or not outcome.get("complete"):
+        return
+    query_embedding, products, version = cache_key
+    answer_cache.set(query_embedding, products, answer, version)
+    if answer_cache.save_due():
+        await run_blocking(answer_cache.save)
+
+async def retrieve_skincare_context(user_message: str, retrieval: RetrievalService) -> List[Dict]:
     """
     从ChromaDB检索相关护肤品信息
 
     Parameters:
     - user_message: 用户消息
+    - retrieval: 应用级检索服务
 
     Returns:
     - 相关产品信息列表
     """
+    _, context = await retrieve_with_embedding(user_message, retrieval)
+    return context
+
+async def retrieve_with_embedding(user_message: str, retrieval: RetrievalService) -> tuple:
+    """
+    与 retrieve_skincare_context 相同，同时返回查询向量（语义缓存使用）
+
+    Returns:
+    - (查询向量, 相关产品信息列表)；检索失败时为 (None, [])
+    """
     try:
-        # 连接ChromaDB
-        client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
-        collection = client.get_collection(name="char-split-collection")
+        # 应用级检索服务缓存的集合句柄（ChromaDB 或进程内索引，见 VECTOR_BACKEND）
+        collection = await run_blocking(retrieval.collection)
 
-        # 生成查询的embedding
-        query_embedding = generate_text_embeddings([user_message], dimensionality=1536)[0]
+        # 生成查询的embedding（进程内缓存，重复查询不调用 provider）
+        query_embedding = await run_blocking(embed_query, user_message, collection)
 
         # 在ChromaDB中搜索
-        results = collection.query(
+        results = await run_blocking(
+            retrieval.query,
             query_embeddings=[query_embedding],
             n_results=5,  # 获取前5个最相关的结果
             include=["documents", "metadatas", "distances"]
@@ -145,27 +281,19 @@ async def retrieve_skincare_context(user_message: str) -> List[Dict]:
                 'distance': results['distances'][0][i] if results['distances'] else None
             })
 
-        return context
+        return query_embedding, context
 
     except Exception as e:
         print(f"Error retrieving context from ChromaDB: {e}")
-        return []
+        return None, []
 
-async def generate_gpt_response(user_message: str, context: List[Dict], history: List[Dict]) -> str:
+def build_chat_messages(user_message: str, context: List[Dict], history: List[Dict]) -> List[Dict]:
     """
-    使用OpenAI GPT生成回复
-
-    Parameters:
-    - user_message: 用户消息
-    - context: ChromaDB检索的相关上下文
-    - history: 对话历史
-
-    Returns:
-    - GPT生成的回复
+    构建发送给 GPT 的消息列表（系统提示词 + 最近的对话历史 + 带检索上下文的用户消息），
+    按 CHAT_MODEL 的 token 预算装入去重、按产品分组的片段和裁剪后的历史
     """
-    try:
-        # 构建系统提示词
-        system_prompt = """你是一位专业的护肤顾问AI助手，拥有丰富的护肤品知识。你的任务是：
+    # 构建系统提示词
+    system_prompt = """你是一位专业的护肤顾问AI助手，拥有丰富的护肤品知识。你的任务是：
 
 1. 基于EWG（Environmental Working Group）护肤品数据库的信息，为用户提供专业、准确的护肤建议
 2. 根据用户的肤质、问题和需求，推荐合适的护肤品
@@ -179,46 +307,73 @@ async def generate_gpt_response(user_message: str, context: List[Dict], history:
 - 提醒可能的注意事项（如敏感成分、使用顺序等）
 - 如果不确定，诚实告知用户"""
 
-        # 构建上下文信息
-        context_text = "\n\n相关护肤品信息：\n"
-        for i, item in enumerate(context[:3], 1):  # 只使用前3个最相关的结果
-            context_text += f"\n{i}. {item['text']}\n"
-            if item.get('metadata'):
-                metadata = item['metadata']
-                if 'book' in metadata:
-                    context_text += f"   来源: {metadata['book']}\n"
-
-        # 构建消息历史
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
+    return pack_chat_messages(system_prompt, user_message, context, history, CHAT_MODEL)
 
-        # 添加历史对话（最多保留最近5轮）
-        for msg in history[-5:]:
-            if isinstance(msg, dict):
-                role = msg.get('role', 'user')
-                content = msg.get('content', '')
-                if content:
-                    messages.append({"role": role, "content": content})
+async def generate_gpt_response(user_message: str, context: List[Dict], history: List[Dict],
+                                outcome: Optional[Dict] = None) -> str:
+    """
+    使用OpenAI GPT生成回复
+
+    Parameters:
+    - user_message: 用户消息
+    - context: ChromaDB检索的相关上下文
+    - history: 对话历史
+    - outcome: 可选，回答正常结束（finish_reason == "stop"）时设置 outcome["complete"] = True
 
-        # 添加当前用户消息和上下文
-        user_message_with_context = f"{user_message}\n{context_text}"
-        messages.append({"role": "user", "content": user_message_with_context})
+    Returns:
+    - GPT生成的回复
+    """
+    try:
+        messages = build_chat_messages(user_message, context, history)
 
         # 调用OpenAI API
-        response = OPENAI_CLIENT.chat.completions.create(
-            model="gpt-4o-mini",  # 使用GPT-4o-mini，性价比高
+        response = await OPENAI_CLIENT.chat.completions.create(
+            model=CHAT_MODEL,
             messages=messages,
             temperature=0.7,
             max_tokens=800
         )
 
-        return response.choices[0].message.content
+        choice = response.choices[0]
+        if outcome is not None:
+            outcome["complete"] = choice.finish_reason == "stop"
+        return choice.message.content
 
     except Exception as e:
         print(f"Error generating GPT response: {e}")
         # 降级到模拟响应
-        return "抱歉，AI服务暂时不可用。让我用基础知识为您解答..."
+        return GPT_UNAVAILABLE_MESSAGE
+
+async def stream_gpt_response(user_message: str, context: List[Dict], history: List[Dict],
+                              outcome: Optional[Dict] = None):
+    """
+    流式调用 OpenAI GPT，逐段产出生成的文本
+
+    出错时产出一条降级提示并结束（此前已产出的部分文本保留）；
+    流正常结束（finish_reason == "stop"）时设置 outcome["complete"] = True
+    """
+    finish_reason = None
+    try:
+        stream = await OPENAI_CLIENT.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=build_chat_messages(user_message, context, history),
+            temperature=0.7,
+            max_tokens=800,
+            stream=True
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        if outcome is not None:
+            outcome["complete"] = finish_reason == "stop"
+
+    except Exception as e:
+        print(f"Error streaming GPT response: {e}")
+        yield GPT_UNAVAILABLE_MESSAGE
 
 def extract_product_names(context: List[Dict]) -> List[str]:
     """
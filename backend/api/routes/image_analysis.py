@@ -2,32 +2,31 @@
 图片分析路由
 使用 GPT-4 Vision API 分析皮肤状况并推荐产品
 """
-from fastapi import APIRouter, HTTPException, File, UploadFile, Form
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import base64
 import os
 import sys
-import chromadb
 from io import BytesIO
 
 # 添加backend目录到路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from cli import generate_text_embeddings
+from api.services.retrieval import RetrievalService, get_retrieval
+from api.services.blocking import run_blocking
+from api.services.image_preprocess import InvalidImage, UploadTooLarge, prepare_image_with_hash, read_upload
+from api.services.image_cache import skin_analysis_cache
+from api.services.query_embeddings import normalize_query
 
-# OpenAI配置
+# OpenAI配置（异步客户端，等待模型回复时不阻塞事件循环）
 try:
-    from openai import OpenAI
-    OPENAI_CLIENT = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    from openai import AsyncOpenAI
+    OPENAI_CLIENT = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
     USE_OPENAI = True
 except Exception as e:
     print(f"OpenAI not available: {e}")
     USE_OPENAI = False
 
-# ChromaDB配置
-CHROMADB_HOST = os.getenv("CHROMADB_HOST", "chromadb")
-CHROMADB_PORT = int(os.getenv("CHROMADB_PORT", "8000"))
-
 router = APIRouter()
 
 class SkinAnalysisResponse(BaseModel):
@@ -40,7 +39,8 @@ class SkinAnalysisResponse(BaseModel):
 @router.post("/analyze-skin", response_model=SkinAnalysisResponse)
 async def analyze_skin_image(
     image: UploadFile = File(...),
-    additional_info: Optional[str] = Form(None)
+    additional_info: Optional[str] = Form(None),
+    retrieval: RetrievalService = Depends(get_retrieval)
 ):
     """
     分析皮肤图片并推荐产品
@@ -51,6 +51,8 @@ async def analyze_skin_image(
 
     Returns:
     - 皮肤分析结果和产品推荐
+
+    相同或几乎相同的照片（感知哈希接近）加相同的补充信息直接返回缓存的结果
     """
     if not USE_OPENAI:
         raise HTTPException(
@@ -59,8 +61,19 @@ async def analyze_skin_image(
         )
 
     try:
-        # 读取图片内容
-        image_bytes = await image.read()
+        # 分块读取图片内容（有大小上限），在进程池中旋转、缩小并重新编码为 JPEG，同时计算感知哈希
+        image_bytes, image_hash = await prepare_image_with_hash(await read_upload(image))
+
+        # 推荐产品依赖集合内容，集合版本也是缓存键的一部分
+        try:
+            version = await run_blocking(retrieval.version)
+        except Exception as e:
+            print(f"Collection version unavailable: {e}")
+            version = None
+        cache_key = (normalize_query(additional_info or ""), version)
+        cached = skin_analysis_cache.get(image_hash, cache_key)
+        if cached is not None:
+            return SkinAnalysisResponse(**cached)
 
         # 将图片转换为base64
         base64_image = base64.b64encode(image_bytes).decode('utf-8')
@@ -72,16 +85,24 @@ async def analyze_skin_image(
         )
 
         # 根据分析结果从数据库检索相关产品
-        recommended_products = await get_product_recommendations(analysis_result)
+        recommended_products = await get_product_recommendations(analysis_result, retrieval)
 
-        return SkinAnalysisResponse(
+        response = SkinAnalysisResponse(
             analysis=analysis_result['analysis'],
             skin_type=analysis_result.get('skin_type'),
             concerns=analysis_result.get('concerns', []),
             recommendations=analysis_result.get('recommendations', []),
             recommended_products=recommended_products
         )
-
+        # 检索失败（没有推荐产品）的结果不缓存
+        if recommended_products:
+            skin_analysis_cache.set(image_hash, cache_key, response.model_dump())
+        return response
+
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -127,7 +148,7 @@ async def analyze_with_gpt4_vision(base64_image: str, additional_info: Optional[
             prompt += f"\n\n用户补充信息: {additional_info}"
 
         # 调用GPT-4 Vision API
-        response = OPENAI_CLIENT.chat.completions.create(
+        response = await OPENAI_CLIENT.chat.completions.create(
             model="gpt-4o-mini",  # 使用支持视觉的模型
             messages=[
                 {
@@ -213,21 +234,18 @@ def parse_analysis_result(analysis_text: str) -> Dict:
 
     return result
 
-async def get_product_recommendations(analysis_result: Dict) -> List[Dict]:
+async def get_product_recommendations(analysis_result: Dict, retrieval: RetrievalService) -> List[Dict]:
     """
     根据分析结果从ChromaDB检索推荐产品
 
     Parameters:
     - analysis_result: 分析结果
+    - retrieval: 应用级检索服务
 
     Returns:
     - 推荐产品列表
     """
     try:
-        # 连接ChromaDB
-        client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
-        collection = client.get_collection(name="char-split-collection")
-
         # 构建搜索查询
         search_queries = []
 
@@ -247,37 +265,26 @@ async def get_product_recommendations(analysis_result: Dict) -> List[Dict]:
         if not search_queries:
             search_queries = ["facial moisturizer", "hydrating serum"]
 
+        # 所有查询一次 embedding + 一次向量检索，按产品合并去重
+        hits = await run_blocking(
+            retrieval.multi_query,
+            search_queries[:3],  # 最多使用3个查询
+            n_results=3,  # 每个查询返回3个产品
+            include=["documents", "metadatas", "distances"]
+        )
+
         all_products = []
-        seen_product_names = set()
-
-        # 对每个查询进行搜索
-        for query in search_queries[:3]:  # 最多使用3个查询
-            query_embedding = generate_text_embeddings([query], dimensionality=1536)[0]
-
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=3,  # 每个查询返回3个产品
-                include=["documents", "metadatas", "distances"]
-            )
-
-            # 格式化结果
-            for i in range(len(results['documents'][0])):
-                metadata = results['metadatas'][0][i] if results['metadatas'] else {}
-                product_name = metadata.get('product_name', metadata.get('book', ''))
-
-                # 避免重复产品
-                if product_name and product_name not in seen_product_names:
-                    seen_product_names.add(product_name)
-
-                    all_products.append({
-                        'name': product_name,
-                        'brand': metadata.get('brand', ''),
-                        'category': metadata.get('category', ''),
-                        'description': results['documents'][0][i][:200],
-                        'amazon_url': metadata.get('amazon_url', ''),
-                        'ewg_url': metadata.get('ewg_url', ''),
-                        'relevance': round(1 - results['distances'][0][i], 3)
-                    })
+        for hit in hits:
+            metadata = hit['metadata']
+            all_products.append({
+                'name': metadata.get('product_name', metadata.get('book', '')),
+                'brand': metadata.get('brand', ''),
+                'category': metadata.get('category', ''),
+                'description': hit['document'][:200],
+                'amazon_url': metadata.get('amazon_url', ''),
+                'ewg_url': metadata.get('ewg_url', ''),
+                'relevance': round(1 - hit['distance'], 3)
+            })
 
         # 按相关度排序，返回前5个
         all_products.sort(key=lambda x: x['relevance'], reverse=True)
@@ -4,11 +4,12 @@
 """
 from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel
-from typing import Optional
-import requests
+import asyncio
 import urllib.parse
 import hashlib
 
+from api.services.product_images import product_image_resolver
+
 router = APIRouter()
 
 class ProductImageResponse(BaseModel):
@@ -35,99 +36,6 @@ def generate_placeholder_image(product_name: str) -> str:
     url = f"https://ui-avatars.com/api/?name={urllib.parse.quote(initials)}&size=200&background={bg_color}&color=fff&bold=true"
     return url
 
-def search_product_image_duckduckgo(product_name: str) -> Optional[str]:
-    """
-    使用DuckDuckGo搜索产品图片
-
-    Parameters:
-    - product_name: 产品名称
-
-    Returns:
-    - 图片URL或None
-    """
-    try:
-        # DuckDuckGo图片搜索API（非官方，但免费）
-        search_query = f"{product_name} skincare product"
-        url = "https://duckduckgo.com/"
-
-        # 第一步：获取vqd token
-        params = {"q": search_query}
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        }
-
-        response = requests.get(url, params=params, headers=headers, timeout=5)
-
-        # 从响应中提取vqd
-        vqd_search = 'vqd="'
-        vqd_start = response.text.find(vqd_search)
-        if vqd_start == -1:
-            return None
-
-        vqd_start += len(vqd_search)
-        vqd_end = response.text.find('"', vqd_start)
-        vqd = response.text[vqd_start:vqd_end]
-
-        # 第二步：使用vqd获取图片
-        image_url = "https://duckduckgo.com/i.js"
-        params = {
-            "l": "us-en",
-            "o": "json",
-            "q": search_query,
-            "vqd": vqd,
-            "f": ",,,",
-            "p": "1"
-        }
-
-        response = requests.get(image_url, params=params, headers=headers, timeout=5)
-        data = response.json()
-
-        # 提取第一张图片
-        if data.get("results") and len(data["results"]) > 0:
-            return data["results"][0].get("image")
-
-        return None
-
-    except Exception as e:
-        print(f"DuckDuckGo image search error: {e}")
-        return None
-
-def search_product_image_serpapi(product_name: str, api_key: Optional[str] = None) -> Optional[str]:
-    """
-    使用SerpAPI搜索Google图片（需要API key，但有免费额度）
-
-    Parameters:
-    - product_name: 产品名称
-    - api_key: SerpAPI key（可选）
-
-    Returns:
-    - 图片URL或None
-    """
-    if not api_key:
-        return None
-
-    try:
-        search_query = f"{product_name} skincare"
-        url = "https://serpapi.com/search.json"
-        params = {
-            "q": search_query,
-            "tbm": "isch",  # 图片搜索
-            "api_key": api_key,
-            "num": 1
-        }
-
-        response = requests.get(url, params=params, timeout=5)
-        data = response.json()
-
-        if data.get("images_results") and len(data["images_results"]) > 0:
-            return data["images_results"][0].get("original")
-
-        return None
-
-    except Exception as e:
-        print(f"SerpAPI image search error: {e}")
-        return None
-
 @router.get("/product-image", response_model=ProductImageResponse)
 async def get_product_image(
     product_name: str = Query(..., description="产品名称"),
@@ -157,8 +65,8 @@ async def get_product_image(
                 source="placeholder"
             )
 
-        # 尝试DuckDuckGo搜索
-        image_url = search_product_image_duckduckgo(product_name)
+        # 尝试DuckDuckGo搜索（超时返回 None）
+        image_url = await product_image_resolver.resolve(product_name)
 
         if image_url:
             return ProductImageResponse(
@@ -200,38 +108,17 @@ async def get_batch_product_images(
     - 产品图片信息列表
     """
     try:
-        names = [name.strip() for name in product_names.split(',')]
-        results = []
-
-        for name in names:
-            if not name:
-                continue
-
-            if use_placeholder:
-                placeholder_url = generate_placeholder_image(name)
-                results.append({
-                    "product_name": name,
-                    "image_url": placeholder_url,
-                    "source": "placeholder"
-                })
-            else:
-                # 尝试搜索
-                image_url = search_product_image_duckduckgo(name)
-
-                if image_url:
-                    results.append({
-                        "product_name": name,
-                        "image_url": image_url,
-                        "source": "duckduckgo"
-                    })
-                else:
-                    # 降级到占位图
-                    placeholder_url = generate_placeholder_image(name)
-                    results.append({
-                        "product_name": name,
-                        "image_url": placeholder_url,
-                        "source": "placeholder"
-                    })
+        names = [name.strip() for name in product_names.split(',') if name.strip()]
+
+        async def resolve(name: str) -> dict:
+            image_url = None if use_placeholder else await product_image_resolver.resolve(name)
+            if image_url:
+                return {"product_name": name, "image_url": image_url, "source": "duckduckgo"}
+            # 降级到占位图
+            return {"product_name": name, "image_url": generate_placeholder_image(name), "source": "placeholder"}
+
+        # 所有名称并发查找（并发数、重复名称的合并和超时由 product_image_resolver 处理）
+        results = await asyncio.gather(*(resolve(name) for name in names))
 
         return {
             "total": len(results),
@@ -2,10 +2,16 @@
 产品推荐路由
 处理护肤品推荐和产品查询
 """
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from typing import List, Optional
 import json
+import os
+import sys
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from api.services.catalog import ProductCatalog, get_catalog
 
 router = APIRouter()
 
@@ -35,7 +41,8 @@ class Product(BaseModel):
     why_recommended: str
     match_score: float
 
-# 模拟产品数据（实际应该从数据库或文件加载）
+# 推荐用的模拟产品数据：EWG 数据没有肤质、价格和评分字段，/recommend 仍使用这组数据，
+# 产品列表走 EWG 产品目录（api.services.catalog）；详情查询两边都能查到（/recommend 返回的 id 可以直接查询）
 MOCK_PRODUCTS = [
     {
         "product_id": "prod_001",
@@ -99,6 +106,8 @@ MOCK_PRODUCTS = [
     }
 ]
 
+MOCK_PRODUCTS_BY_ID = {product["product_id"]: product for product in MOCK_PRODUCTS}
+
 @router.post("/recommend", response_model=dict)
 async def get_recommendations(request: RecommendationRequest):
     """
@@ -181,22 +190,33 @@ async def get_recommendations(request: RecommendationRequest):
             detail=f"Error generating recommendations: {str(e)}"
         )
 
+def _require_catalog(catalog: Optional[ProductCatalog]) -> ProductCatalog:
+    if catalog is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Product catalog is not available"
+        )
+    return catalog
+
 @router.get("/{product_id}", response_model=dict)
-async def get_product_details(product_id: str):
+async def get_product_details(
+    product_id: str,
+    catalog: Optional[ProductCatalog] = Depends(get_catalog)
+):
     """
     获取单个产品的详细信息
 
     Parameters:
-    - product_id: 产品ID
+    - product_id: 产品ID（EWG 目录的 ewg_1002924，或 /recommend 返回的 prod_001）
 
     Returns:
-    - 产品详细信息
+    - 产品详细信息（含成分表、使用方法和警示）
     """
-    # 查找产品
-    product = next(
-        (p for p in MOCK_PRODUCTS if p["product_id"] == product_id),
-        None
-    )
+    # /recommend 的模拟产品不依赖产品目录
+    product = MOCK_PRODUCTS_BY_ID.get(product_id)
+    if product is None:
+        # product_id 哈希索引，O(1)
+        product = _require_catalog(catalog).get(product_id)
 
     if not product:
         raise HTTPException(
@@ -210,44 +230,37 @@ async def get_product_details(product_id: str):
 async def search_products(
     category: Optional[str] = None,
     brand: Optional[str] = None,
-    min_price: Optional[float] = None,
-    max_price: Optional[float] = None,
-    skin_type: Optional[str] = None,
-    limit: int = Query(default=20, le=100)
+    has_buy_link: Optional[bool] = None,
+    max_concern: Optional[str] = Query(default=None, pattern="^(low|moderate|high)$"),
+    limit: int = Query(default=20, le=100),
+    offset: int = Query(default=0, ge=0),
+    catalog: Optional[ProductCatalog] = Depends(get_catalog)
 ):
     """
     搜索和筛选产品
 
     Parameters:
-    - category: 产品类别
-    - brand: 品牌
-    - min_price, max_price: 价格范围
-    - skin_type: 肤质类型
-    - limit: 返回数量限制
+    - category: 产品类别（不区分大小写）
+    - brand: 品牌（不区分大小写）
+    - has_buy_link: 是否有购买链接
+    - max_concern: 成分关注等级上限（low / moderate / high）
+    - limit, offset: 分页
 
     Returns:
     - products: 产品列表
     """
-    filtered = MOCK_PRODUCTS.copy()
-
-    if category:
-        filtered = [p for p in filtered if p["category"] == category]
-
-    if brand:
-        filtered = [p for p in filtered if p["brand"].lower() == brand.lower()]
-
-    if min_price is not None:
-        filtered = [p for p in filtered if p["price"] >= min_price]
-
-    if max_price is not None:
-        filtered = [p for p in filtered if p["price"] <= max_price]
-
-    if skin_type:
-        filtered = [p for p in filtered if skin_type in p.get("skin_types", [])]
+    total, products = _require_catalog(catalog).list(
+        limit=limit,
+        offset=offset,
+        brand=brand,
+        category=category,
+        has_buy_link=has_buy_link,
+        max_concern=max_concern
+    )
 
     return {
-        "total": len(filtered),
-        "products": filtered[:limit]
+        "total": total,
+        "products": products
     }
 
 def calculate_match_score(product: dict, request: RecommendationRequest) -> float:
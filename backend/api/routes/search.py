@@ -2,10 +2,9 @@
 RAG搜索路由
 使用ChromaDB进行向量检索
 """
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from typing import List, Optional
-import chromadb
 import os
 import sys
 import hashlib
@@ -13,14 +12,14 @@ import urllib.parse
 
 # 添加backend目录到路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from cli import generate_text_embeddings
+from api.services.query_embeddings import embed_query
+from api.services.retrieval import RetrievalService, build_where, get_retrieval
+from api.services.blocking import run_blocking
+from api.services.lexical_index import LexicalIndex, fuse_product_hits, get_lexical
+from api.services.search_cache import search_cache_key, search_response_cache
 
 router = APIRouter()
 
-# ChromaDB配置
-CHROMADB_HOST = os.getenv("CHROMADB_HOST", "chromadb")
-CHROMADB_PORT = int(os.getenv("CHROMADB_PORT", "8000"))
-
 def generate_product_image_url(product_name: str) -> str:
     """
     为产品生成图片URL
@@ -47,7 +46,18 @@ def generate_product_image_url(product_name: str) -> str:
 @router.get("/search")
 async def search_products(
     q: str = Query(..., description="搜索查询"),
-    top_k: int = Query(default=5, le=20, description="返回结果数量")
+    top_k: int = Query(default=5, le=20, description="返回结果数量"),
+    ef: Optional[int] = Query(default=None, ge=1, le=1000, description="HNSW 检索宽度（仅 VECTOR_BACKEND=hnsw）"),
+    nprobe: Optional[int] = Query(default=None, ge=1, le=1024, description="IVF 探查的聚类数（仅 VECTOR_BACKEND=ivfpq）"),
+    mode: str = Query(default="product", pattern="^(product|chunk)$", description="product: 每个产品一条结果；chunk: 原始 chunk"),
+    score: str = Query(default="max", pattern="^(max|sum)$", description="产品分数：最相似 chunk 或命中 chunk 相似度之和"),
+    hybrid: bool = Query(default=True, description="产品模式下融合 BM25 关键词检索（RRF）"),
+    brand: Optional[str] = Query(default=None, description="只返回该品牌的产品"),
+    category: Optional[str] = Query(default=None, description="只返回该类别的产品"),
+    has_buy_link: Optional[bool] = Query(default=None, description="是否有购买链接"),
+    max_concern: Optional[str] = Query(default=None, pattern="^(low|moderate|high)$", description="成分关注等级上限"),
+    retrieval: RetrievalService = Depends(get_retrieval),
+    lexical: Optional[LexicalIndex] = Depends(get_lexical)
 ):
     """
     使用RAG进行产品搜索
@@ -55,47 +65,122 @@ async def search_products(
     Parameters:
     - q: 搜索查询（例如: "moisturizer for dry skin"）
     - top_k: 返回结果数量（默认5，最多20）
+    - ef / nprobe: 进程内 ANN 索引的召回/延迟参数，越大召回越高、越慢
+    - mode: product（默认）返回 top_k 个不同产品及其最相关的片段；chunk 返回原始 chunk
+    - score: 产品模式下的打分方式（max / sum）
+    - hybrid: 产品模式下把向量结果和 BM25 结果用 RRF 融合；embedding 服务不可用时只返回 BM25 结果
+    - brand / category / has_buy_link / max_concern: metadata 过滤，在检索内部执行（不是取回后再过滤），
+      所以过滤后仍返回 top_k 条（满足条件的产品足够时）
+
+    相同的（归一化后）查询和参数直接返回缓存的响应，集合重新加载后缓存自动失效。
 
     Returns:
     - results: 相关产品列表
     """
     try:
-        # 连接ChromaDB
-        client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
-        collection = client.get_collection(name="char-split-collection")
-
-        # 生成查询的embedding
-        query_embedding = generate_text_embeddings([q], dimensionality=1536)[0]
-
-        # 在ChromaDB中搜索
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            include=["documents", "metadatas", "distances"]
-        )
+        where = build_where(brand=brand, category=category, has_buy_link=has_buy_link, max_concern=max_concern)
+        use_lexical = mode == "product" and hybrid and lexical is not None
+
+        try:
+            version = await run_blocking(retrieval.version)
+        except Exception as e:
+            # 向量库不可用：不使用缓存（混合检索时下面会降级为词法检索）
+            print(f"Collection version unavailable, skipping search cache: {e}")
+            version = None
+        cache_key = search_cache_key(version, q, top_k=top_k, ef=ef, nprobe=nprobe, mode=mode, score=score,
+                                     hybrid=use_lexical, where=where) if version else None
+        cached = search_response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            return {**cached, "query": q}
+
+        # 词法检索在进程内完成（亚毫秒级），不需要卸载到线程池
+        lexical_hits = lexical.search(q, top_k=top_k * 2, where=where) if use_lexical else []
+        retrieval_mode = "hybrid" if use_lexical else "vector"
+
+        if mode == "product":
+            try:
+                # 应用级检索服务缓存的集合句柄（ChromaDB 或进程内索引，见 VECTOR_BACKEND）
+                collection = await run_blocking(retrieval.collection)
+
+                # 生成查询的embedding（进程内缓存，重复查询不调用 provider）
+                query_embedding = await run_blocking(embed_query, q, collection)
+
+                # 预取多个 chunk，按产品聚合后返回不同产品（混合检索时多取一些参与融合）
+                hits = await run_blocking(
+                    retrieval.product_query,
+                    query_embedding,
+                    top_k=top_k * 2 if use_lexical else top_k,
+                    score=score,
+                    ef=ef,
+                    nprobe=nprobe,
+                    where=where
+                )
+            except Exception as e:
+                if not use_lexical:
+                    raise
+                # embedding 服务或向量库不可用：降级为只用 BM25 结果
+                print(f"Vector search unavailable, falling back to lexical search: {e}")
+                hits = []
+                retrieval_mode = "lexical"
+            if use_lexical:
+                hits = fuse_product_hits(hits, lexical, lexical_hits, top_k)
+        else:
+            collection = await run_blocking(retrieval.collection)
+            query_embedding = await run_blocking(embed_query, q, collection)
+
+            # 在ChromaDB中搜索
+            results = await run_blocking(
+                retrieval.query,
+                query_embeddings=[query_embedding],
+                n_results=top_k,
+                include=["documents", "metadatas", "distances"],
+                ef=ef,
+                nprobe=nprobe,
+                where=where
+            )
+            hits = [
+                {
+                    'document': results['documents'][0][i],
+                    'metadata': results['metadatas'][0][i] if results['metadatas'] else {},
+                    'distance': results['distances'][0][i] if results['distances'] else None,
+                }
+                for i in range(len(results['documents'][0]))
+            ]
 
         # 格式化结果并添加图片URL
         formatted_results = []
-        for i in range(len(results['documents'][0])):
-            metadata = results['metadatas'][0][i] if results['metadatas'] else {}
+        for hit in hits:
+            metadata = hit['metadata']
             product_name = metadata.get('book', 'Unknown Product')
 
             # 生成产品图片URL
             image_url = generate_product_image_url(product_name)
 
-            formatted_results.append({
-                'document': results['documents'][0][i],
+            result = {
+                'document': hit['document'],
                 'metadata': metadata,
-                'distance': results['distances'][0][i] if results['distances'] else None,
+                'distance': hit['distance'],
                 'image_url': image_url,
                 'product_name': product_name
-            })
-
-        return {
+            }
+            if mode == "product":
+                result['score'] = hit['score']
+                result['matched_chunks'] = hit['matched_chunks']
+                if 'rrf_score' in hit:
+                    result['rrf_score'] = hit['rrf_score']
+            formatted_results.append(result)
+
+        response = {
             "query": q,
+            "retrieval": retrieval_mode,
+            "filters": where or {},
             "total": len(formatted_results),
             "results": formatted_results
         }
+        # 降级结果（只有词法检索）不缓存，向量检索恢复后立即用上完整结果
+        if cache_key and retrieval_mode != "lexical":
+            search_response_cache.set(cache_key, response)
+        return response
 
     except Exception as e:
         raise HTTPException(
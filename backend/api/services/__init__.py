@@ -0,0 +1,4 @@
+"""
+API 服务层
+路由之间共享的进程内状态（缓存、索引、客户端），每个 worker 进程一份
+"""
@@ -0,0 +1,180 @@
+"""
+/api/chat 语义回答缓存
+条目 = (查询向量, 检索到的产品集合, 回答)。新问题与某个条目的余弦相似度不低于阈值、
+并且检索到完全相同的产品集合时，直接返回该条目的回答，不再调用 GPT。
+
+- 向量保存在一个预分配的 (max_entries, dim) float32 矩阵里，查找是一次矩阵乘法
+- 条目数达到上限时淘汰最久未使用的条目
+- 每个条目所属的集合版本（RetrievalService.version）记录在缓存上：版本变化（集合重新加载）
+  时整个缓存清空
+- 定期和进程退出时写入 npz 文件（先写临时文件再替换），重启后继续使用
+"""
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from reload_with_links import EMBEDDINGS_FOLDER
+from api.services.cache import register
+
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", os.path.join(EMBEDDINGS_FOLDER, "chat-answer-cache.npz"))
+SEMANTIC_CACHE_ENTRIES = int(os.getenv("SEMANTIC_CACHE_ENTRIES", "5000"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# 有新条目时最多间隔多久写一次文件（秒）
+SEMANTIC_CACHE_SAVE_INTERVAL = float(os.getenv("SEMANTIC_CACHE_SAVE_INTERVAL", "300"))
+
+
+def _unit(vector) -> np.ndarray:
+    v = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+
+class SemanticAnswerCache:
+    def __init__(self, path: str = SEMANTIC_CACHE_PATH, max_entries: int = SEMANTIC_CACHE_ENTRIES,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD, save_interval: float = SEMANTIC_CACHE_SAVE_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.save_interval = save_interval
+        self.version = None
+        self._vectors = None       # (max_entries, dim)，前 len(self) 行有效
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._products = []        # 每个条目检索到的产品集合（frozenset）
+        self._answers = []
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._answers)
+
+    def _reset(self, version: str | None) -> None:
+        self.version = version
+        self._vectors = None
+        self._products = []
+        self._answers = []
+        self._dirty = True
+
+    def _check_version(self, version: str) -> None:
+        if version != self.version:
+            if self._answers:
+                self.invalidations += 1
+                print(f"[AnswerCache] collection version changed, dropping {len(self._answers)} answers")
+            self._reset(version)
+
+    def get(self, embedding, products, version: str) -> str | None:
+        """返回缓存的回答；没有足够相似且产品相同的条目时返回 None"""
+        q = _unit(embedding)
+        products = frozenset(products)
+        with self._lock:
+            self._check_version(version)
+            n = len(self._answers)
+            if n and self._vectors.shape[1] == q.shape[0]:
+                scores = self._vectors[:n] @ q
+                close = np.flatnonzero(scores >= self.threshold)
+                for i in close[np.argsort(-scores[close])]:
+                    if self._products[i] == products:
+                        self._last_used[i] = time.time()
+                        self.hits += 1
+                        return self._answers[i]
+            self.misses += 1
+            return None
+
+    def set(self, embedding, products, answer: str, version: str) -> None:
+        q = _unit(embedding)
+        with self._lock:
+            self._check_version(version)
+            if self._vectors is None or self._vectors.shape[1] != q.shape[0]:
+                self._reset(version)
+                self._vectors = np.zeros((self.max_entries, q.shape[0]), dtype=np.float32)
+            n = len(self._answers)
+            if n < self.max_entries:
+                i = n
+                self._products.append(None)
+                self._answers.append(None)
+            else:
+                i = int(np.argmin(self._last_used[:n]))
+                self.evictions += 1
+            self._vectors[i] = q
+            self._last_used[i] = time.time()
+            self._products[i] = frozenset(products)
+            self._answers[i] = answer
+            self._dirty = True
+
+    def save_due(self) -> bool:
+        return self._dirty and time.monotonic() - self._saved_at >= self.save_interval
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            n = len(self._answers)
+            meta = {"version": self.version, "products": [sorted(p) for p in self._products],
+                    "answers": self._answers}
+            vectors = self._vectors[:n].copy() if n else np.zeros((0, 0), dtype=np.float32)
+            last_used = self._last_used[:n].copy()
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp = self.path + ".tmp.npz"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            np.savez(tmp, vectors=vectors, last_used=last_used,
+                     meta=np.frombuffer(json.dumps(meta, ensure_ascii=False).encode("utf-8"), dtype=np.uint8))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[AnswerCache] could not save {self.path}: {e}")
+            return
+        print(f"[AnswerCache] saved {n} answers to {self.path}")
+
+    def load(self) -> None:
+        """读取持久化的缓存；文件不存在或损坏时从空缓存开始"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                vectors = data["vectors"]
+                last_used = data["last_used"]
+                meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+        except Exception as e:
+            print(f"[AnswerCache] could not load {self.path}: {e}")
+            return
+        # 超过上限时只保留最近使用的条目
+        keep = np.argsort(-last_used)[:self.max_entries]
+        with self._lock:
+            self._reset(meta.get("version"))
+            if len(keep):
+                self._vectors = np.zeros((self.max_entries, vectors.shape[1]), dtype=np.float32)
+                self._vectors[:len(keep)] = vectors[keep]
+                self._last_used[:len(keep)] = last_used[keep]
+                self._products = [frozenset(meta["products"][i]) for i in keep]
+                self._answers = [meta["answers"][i] for i in keep]
+            self._dirty = False
+        print(f"[AnswerCache] loaded {len(keep)} answers from {self.path}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._answers),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+answer_cache = SemanticAnswerCache()
+register("chat_answers", answer_cache)
@@ -0,0 +1,28 @@
+"""
+阻塞调用的线程池卸载
+没有异步客户端的调用（embedding provider、Chroma、进程内索引检索）放到有上限的线程池里执行，
+事件循环不会被单个慢请求卡住，同时限制同时占用的线程数。
+"""
+import os
+import functools
+
+import anyio
+import anyio.to_thread
+
+# 同时执行的阻塞调用上限（所有路由共享）
+BLOCKING_IO_THREADS = int(os.getenv("BLOCKING_IO_THREADS", "16"))
+
+_limiter = None
+
+
+def _get_limiter() -> anyio.CapacityLimiter:
+    # 在事件循环里第一次使用时创建
+    global _limiter
+    if _limiter is None:
+        _limiter = anyio.CapacityLimiter(BLOCKING_IO_THREADS)
+    return _limiter
+
+
+async def run_blocking(func, *args, **kwargs):
+    """在线程池中执行 func(*args, **kwargs) 并等待结果。"""
+    return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=_get_limiter())
@@ -0,0 +1,109 @@
+"""
+进程内 LRU + TTL 缓存
+- 按条目数和字节数双重限额，超出时淘汰最久未使用的条目
+- 记录命中/未命中/淘汰/过期次数，所有注册的缓存统一通过 cache_stats() 暴露
+  （其它实现了 stats() 的缓存用 register() 注册）
+"""
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+_registry = {}
+
+
+def _default_size(value) -> int:
+    nbytes = getattr(value, "nbytes", None)
+    return int(nbytes) if nbytes is not None else sys.getsizeof(value)
+
+
+class TTLCache:
+    """线程安全的 LRU 缓存，条目在 ttl 秒后过期（ttl=0 表示不过期）。
+
+    size_of: callable(value) -> int，估算单个值占用的字节数，默认使用 numpy 的 nbytes
+    """
+
+    def __init__(self, name: str, max_entries: int = 10_000, max_bytes: int = 0, ttl: float = 0,
+                 size_of=_default_size):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        register(name, self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, _, value = entry
+            if expires_at and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        size = self.size_of(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires_at, size, value)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries
+                                  or (self.max_bytes and self._bytes > self.max_bytes)):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key) -> None:
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def register(name: str, cache) -> None:
+    """cache 需要提供 stats() -> dict"""
+    _registry[name] = cache
+
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in _registry.items()}
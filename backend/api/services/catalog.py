@@ -0,0 +1,207 @@
+"""
+进程内产品目录（/api/products）
+- 启动时把 ewg_face_label_structured.jsonl 的产品读成列式存储：每个字段一个列，
+  brand / category 存为整数编码，concern_level / has_buy_link 存为 numpy 数组
+- product_id、brand、category 上建哈希索引（值 -> 行号数组），列表、过滤和详情查询
+  只访问候选行，开销与结果规模成正比，而不是全表扫描
+- 目录对象构建后只读；数据文件被重写（mtime 变化）后的第一个请求构建新目录，
+  构建成功后整体替换引用，正在处理的请求继续使用旧目录
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from reload_with_links import STRUCTURED_DATA, CONCERN_LEVELS, concern_level
+
+_ewg_id = re.compile(r"/products/(\d+)-")
+
+_catalogs = {}
+_failed = {}
+_lock = threading.Lock()
+
+
+def product_id_for(record: dict) -> str:
+    """EWG 产品页 URL 里的数字 id（稳定且唯一），没有 URL 时用标题的哈希"""
+    match = _ewg_id.search(record.get("url") or "")
+    if match:
+        return f"ewg_{match.group(1)}"
+    return "title_" + hashlib.md5((record.get("title") or "").encode()).hexdigest()[:12]
+
+
+def _key(value) -> str:
+    return (value or "").strip().lower()
+
+
+class _Codes:
+    """字符串列的字典编码：值 -> 整数编码，附带每个编码对应的行号数组（哈希索引）"""
+
+    def __init__(self, values: list):
+        self.labels = []
+        self._codes = {}
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            key = _key(value)
+            code = self._codes.get(key)
+            if code is None:
+                code = self._codes[key] = len(self.labels)
+                self.labels.append(value)
+            codes[i] = code
+        self.codes = codes
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(self.labels) + 1))
+        self._rows = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.labels))]
+
+    def code(self, value: str) -> int | None:
+        return self._codes.get(_key(value))
+
+    def rows(self, code: int) -> np.ndarray:
+        return self._rows[code]
+
+
+class ProductCatalog:
+    """只读的列式产品目录。version 是构建时数据文件的 mtime。"""
+
+    def __init__(self, records: list, version: float = 0.0):
+        columns = {name: [] for name in ("product_id", "name", "brand", "category", "ewg_url", "buy_urls",
+                                         "ingredient_concern", "ingredients", "directions", "warnings")}
+        levels = []
+        self._ids = {}
+        for rec in records:
+            pid = product_id_for(rec)
+            # 同一产品页可能被抓取多次，保留第一条
+            if not rec.get("title") or pid in self._ids:
+                continue
+            self._ids[pid] = len(levels)
+            sections = rec.get("label_sections") or {}
+            columns["product_id"].append(pid)
+            columns["name"].append(rec["title"])
+            columns["brand"].append(rec.get("brand") or "")
+            columns["category"].append(rec.get("category") or "")
+            columns["ewg_url"].append(rec.get("url") or "")
+            columns["buy_urls"].append(list(rec.get("buy_button_urls") or []))
+            columns["ingredient_concern"].append(rec.get("ingredient_concern") or "")
+            for section in ("ingredients", "directions", "warnings"):
+                columns[section].append((sections.get(section) or {}).get("text") or "")
+            levels.append(concern_level(rec))
+
+        self.version = version
+        self.columns = columns
+        self.concern_level = np.array(levels, dtype=np.int8)
+        self.has_buy_link = np.array([bool(urls) for urls in columns["buy_urls"]], dtype=bool)
+        self.brands = _Codes(columns["brand"])
+        self.categories = _Codes(columns["category"])
+
+    def __len__(self):
+        return len(self.concern_level)
+
+    @classmethod
+    def from_jsonl(cls, path: str = STRUCTURED_DATA) -> "ProductCatalog":
+        version = os.path.getmtime(path)
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        catalog = cls(records, version=version)
+        print(f"[Catalog] loaded {len(catalog)} products from {path}")
+        return catalog
+
+    def product(self, row: int, detail: bool = False) -> dict:
+        c = self.columns
+        buy_urls = c["buy_urls"][row]
+        product = {
+            "product_id": c["product_id"][row],
+            "name": c["name"][row],
+            "brand": c["brand"][row],
+            "category": c["category"][row],
+            "ewg_url": c["ewg_url"][row],
+            "amazon_url": buy_urls[0] if buy_urls else "",
+            "has_buy_link": bool(self.has_buy_link[row]),
+            "concern_level": int(self.concern_level[row]),
+        }
+        if detail:
+            product.update({
+                "buy_urls": buy_urls,
+                "ingredient_concern": c["ingredient_concern"][row],
+                "ingredients": c["ingredients"][row],
+                "directions": c["directions"][row],
+                "warnings": c["warnings"][row],
+            })
+        return product
+
+    def get(self, product_id: str) -> dict | None:
+        row = self._ids.get(product_id)
+        return self.product(row, detail=True) if row is not None else None
+
+    def filter(self, brand: str | None = None, category: str | None = None,
+               has_buy_link: bool | None = None, max_concern: str | None = None) -> np.ndarray:
+        """返回满足条件的行号（按文件顺序）。有 brand / category 时从较小的哈希桶出发，
+        其余条件在候选行上向量化判断。"""
+        candidates = None
+        for codes, value in ((self.brands, brand), (self.categories, category)):
+            if not value:
+                continue
+            code = codes.code(value)
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            rows = codes.rows(code)
+            if candidates is None or len(rows) < len(candidates):
+                candidates = rows
+        if candidates is None:
+            candidates = np.arange(len(self))
+
+        keep = np.ones(len(candidates), dtype=bool)
+        if brand:
+            keep &= self.brands.codes[candidates] == self.brands.code(brand)
+        if category:
+            keep &= self.categories.codes[candidates] == self.categories.code(category)
+        if has_buy_link is not None:
+            keep &= self.has_buy_link[candidates] == has_buy_link
+        if max_concern:
+            levels = self.concern_level[candidates]
+            keep &= (levels >= 1) & (levels <= CONCERN_LEVELS[max_concern])
+        return candidates[keep]
+
+    def list(self, limit: int = 20, offset: int = 0, **filters) -> tuple:
+        """返回 (满足条件的总数, 当前页的产品列表)"""
+        rows = self.filter(**filters)
+        return len(rows), [self.product(int(r)) for r in rows[offset:offset + limit]]
+
+
+def load_catalog(path: str = STRUCTURED_DATA) -> ProductCatalog | None:
+    """进程内常驻的产品目录；数据文件被重写后自动重新加载。
+
+    新目录完整构建后才替换旧引用；构建失败（例如文件写到一半）时继续使用旧目录。
+    数据文件不存在时返回 None。
+    """
+    key = os.path.abspath(path)
+    try:
+        version = os.path.getmtime(key)
+    except OSError:
+        return _catalogs.get(key)
+    catalog = _catalogs.get(key)
+    if (catalog is not None and catalog.version == version) or _failed.get(key) == version:
+        return catalog
+    with _lock:
+        catalog = _catalogs.get(key)
+        if (catalog is None or catalog.version != version) and _failed.get(key) != version:
+            try:
+                catalog = _catalogs[key] = ProductCatalog.from_jsonl(key)
+            except (OSError, ValueError) as e:
+                # 同一版本的文件不再重试，等下一次写入
+                _failed[key] = version
+                print(f"[Catalog] reload of {key} failed ({e}), keeping the previous catalog")
+        return catalog
+
+
+def get_catalog() -> ProductCatalog | None:
+    """FastAPI 依赖（同步函数，文件变化时的重建在线程池中进行）"""
+    return load_catalog()
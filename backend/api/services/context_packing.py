@@ -0,0 +1,154 @@
+"""
+聊天提示词的 token 预算
+把系统提示词、当前问题、检索到的 chunk 和对话历史装进每个模型固定的 token 预算：
+- chunk 按产品分组（保持检索排序），同一产品内去掉重复或被包含的片段，每个产品有单独的上限
+- 对话历史从最近一轮往前取，单轮过长时截断，占用不超过预算的 HISTORY_SHARE
+- 用 tiktoken 计数；未安装或编码表无法加载时按 4 字符/token 粗略估计
+"""
+import os
+import re
+import sys
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from api.services.retrieval import product_key
+
+# 每个模型的提示词 token 预算（不含回复的 max_tokens），CHAT_PROMPT_TOKENS 覆盖所有模型
+MODEL_PROMPT_BUDGETS = {
+    "gpt-4o-mini": 3000,
+    "gpt-4o": 3000,
+    "gpt-4.1-mini": 3000,
+    "gpt-3.5-turbo": 2000,
+}
+DEFAULT_PROMPT_BUDGET = 2000
+CHAT_PROMPT_TOKENS = int(os.getenv("CHAT_PROMPT_TOKENS", "0"))
+# 对话历史最多占预算的比例，单轮历史和单个产品的 token 上限
+HISTORY_SHARE = float(os.getenv("CHAT_HISTORY_SHARE", "0.25"))
+HISTORY_TURN_TOKENS = int(os.getenv("CHAT_HISTORY_TURN_TOKENS", "300"))
+PRODUCT_TOKENS = int(os.getenv("CHAT_PRODUCT_TOKENS", "450"))
+MIN_PRODUCT_TOKENS = 32
+# OpenAI chat 格式每条消息的固定开销，以及回复前缀
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+_whitespace = re.compile(r"\s+")
+
+
+def prompt_budget(model: str) -> int:
+    return CHAT_PROMPT_TOKENS or MODEL_PROMPT_BUDGETS.get(model, DEFAULT_PROMPT_BUDGET)
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # 编码表需要首次下载，离线环境下退回粗略估计，不影响对话
+        print(f"[ChatContext] tiktoken encoding for {model} unavailable ({e}), estimating tokens")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        return len(text) // 4 + 1 if text else 0
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    """截断到最多 max_tokens 个 token（被截断时末尾加省略号）"""
+    if max_tokens <= 0:
+        return ""
+    enc = _encoding(model)
+    if enc is None:
+        return text if len(text) <= max_tokens * 4 else text[:max_tokens * 4 - 4] + "..."
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens - 1]) + "..."
+
+
+def group_snippets(context: list) -> list:
+    """[(产品名, [片段, ...]), ...]，产品按第一次出现的检索排名排序；
+    同一产品内与已选片段相同或被其包含的片段被丢弃"""
+    groups = {}
+    for item in context:
+        text = (item.get('text') or '').strip()
+        if not text:
+            continue
+        name = product_key(item.get('metadata')) or ''
+        snippets = groups.setdefault(name, [])
+        norm = _whitespace.sub(" ", text).lower()
+        if any(norm in seen for _, seen in snippets):
+            continue
+        # 新片段包含了已选的片段：用新片段替换
+        snippets[:] = [(t, seen) for t, seen in snippets if seen not in norm]
+        snippets.append((text, norm))
+    return [(name, [t for t, _ in snippets]) for name, snippets in groups.items()]
+
+
+def pack_chat_messages(system_prompt: str, user_message: str, context: list, history: list, model: str) -> list:
+    """返回装入预算的消息列表：系统提示词 + 裁剪后的历史 + 带产品上下文的当前问题"""
+    budget = prompt_budget(model)
+    system_tokens = count_tokens(system_prompt, model) + MESSAGE_OVERHEAD
+    question_tokens = count_tokens(user_message, model) + MESSAGE_OVERHEAD + REPLY_OVERHEAD
+    remaining = budget - system_tokens - question_tokens
+
+    # 1. 对话历史：从最近一轮往前取
+    history_messages = []
+    history_tokens = 0
+    history_budget = min(int(budget * HISTORY_SHARE), max(remaining, 0))
+    for msg in reversed(history or []):
+        if not isinstance(msg, dict) or not msg.get('content'):
+            continue
+        content = truncate_tokens(str(msg['content']), HISTORY_TURN_TOKENS, model)
+        tokens = count_tokens(content, model) + MESSAGE_OVERHEAD
+        if history_tokens + tokens > history_budget:
+            break
+        history_messages.append({"role": msg.get('role', 'user'), "content": content})
+        history_tokens += tokens
+    history_messages.reverse()
+    remaining -= history_tokens
+
+    # 2. 产品上下文：按检索排名逐个产品装入剩余预算
+    header = "\n\n相关护肤品信息：\n"
+    context_text = ""
+    context_tokens = 0
+    groups = group_snippets(context)
+    packed = 0
+    if groups and remaining > count_tokens(header, model):
+        context_text = header
+        context_tokens = count_tokens(header, model)
+        for name, snippets in groups:
+            # 剩余预算连产品名都放不下时停止
+            if remaining - context_tokens < MIN_PRODUCT_TOKENS:
+                break
+            block = f"\n{packed + 1}. 产品: {name}\n" + "\n".join(snippets) + "\n"
+            block = truncate_tokens(block, min(PRODUCT_TOKENS, remaining - context_tokens), model)
+            tokens = count_tokens(block, model)
+            if context_tokens + tokens > remaining:
+                break
+            context_text += block
+            context_tokens += tokens
+            packed += 1
+        if not packed:
+            context_text, context_tokens = "", 0
+
+    total = system_tokens + question_tokens + history_tokens + context_tokens
+    print(f"[ChatContext] model={model} budget={budget} total={total} system={system_tokens} "
+          f"question={question_tokens} context={context_tokens} ({packed}/{len(groups)} products, "
+          f"{len(context)} chunks) history={history_tokens} ({len(history_messages)}/{len(history or [])} turns)")
+
+    return ([{"role": "system", "content": system_prompt}] + history_messages
+            + [{"role": "user", "content": f"{user_message}\n{context_text}"}])
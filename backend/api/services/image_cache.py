@@ -0,0 +1,139 @@
+"""
+/api/analyze-skin 结果缓存
+键 = (预处理后图片的 64 位 dHash, 归一化的 additional_info, 集合版本)。
+同一张或几乎相同的照片（重新压缩、轻微缩放）哈希的汉明距离很小：距离不超过阈值、
+其余键相同的条目直接复用分析结果和推荐产品，不再调用视觉模型和检索。
+
+哈希保存在一个 uint64 数组里，查找是一次向量化的 XOR + popcount；
+条目数和字节数有上限（淘汰最久未使用的条目），条目在 ttl 秒后过期。
+"""
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from api.services.cache import register
+
+SKIN_CACHE_ENTRIES = int(os.getenv("SKIN_CACHE_ENTRIES", "2048"))
+SKIN_CACHE_MB = float(os.getenv("SKIN_CACHE_MB", "16"))
+SKIN_CACHE_TTL = float(os.getenv("SKIN_CACHE_TTL", str(24 * 3600)))
+# 64 位 dHash 的汉明距离阈值
+SKIN_CACHE_HAMMING = int(os.getenv("SKIN_CACHE_HAMMING", "6"))
+
+
+def hamming_distances(hashes: np.ndarray, h: int) -> np.ndarray:
+    x = np.bitwise_xor(hashes, np.uint64(h))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return np.unpackbits(x.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class PerceptualHashCache:
+    """线程安全；value 需要可以 JSON 序列化（用于估算字节数）"""
+
+    def __init__(self, name: str, max_entries: int = SKIN_CACHE_ENTRIES,
+                 max_bytes: int = int(SKIN_CACHE_MB * 1024 * 1024), ttl: float = SKIN_CACHE_TTL,
+                 threshold: int = SKIN_CACHE_HAMMING):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.threshold = threshold
+        self._hashes = np.zeros(max_entries, dtype=np.uint64)
+        self._expires = np.zeros(max_entries, dtype=np.float64)   # 0 表示空位
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._sizes = np.zeros(max_entries, dtype=np.int64)
+        self._keys = [None] * max_entries
+        self._values = [None] * max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        register(name, self)
+
+    def _live(self, now: float) -> np.ndarray:
+        return self._expires > now
+
+    def get(self, h: int, key):
+        """返回汉明距离最小（且不超过阈值）的条目的值；没有时返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            distances = hamming_distances(self._hashes, h)
+            candidates = np.flatnonzero(self._live(now) & (distances <= self.threshold))
+            for i in candidates[np.argsort(distances[candidates], kind="stable")]:
+                if self._keys[i] == key:
+                    self._last_used[i] = now
+                    self.hits += 1
+                    return self._values[i]
+            self.misses += 1
+            return None
+
+    def set(self, h: int, key, value) -> None:
+        size = len(json.dumps(value, ensure_ascii=False, default=str))
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            live = self._live(now)
+            # 过期的条目直接释放
+            for j in np.flatnonzero(~live & (self._sizes > 0)):
+                self._sizes[j] = 0
+                self._keys[j] = None
+                self._values[j] = None
+                self.expirations += 1
+            free = np.flatnonzero(~live)
+            if len(free):
+                i = int(free[0])
+            else:
+                i = int(np.argmin(self._last_used))
+                self._evict(i)
+            while self._sizes.sum() + size > self.max_bytes:
+                occupied = np.flatnonzero(self._sizes)
+                self._evict(int(occupied[np.argmin(self._last_used[occupied])]))
+            self._hashes[i] = np.uint64(h)
+            self._expires[i] = now + self.ttl if self.ttl else np.inf
+            self._last_used[i] = now
+            self._sizes[i] = size
+            self._keys[i] = key
+            self._values[i] = value
+
+    def _evict(self, i: int) -> None:
+        self._expires[i] = 0
+        self._sizes[i] = 0
+        self._keys[i] = None
+        self._values[i] = None
+        self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._expires[:] = 0
+            self._sizes[:] = 0
+            self._keys = [None] * self.max_entries
+            self._values = [None] * self.max_entries
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": int(self._live(now).sum()),
+                "bytes": int(self._sizes.sum()),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hamming_threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+skin_analysis_cache = PerceptualHashCache("skin_analysis")
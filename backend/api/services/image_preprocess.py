@@ -0,0 +1,117 @@
+"""
+上传图片的读取和预处理
+- read_upload: 分块读取上传文件，超过上限立即中止，不会把任意大的请求读进内存
+- preprocess_image: 按 EXIF 旋转、缩小到最长边 IMAGE_MAX_EDGE、重新编码为 JPEG
+  （手机原图通常 4-12 MP，缩小后视觉模型的请求体和延迟都小得多）
+- difference_hash: 缩小后图片的 64 位 dHash（感知哈希，重新压缩、轻微缩放后基本不变）
+- prepare_image: 在进程池中执行 preprocess_image（解码/缩放是 CPU 密集型，不占用事件循环和 GIL）
+/api/analyze-skin 和 /api/analysis/upload 共用。
+"""
+import os
+import asyncio
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+IMAGE_UPLOAD_MAX_MB = float(os.getenv("IMAGE_UPLOAD_MAX_MB", "10"))
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 解码前的像素上限（防止解压炸弹），约 50 MP
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+
+READ_CHUNK_SIZE = 64 * 1024
+
+_pool = None
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+async def read_upload(upload, max_bytes: int = int(IMAGE_UPLOAD_MAX_MB * 1024 * 1024)) -> bytes:
+    """分块读取 UploadFile，超过 max_bytes 时抛出 UploadTooLarge"""
+    buffer = bytearray()
+    while True:
+        chunk = await upload.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return bytes(buffer)
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise UploadTooLarge(f"File size too large. Maximum {max_bytes // (1024 * 1024)}MB allowed.")
+
+
+def difference_hash(img: Image.Image, size: int = 8) -> int:
+    """dHash：灰度缩小到 (size+1) x size，每个像素与右侧像素比较得到 size*size 位"""
+    px = img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS).tobytes()
+    h = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            h = (h << 1) | (px[i] < px[i + 1])
+    return h
+
+
+def preprocess_image(data: bytes, max_edge: int = IMAGE_MAX_EDGE, quality: int = IMAGE_JPEG_QUALITY) -> bytes:
+    """解码、按 EXIF 方向旋转、缩小到最长边不超过 max_edge，返回 JPEG 字节"""
+    return _preprocess(data, max_edge, quality)[0]
+
+
+def preprocess_image_with_hash(data: bytes, max_edge: int = IMAGE_MAX_EDGE,
+                               quality: int = IMAGE_JPEG_QUALITY) -> tuple:
+    """与 preprocess_image 相同，另外返回缩小后图片的 dHash：(JPEG 字节, hash)"""
+    return _preprocess(data, max_edge, quality, with_hash=True)
+
+
+def _preprocess(data: bytes, max_edge: int, quality: int, with_hash: bool = False) -> tuple:
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    try:
+        img = Image.open(BytesIO(data))
+        # JPEG 可以在解码时按 1/2、1/4、1/8 缩小，大图省掉大部分解码开销
+        img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # 透明背景铺成白色，JPEG 不支持 alpha
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue(), difference_hash(img) if with_hash else None
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise InvalidImage(f"Invalid image: {e}") from e
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return _pool
+
+
+async def prepare_image(data: bytes, max_edge: int = IMAGE_MAX_EDGE, quality: int = IMAGE_JPEG_QUALITY) -> bytes:
+    """在进程池中执行 preprocess_image 并等待结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), preprocess_image, data, max_edge, quality)
+
+
+async def prepare_image_with_hash(data: bytes, max_edge: int = IMAGE_MAX_EDGE,
+                                  quality: int = IMAGE_JPEG_QUALITY) -> tuple:
+    """在进程池中执行 preprocess_image_with_hash，返回 (JPEG 字节, dHash)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), preprocess_image_with_hash, data, max_edge, quality)
+
+
+def shutdown_image_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
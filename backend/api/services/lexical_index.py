@@ -0,0 +1,200 @@
+"""
+进程内 BM25 倒排索引（产品级）
+- 启动时基于 ewg_face_label_structured.jsonl 的 title / brand / ingredients / warnings 字段构建
+- 英文/数字按词切分（"CI 77891" -> ci, 77891），中日韩文字用字符 bigram
+- 每个 posting 的 BM25 权重在构建时算好，查询只需对每个查询词做一次 numpy scatter-add
+- 与向量检索结果用 reciprocal rank fusion 融合；embedding provider 不可用时单独作为降级检索
+"""
+import os
+import re
+import sys
+import json
+import math
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+from fastapi import Request
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from reload_with_links import STRUCTURED_DATA, ProductTitleIndex, concern_level
+from api.services.retrieval import MetadataBitmaps, product_key
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# 字段权重（词频乘数）：产品名和品牌命中比成分表里出现一次更重要
+FIELD_WEIGHTS = {"title": 3, "brand": 2, "ingredients": 1, "warnings": 1}
+
+_word = re.compile(r"[a-z0-9]+(?:[.'-][a-z0-9]+)*")
+_cjk = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]+")
+
+
+def tokenize(text: str) -> list:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = _word.findall(text)
+    for run in _cjk.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _field_texts(record: dict) -> dict:
+    sections = record.get("label_sections") or {}
+    return {
+        "title": record.get("title") or "",
+        "brand": record.get("brand") or "",
+        "ingredients": (sections.get("ingredients") or {}).get("text") or "",
+        "warnings": (sections.get("warnings") or {}).get("text") or "",
+    }
+
+
+class LexicalIndex:
+    """products: 与文档一一对应的 dict 列表（至少包含 product_name = 结构化数据的 title，用作与向量结果融合的键）"""
+
+    def __init__(self, products: list, postings: dict):
+        self.products = products
+        self.postings = postings  # token -> (doc ids int32, bm25 weights float32)
+        self._keys = {p["product_name"]: i for i, p in enumerate(products)}
+        self._titles = ProductTitleIndex(self._keys)
+        # 与向量索引相同的 metadata 位图，用同一个 where 子句过滤
+        self.bitmaps = MetadataBitmaps(products)
+
+    def __len__(self):
+        return len(self.products)
+
+    @classmethod
+    def from_records(cls, records: list) -> "LexicalIndex":
+        products = []
+        doc_terms = []
+        seen = set()
+        for rec in records:
+            fields = _field_texts(rec)
+            # 产品名是融合键，重复的产品只保留第一条
+            if not fields["title"] or fields["title"] in seen:
+                continue
+            seen.add(fields["title"])
+            tf = Counter()
+            for field, text in fields.items():
+                for token in tokenize(text):
+                    tf[token] += FIELD_WEIGHTS[field]
+            doc_terms.append(tf)
+            buy_urls = rec.get("buy_button_urls") or []
+            products.append({
+                "product_name": fields["title"],
+                "brand": fields["brand"],
+                "category": rec.get("category") or "",
+                "amazon_url": buy_urls[0] if buy_urls else "",
+                "ewg_url": rec.get("url") or "",
+                "has_buy_link": bool(buy_urls),
+                "concern_level": concern_level(rec),
+                "snippet": f"Title: {fields['title']}\nBrand: {fields['brand']}\nIngredients: {fields['ingredients']}"[:400],
+            })
+
+        n_docs = len(doc_terms)
+        lengths = np.array([sum(tf.values()) for tf in doc_terms], dtype=np.float32)
+        avg_len = float(lengths.mean()) if n_docs else 0.0
+        by_token = defaultdict(list)
+        for doc, tf in enumerate(doc_terms):
+            for token, freq in tf.items():
+                by_token[token].append((doc, freq))
+
+        postings = {}
+        for token, entries in by_token.items():
+            docs = np.array([d for d, _ in entries], dtype=np.int32)
+            freqs = np.array([f for _, f in entries], dtype=np.float32)
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[docs] / avg_len)
+            postings[token] = (docs, (idf * freqs * (BM25_K1 + 1) / (freqs + norm)).astype(np.float32))
+        return cls(products, postings)
+
+    @classmethod
+    def from_jsonl(cls, path: str = STRUCTURED_DATA) -> "LexicalIndex":
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        index = cls.from_records(records)
+        print(f"[Lexical] indexed {len(index)} products, {len(index.postings)} terms from {path}")
+        return index
+
+    def search(self, query: str, top_k: int = 10, where: dict | None = None) -> list:
+        """返回 [(产品序号, BM25 分数), ...]，分数降序。where 与向量检索的过滤条件相同（见 build_where）。"""
+        scores = np.zeros(len(self.products), dtype=np.float32)
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if posting is not None:
+                docs, weights = posting
+                scores[docs] += weights
+        if where:
+            scores[~self.bitmaps.mask(where)] = 0
+        hits = np.flatnonzero(scores)
+        if not len(hits):
+            return []
+        k = min(top_k, len(hits))
+        top = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def product_id(self, name: str) -> str:
+        """向量结果的产品键（book 派生的产品名）对应的 title；对应不上时原样返回"""
+        if name in self._keys:
+            return name
+        return self._titles.match(name) or name
+
+    def product(self, name: str) -> dict | None:
+        i = self._keys.get(name)
+        return self.products[i] if i is not None else None
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """rankings: 若干个按相关度排好序的键列表。返回 [(键, RRF 分数), ...]，分数降序。"""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] += 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda kv: -kv[1])
+
+
+def fuse_product_hits(vector_hits: list, lexical: LexicalIndex, lexical_hits: list, top_k: int) -> list:
+    """用 RRF 融合向量检索的产品结果（RetrievalService.product_query）和 BM25 结果。
+
+    两边都命中的产品沿用向量结果（最相关的 chunk 作为 snippet）；只有词法命中的产品
+    用结构化数据生成 snippet 和 metadata，distance 为 None。每个结果带 rrf_score。
+    两边都按结构化数据的 title 融合（没有 product_id 的旧集合在这里对应）。
+    """
+    by_key = {}
+    for h in vector_hits:
+        by_key.setdefault(lexical.product_id(product_key(h['metadata'])), h)
+    rankings = [list(by_key), [lexical.products[i]["product_name"] for i, _ in lexical_hits]]
+    fused = []
+    for key, score in reciprocal_rank_fusion(rankings)[:top_k]:
+        hit = by_key.get(key)
+        if hit is None:
+            product = lexical.product(key)
+            metadata = {"book": key, "product_name": key}
+            metadata.update({f: product[f] for f in ("brand", "category", "amazon_url", "ewg_url") if product[f]})
+            metadata.update(has_buy_link=product["has_buy_link"], concern_level=product["concern_level"])
+            hit = {"document": product["snippet"], "metadata": metadata, "distance": None,
+                   "score": None, "matched_chunks": 0}
+        fused.append({**hit, "rrf_score": round(score, 6)})
+    return fused
+
+
+def load_lexical_index(path: str = STRUCTURED_DATA) -> LexicalIndex | None:
+    """启动时调用；数据文件不存在时返回 None（search 只走向量检索）"""
+    if not os.path.exists(path):
+        print(f"[Lexical] {path} not found, lexical search disabled")
+        return None
+    return LexicalIndex.from_jsonl(path)
+
+
+def get_lexical(request: Request) -> LexicalIndex | None:
+    """FastAPI 依赖：返回 lifespan 中构建的倒排索引"""
+    return getattr(request.app.state, "lexical", None)
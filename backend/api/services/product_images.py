@@ -0,0 +1,159 @@
+"""
+产品图片查找
+- 所有查找共用一个 httpx.AsyncClient（连接池、keep-alive），在应用关闭时释放
+- 同时进行的外部查找数受 PRODUCT_IMAGE_CONCURRENCY 限制
+- single-flight：同一产品（归一化后的名称）正在查找时，新的请求等待同一个查找结果，不再重复请求
+- 每次查找最多等待 PRODUCT_IMAGE_TIMEOUT 秒，超时返回 None（调用方降级到占位图）；
+  超时只影响当前等待者，共享的查找继续完成
+"""
+import os
+import sys
+import asyncio
+from typing import Optional
+
+import httpx
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from api.services.query_embeddings import normalize_query
+
+PRODUCT_IMAGE_CONCURRENCY = int(os.getenv("PRODUCT_IMAGE_CONCURRENCY", "8"))
+PRODUCT_IMAGE_TIMEOUT = float(os.getenv("PRODUCT_IMAGE_TIMEOUT", "6"))
+# 单个 HTTP 请求的超时（一次 DuckDuckGo 查找包含两个请求）
+PRODUCT_IMAGE_HTTP_TIMEOUT = float(os.getenv("PRODUCT_IMAGE_HTTP_TIMEOUT", "5"))
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+
+
+async def search_product_image_duckduckgo(client: httpx.AsyncClient, product_name: str) -> Optional[str]:
+    """
+    使用DuckDuckGo搜索产品图片
+
+    Returns:
+    - 图片URL或None
+    """
+    try:
+        # DuckDuckGo图片搜索API（非官方，但免费）
+        search_query = f"{product_name} skincare product"
+
+        # 第一步：获取vqd token
+        response = await client.get("https://duckduckgo.com/", params={"q": search_query})
+
+        # 从响应中提取vqd
+        vqd_search = 'vqd="'
+        vqd_start = response.text.find(vqd_search)
+        if vqd_start == -1:
+            return None
+
+        vqd_start += len(vqd_search)
+        vqd_end = response.text.find('"', vqd_start)
+        vqd = response.text[vqd_start:vqd_end]
+
+        # 第二步：使用vqd获取图片
+        params = {
+            "l": "us-en",
+            "o": "json",
+            "q": search_query,
+            "vqd": vqd,
+            "f": ",,,",
+            "p": "1"
+        }
+        response = await client.get("https://duckduckgo.com/i.js", params=params)
+        data = response.json()
+
+        # 提取第一张图片
+        if data.get("results"):
+            return data["results"][0].get("image")
+        return None
+
+    except Exception as e:
+        print(f"DuckDuckGo image search error: {e}")
+        return None
+
+
+async def search_product_image_serpapi(client: httpx.AsyncClient, product_name: str,
+                                       api_key: Optional[str] = None) -> Optional[str]:
+    """
+    使用SerpAPI搜索Google图片（需要API key，但有免费额度）
+
+    Returns:
+    - 图片URL或None
+    """
+    if not api_key:
+        return None
+
+    try:
+        params = {
+            "q": f"{product_name} skincare",
+            "tbm": "isch",  # 图片搜索
+            "api_key": api_key,
+            "num": 1
+        }
+        response = await client.get("https://serpapi.com/search.json", params=params)
+        data = response.json()
+
+        if data.get("images_results"):
+            return data["images_results"][0].get("original")
+        return None
+
+    except Exception as e:
+        print(f"SerpAPI image search error: {e}")
+        return None
+
+
+class ProductImageResolver:
+    """客户端和信号量在事件循环里第一次使用时创建"""
+
+    def __init__(self, concurrency: int = PRODUCT_IMAGE_CONCURRENCY, timeout: float = PRODUCT_IMAGE_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._client = None
+        self._semaphore = None
+        self._inflight = {}    # 归一化产品名 -> 正在进行的查找 Task
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=PRODUCT_IMAGE_HTTP_TIMEOUT,
+                headers={"User-Agent": USER_AGENT},
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.concurrency * 2,
+                                    max_keepalive_connections=self.concurrency),
+            )
+        return self._client
+
+    async def _search(self, product_name: str) -> Optional[str]:
+        async with self._semaphore:
+            return await search_product_image_duckduckgo(self._get_client(), product_name)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def resolve(self, product_name: str) -> Optional[str]:
+        """返回图片URL；查找失败或超时时返回 None"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        key = normalize_query(product_name)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._search(product_name))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._forget(key, t))
+        try:
+            # shield：等待者超时或被取消时不取消共享的查找
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            print(f"[ProductImages] lookup for {product_name!r} timed out after {self.timeout}s")
+            return None
+
+    async def close(self) -> None:
+        for task in list(self._inflight.values()):
+            task.cancel()
+        self._inflight.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+product_image_resolver = ProductImageResolver()
@@ -0,0 +1,60 @@
+"""
+查询向量缓存
+search / chat / image-analysis 路由共享同一个缓存：归一化后的查询文本 -> 向量，
+重复的查询（热门搜索、固定的追问）不再调用 embedding provider。
+"""
+import os
+import re
+import sys
+import unicodedata
+
+import numpy as np
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from cli import generate_text_embeddings, embedding_config_for_collection
+from api.services.cache import TTLCache
+
+QUERY_EMBEDDING_CACHE_MB = float(os.getenv("QUERY_EMBEDDING_CACHE_MB", "64"))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", str(24 * 3600)))
+
+query_embedding_cache = TTLCache(
+    "query_embeddings",
+    max_entries=1_000_000,
+    max_bytes=int(QUERY_EMBEDDING_CACHE_MB * 1024 * 1024),
+    ttl=QUERY_EMBEDDING_CACHE_TTL,
+)
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """全角/半角统一、小写、合并空白。"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return _whitespace.sub(" ", text).strip().lower()
+
+
+def _config_key(config: dict) -> tuple:
+    return (config.get("provider"), config.get("model"), config.get("dimensionality"))
+
+
+def embed_queries(queries: list, collection) -> list:
+    """返回与 queries 一一对应的向量（list[float]），只为未命中的查询调用一次 provider。"""
+    config = embedding_config_for_collection(collection)
+    prefix = _config_key(config)
+    keys = [prefix + (normalize_query(q),) for q in queries]
+
+    vectors = [query_embedding_cache.get(k) for k in keys]
+    missing = list(dict.fromkeys(k for k, v in zip(keys, vectors) if v is None))
+    if missing:
+        # 不写入离线建库用的 SQLite chunk 缓存（没有淘汰和大小上限）：查询复用由上面的内存 TTL 缓存负责
+        embeddings = generate_text_embeddings([k[-1] for k in missing], use_cache=False, **config)
+        fresh = {k: np.asarray(emb, dtype=np.float32) for k, emb in zip(missing, embeddings)}
+        for k, v in fresh.items():
+            query_embedding_cache.set(k, v)
+        vectors = [v if v is not None else fresh[k] for k, v in zip(keys, vectors)]
+    return [v.tolist() for v in vectors]
+
+
+def embed_query(query: str, collection) -> list:
+    return embed_queries([query], collection)[0]
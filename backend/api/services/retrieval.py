@@ -0,0 +1,397 @@
+"""
+检索服务
+VECTOR_BACKEND=chroma（默认）时通过 HTTP 查询 Chroma 容器；
+exact / hnsw / ivfpq 时直接在进程内检索向量存储（见 vector_index），省掉一次 HTTP 往返。
+
+RetrievalService 由 api/main.py 的 lifespan 创建，整个应用生命周期内复用：
+- 一个 Chroma HttpClient（底层 HTTP 连接池保持 keep-alive），不再每个请求新建
+- 缓存集合句柄，不再每个请求额外请求一次集合 metadata
+- 查询失败时（Chroma 重启、集合被 reload_with_links 重建）自动重连并重试一次
+路由通过 Depends(get_retrieval) 获取服务。
+"""
+import os
+import sys
+import time
+import threading
+
+import chromadb
+import numpy as np
+from fastapi import Request
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from vector_index import INDEX_KINDS, get_index
+from vector_store import HEADER_FILE
+from chroma_sync import CONTENT_VERSION_KEY
+from api.services.query_embeddings import embed_queries
+from reload_with_links import (VECTOR_STORE, STRUCTURED_DATA, CONCERN_LEVELS, extract_product_name_from_book,
+                               ProductMap, load_structured_data, product_metadata)
+
+# ChromaDB配置
+CHROMADB_HOST = os.getenv("CHROMADB_HOST", "chromadb")
+CHROMADB_PORT = int(os.getenv("CHROMADB_PORT", "8000"))
+# 例如 char-split-local-collection（本地 embedding 后端），查询向量的后端由集合 metadata 决定
+CHROMADB_COLLECTION = os.getenv("CHROMADB_COLLECTION", "char-split-collection")
+
+# chroma | exact | hnsw | ivfpq
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", VECTOR_STORE)
+# 按产品聚合时每个产品预取的 chunk 数（不足 top_k 个产品时自动加倍重取）
+SEARCH_OVERFETCH = int(os.getenv("SEARCH_OVERFETCH", "4"))
+MAX_OVERFETCH_CHUNKS = int(os.getenv("MAX_OVERFETCH_CHUNKS", "1000"))
+# Chroma 集合版本（id + 条数）的检查间隔（秒）：reload 后最多这么久响应缓存才失效
+COLLECTION_VERSION_TTL = float(os.getenv("COLLECTION_VERSION_TTL", "10"))
+
+
+def build_where(brand: str | None = None, category: str | None = None,
+                has_buy_link: bool | None = None, max_concern: str | None = None) -> dict | None:
+    """把过滤参数转换为 Chroma where 子句（进程内索引用 MetadataBitmaps 执行同样的子句）。
+
+    max_concern 只保留有关注等级数据且不高于该等级的产品（concern_level 0 表示没有数据）。
+    """
+    conditions = []
+    if brand:
+        conditions.append({"brand": brand})
+    if category:
+        conditions.append({"category": category})
+    if has_buy_link is not None:
+        conditions.append({"has_buy_link": has_buy_link})
+    if max_concern:
+        conditions.append({"concern_level": {"$gte": 1}})
+        conditions.append({"concern_level": {"$lte": CONCERN_LEVELS[max_concern]}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+class MetadataBitmaps:
+    """行级 metadata 的位图：每个 (字段, 值) 一个布尔掩码，数值字段一个数组，第一次用到时计算并缓存。
+
+    mask(where) 支持 Chroma where 子句的 $and / $or / $eq / $ne / $in / $gt / $gte / $lt / $lte。
+    """
+
+    def __init__(self, metadatas: list):
+        self._metadatas = metadatas
+        self._columns = {}
+        self._numeric = {}
+        self._masks = {}
+
+    def _column(self, field: str) -> np.ndarray:
+        if field not in self._columns:
+            column = np.empty(len(self._metadatas), dtype=object)
+            column[:] = [(m or {}).get(field) for m in self._metadatas]
+            self._columns[field] = column
+        return self._columns[field]
+
+    def _number(self, field: str) -> np.ndarray:
+        if field not in self._numeric:
+            self._numeric[field] = np.array(
+                [v if isinstance(v, (int, float)) else np.nan for v in self._column(field)], dtype=np.float64)
+        return self._numeric[field]
+
+    def _eq(self, field: str, value) -> np.ndarray:
+        key = (field, type(value).__name__, value)
+        if key not in self._masks:
+            column = self._column(field)
+            self._masks[key] = np.fromiter((v == value and type(v) is type(value) for v in column),
+                                           dtype=bool, count=len(column))
+        return self._masks[key]
+
+    def mask(self, where: dict) -> np.ndarray:
+        if "$and" in where:
+            return np.logical_and.reduce([self.mask(c) for c in where["$and"]])
+        if "$or" in where:
+            return np.logical_or.reduce([self.mask(c) for c in where["$or"]])
+        (field, cond), = where.items()
+        if not isinstance(cond, dict):
+            return self._eq(field, cond)
+        (op, value), = cond.items()
+        if op == "$eq":
+            return self._eq(field, value)
+        if op == "$ne":
+            return ~self._eq(field, value)
+        if op == "$in":
+            return np.logical_or.reduce([self._eq(field, v) for v in value])
+        numbers = self._number(field)
+        with np.errstate(invalid="ignore"):
+            if op == "$gt":
+                return numbers > value
+            if op == "$gte":
+                return numbers >= value
+            if op == "$lt":
+                return numbers < value
+            if op == "$lte":
+                return numbers <= value
+        raise ValueError(f"Unsupported where operator {op!r}")
+
+
+class LocalCollection:
+    """进程内向量索引，query() 的参数和返回格式与 Chroma collection.query 一致，
+    另外接受 ef / nprobe 等检索参数；where 过滤用预计算的位图执行。"""
+
+    def __init__(self, name: str, index, metadatas: list):
+        self.name = name
+        self.index = index
+        self.store = index.store
+        self.metadata = {"hnsw:space": "cosine", "embedding_dim": self.store.dim, **self.store.meta}
+        self._metadatas = metadatas
+        self.bitmaps = MetadataBitmaps(metadatas)
+
+    def count(self) -> int:
+        return self.store.count
+
+    def query(self, query_embeddings, n_results: int = 10,
+              include=("documents", "metadatas", "distances"), where: dict | None = None, **search_params) -> dict:
+        mask = self.bitmaps.mask(where) if where else None
+        scores, rows = self.index.search(np.asarray(query_embeddings, dtype=np.float32),
+                                         top_k=n_results, mask=mask, **search_params)
+        ids = self.store.ids
+        documents = self.store.column("chunk") if "documents" in include else None
+        return {
+            "ids": [[ids[i] for i in r] for r in rows],
+            "documents": [[documents[i] or "" for i in r] for r in rows] if documents is not None else None,
+            "metadatas": [[self._metadatas[i] for i in r] for r in rows] if "metadatas" in include else None,
+            "distances": (1.0 - scores).tolist() if "distances" in include else None,
+        }
+
+
+def product_key(metadata: dict) -> str:
+    """同一产品的所有 chunk 共享的键，用于按产品去重以及与倒排索引结果融合。
+
+    优先用 product_id（结构化数据的 title），旧集合没有时用 book 派生的产品名
+    """
+    metadata = metadata or {}
+    return (metadata.get('product_id') or metadata.get('product_name')
+            or extract_product_name_from_book(metadata.get('book')))
+
+
+def aggregate_by_product(results: dict, top_k: int, score: str = "max", row: int = 0) -> list:
+    """把一次查询返回的 chunk 按产品分组（向量化），返回最多 top_k 个不同产品。
+
+    score="max": 产品分数 = 最相似 chunk 的相似度；score="sum": 所有命中 chunk 相似度之和
+    每个结果带上最相似的 chunk 作为 snippet:
+    {"id", "document", "metadata", "distance", "score", "matched_chunks"}
+    """
+    ids = results['ids'][row]
+    if not ids:
+        return []
+    metadatas = results['metadatas'][row]
+    documents = results['documents'][row] if results.get('documents') else [None] * len(ids)
+    distances = results['distances'][row]
+    similarity = 1.0 - np.asarray(distances, dtype=np.float64)
+
+    keys = np.array([product_key(m) or _id for m, _id in zip(metadatas, ids)], dtype=object)
+    _, group = np.unique(keys, return_inverse=True)
+    n_groups = group.max() + 1
+
+    # 每组最相似的 chunk：按 (组, -相似度) 排序后取每组第一行
+    order = np.lexsort((-similarity, group))
+    first = np.r_[True, group[order][1:] != group[order][:-1]]
+    best_rows = order[first]                # 第 g 组最相似 chunk 的行号
+    if score == "sum":
+        group_score = np.bincount(group, weights=similarity, minlength=n_groups)
+    else:
+        group_score = similarity[best_rows]
+    counts = np.bincount(group, minlength=n_groups)
+
+    top = np.argsort(-group_score, kind="stable")[:top_k]
+    return [
+        {
+            'id': ids[best_rows[g]],
+            'document': documents[best_rows[g]],
+            'metadata': metadatas[best_rows[g]] or {},
+            'distance': distances[best_rows[g]],
+            'score': round(float(group_score[g]), 6),
+            'matched_chunks': int(counts[g]),
+        }
+        for g in top
+    ]
+
+
+def _row_metadatas(store) -> list:
+    """与 reload_with_links 写入 Chroma 的 metadata 相同：同一产品的 chunk 共享一份 dict"""
+    product_map = load_structured_data() if os.path.exists(STRUCTURED_DATA) else ProductMap()
+    metadatas = []
+    for book, _, count in store.groups():
+        metadatas.extend([product_metadata(book, product_map)] * count)
+    return metadatas
+
+
+class RetrievalService:
+    def __init__(self, backend: str = VECTOR_BACKEND, host: str = CHROMADB_HOST, port: int = CHROMADB_PORT,
+                 collection_name: str = CHROMADB_COLLECTION, store_path: str = VECTOR_STORE_PATH):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.collection_name = collection_name
+        self.store_path = store_path
+        self._client = None
+        self._collections = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def is_local(self) -> bool:
+        return self.backend in INDEX_KINDS
+
+    def _chroma_client(self):
+        if self._client is None:
+            self._client = chromadb.HttpClient(host=self.host, port=self.port)
+        return self._client
+
+    def _local_collection(self) -> LocalCollection:
+        index = get_index(self.store_path, self.backend)
+        collection = self._collections.get(self.backend)
+        # 向量存储被重写后 get_index 返回新的索引，metadata 一起重建
+        if collection is None or collection.index is not index:
+            collection = LocalCollection(f"{os.path.basename(self.store_path)}-{self.backend}", index,
+                                         _row_metadatas(index.store))
+            self._collections[self.backend] = collection
+        return collection
+
+    def collection(self, name: str | None = None):
+        """返回缓存的集合句柄（第一次调用时才连接/加载）。"""
+        with self._lock:
+            if self.is_local:
+                return self._local_collection()
+            name = name or self.collection_name
+            if name not in self._collections:
+                self._collections[name] = self._chroma_client().get_collection(name=name)
+            return self._collections[name]
+
+    def version(self, name: str | None = None) -> str:
+        """集合内容的版本号，集合被重建或重新加载后改变（用作响应缓存键的一部分）。
+
+        进程内索引用向量存储 header 的 mtime；Chroma 用集合 id + 同步时写入 metadata 的内容版本
+        （chroma_sync.stamp_version，增量同步只改 metadata 时也会变化；没有内容版本的旧集合退回到条数），
+        每 COLLECTION_VERSION_TTL 秒重新获取一次集合（集合被重建时顺便替换缓存的句柄）。
+        """
+        if self.is_local:
+            collection = self.collection()
+            return f"{collection.name}:{os.path.getmtime(os.path.join(collection.store.path, HEADER_FILE))}"
+        return self._chroma_state(name)[0]
+
+    def count(self, name: str | None = None) -> int:
+        """集合的 chunk 数。Chroma 的条数与 version 一起缓存 COLLECTION_VERSION_TTL 秒，
+        检索时不必每次请求都多一次 HTTP 往返。"""
+        if self.is_local:
+            return self.collection().count()
+        return self._chroma_state(name)[1]
+
+    def _chroma_state(self, name: str | None = None) -> tuple:
+        name = name or self.collection_name
+        checked_at, version, count = self._versions.get(name, (0.0, None, 0))
+        if version is None or time.monotonic() - checked_at >= COLLECTION_VERSION_TTL:
+            collection = self._chroma_client().get_collection(name=name)
+            count = collection.count()
+            content = (collection.metadata or {}).get(CONTENT_VERSION_KEY) or count
+            version = f"{name}:{collection.id}:{content}"
+            with self._lock:
+                self._collections[name] = collection
+                self._versions[name] = (time.monotonic(), version, count)
+        return version, count
+
+    def reset(self) -> None:
+        """丢弃客户端和集合句柄，下一次调用时重新连接。"""
+        with self._lock:
+            self._client = None
+            self._collections.clear()
+            self._versions.clear()
+
+    def warm(self) -> None:
+        """启动时预先连接 Chroma / 加载进程内索引；失败不影响启动，第一次请求时再试。"""
+        try:
+            collection = self.collection()
+            print(f"[Retrieval] {self.backend} backend ready: {collection.name} ({collection.count()} chunks)")
+        except Exception as e:
+            print(f"[Retrieval] {self.backend} backend not ready yet: {e}")
+            self.reset()
+
+    def close(self) -> None:
+        self.reset()
+
+    def query(self, query_embeddings, n_results: int,
+              include=("documents", "metadatas", "distances"),
+              ef: int | None = None, nprobe: int | None = None, name: str | None = None,
+              where: dict | None = None) -> dict:
+        """ef / nprobe 只对进程内的 hnsw / ivfpq 索引生效，Chroma 后端忽略。
+        where 是 metadata 过滤条件（见 build_where），在检索内部执行。"""
+        if self.is_local:
+            params = {k: v for k, v in (("ef", ef), ("nprobe", nprobe)) if v}
+            return self.collection().query(query_embeddings, n_results=n_results, include=include,
+                                           where=where, **params)
+        kwargs = {"where": where} if where else {}
+        try:
+            return self.collection(name).query(
+                query_embeddings=query_embeddings, n_results=n_results, include=list(include), **kwargs)
+        except Exception as e:
+            # 连接断开或集合被重建（句柄指向旧的集合 id）：重连后重试一次
+            print(f"[Retrieval] query failed ({e}), reconnecting")
+            self.reset()
+            return self.collection(name).query(
+                query_embeddings=query_embeddings, n_results=n_results, include=list(include), **kwargs)
+
+    def product_query(self, query_embedding, top_k: int, score: str = "max", overfetch: int = SEARCH_OVERFETCH,
+                      ef: int | None = None, nprobe: int | None = None, name: str | None = None,
+                      where: dict | None = None) -> list:
+        """按产品聚合的检索：预取 top_k * overfetch 个 chunk，分组后返回 top_k 个不同产品。
+        集合里产品足够但预取的 chunk 凑不满 top_k 个产品时，加倍预取量重试。
+        where 过滤在检索内部执行，预取的 chunk 都满足条件。空集合直接返回 []。"""
+        total = self.count(name)
+        if not total:
+            return []
+        n_results = min(max(top_k * overfetch, top_k), total, MAX_OVERFETCH_CHUNKS)
+        while True:
+            results = self.query([query_embedding], n_results=n_results,
+                                 include=("documents", "metadatas", "distances"),
+                                 ef=ef, nprobe=nprobe, name=name, where=where)
+            products = aggregate_by_product(results, top_k, score=score)
+            # 过滤后返回的 chunk 不足 n_results 说明满足条件的 chunk 已全部取到
+            exhausted = len(results['ids'][0]) < n_results
+            if len(products) >= top_k or exhausted or n_results >= min(total, MAX_OVERFETCH_CHUNKS):
+                return products
+            n_results = min(n_results * 2, total, MAX_OVERFETCH_CHUNKS)
+
+    def multi_query(self, queries: list, n_results: int, include=("documents", "metadatas", "distances"),
+                    ef: int | None = None, nprobe: int | None = None, name: str | None = None,
+                    where: dict | None = None) -> list:
+        """一批查询文本：一次 embedding 调用 + 一次带多个 query_embeddings 的向量查询，
+        合并后按产品去重（保留距离最小的 chunk），按距离升序返回。
+
+        每个结果: {"id", "document", "metadata", "distance", "queries": [命中该产品的查询]}
+        """
+        queries = [q for q in queries if q]
+        if not queries:
+            return []
+        collection = self.collection(name)
+        embeddings = embed_queries(queries, collection)
+        include = tuple(dict.fromkeys(tuple(include) + ("metadatas", "distances")))
+        results = self.query(embeddings, n_results=n_results, include=include, ef=ef, nprobe=nprobe, name=name,
+                             where=where)
+
+        best = {}
+        for qi, query in enumerate(queries):
+            for i, _id in enumerate(results['ids'][qi]):
+                metadata = results['metadatas'][qi][i] or {}
+                key = product_key(metadata)
+                if not key:
+                    continue
+                distance = results['distances'][qi][i]
+                hit = best.get(key)
+                if hit is None or distance < hit['distance']:
+                    best[key] = {
+                        'id': _id,
+                        'document': results['documents'][qi][i] if results.get('documents') else None,
+                        'metadata': metadata,
+                        'distance': distance,
+                        'queries': hit['queries'] if hit else [],
+                    }
+                    hit = best[key]
+                if query not in hit['queries']:
+                    hit['queries'].append(query)
+        return sorted(best.values(), key=lambda h: h['distance'])
+
+
+def get_retrieval(request: Request) -> RetrievalService:
+    """FastAPI 依赖：返回 lifespan 中创建的检索服务"""
+    return request.app.state.retrieval
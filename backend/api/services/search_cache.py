@@ -0,0 +1,37 @@
+"""
+/api/search 响应缓存
+键 = (集合版本, 归一化查询, top_k, 检索参数, 过滤条件)。集合版本见 RetrievalService.version：
+集合被重新加载后版本改变，旧条目不会再被命中，随 LRU / TTL 淘汰，无需显式清空。
+命中/未命中/淘汰次数通过 /api/cache/stats 暴露（search_responses）。
+"""
+import os
+import sys
+import json
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from api.services.cache import TTLCache
+from api.services.query_embeddings import normalize_query
+
+SEARCH_CACHE_ENTRIES = int(os.getenv("SEARCH_CACHE_ENTRIES", "4096"))
+SEARCH_CACHE_MB = float(os.getenv("SEARCH_CACHE_MB", "32"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+
+
+def _json_size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, default=str))
+
+
+search_response_cache = TTLCache(
+    "search_responses",
+    max_entries=SEARCH_CACHE_ENTRIES,
+    max_bytes=int(SEARCH_CACHE_MB * 1024 * 1024),
+    ttl=SEARCH_CACHE_TTL,
+    size_of=_json_size,
+)
+
+
+def search_cache_key(version: str, q: str, **params) -> tuple:
+    """params: top_k / mode / score / 过滤条件等，值为 None 的参数与未传相同"""
+    return (version, normalize_query(q)) + tuple(sorted(
+        (k, json.dumps(v, sort_keys=True)) for k, v in params.items() if v is not None))
@@ -0,0 +1,165 @@
+"""
+购买链接索引
+把完整的 EWG jsonl 只读一次，构建：
+- URL 哈希表：产品页 url -> 记录
+- 标题索引：标题规范化为小写词序列，完整标题哈希表 + 词 -> 记录的倒排表，
+  用来回答"标题互相包含"的模糊匹配
+购买链接在构建时就经过 _is_purchase_link 过滤，查询一批候选只做哈希查找，
+开销与候选数成正比，与数据集大小无关。
+"""
+import os
+import re
+import json
+import threading
+from urllib.parse import urlparse
+
+# 每条记录最多保留的购买链接数
+MAX_LINKS_PER_RECORD = 5
+
+_doc_url = re.compile(r"https?://[^\s'\)\"]+")
+_title_token = re.compile(r"\w+")
+_black_domains = ('facebook.com', 'twitter.com', 'instagram.com', 'youtube.com', 'play.google.com',
+                  'apps.apple.com', 'linkedin.com')
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _is_purchase_link(u: str) -> bool:
+    try:
+        p = urlparse(u)
+        domain = (p.netloc or '').lower()
+        # 排除 site-internal links (ewg)：产品页、成分页、导航/帮助页都不是购买链接
+        if 'ewg.org' in domain:
+            return False
+        # 排除社交媒体 / app store / tracking 等非购买目的域名
+        if any(bd in domain for bd in _black_domains):
+            return False
+        # 最终：接受外部域名作为可能的购买链接
+        return bool(domain)
+    except Exception:
+        return False
+
+
+def normalize_title(title: str) -> str:
+    """小写词序列（空格分隔），标题包含关系按完整的词判断"""
+    return " ".join(_title_token.findall((title or "").casefold()))
+
+
+def _url_keys(u: str) -> list:
+    """文档里的 url 可能在产品页 url 后面带路径/参数，按每个 '/' 处的前缀查找"""
+    u = u.strip()
+    keys = [u]
+    for i, ch in enumerate(u):
+        if ch == '/' and i > len('https://'):
+            keys.append(u[:i + 1])
+    return keys
+
+
+class BuyLinkIndex:
+    """links[rid] / titles[rid] 是第 rid 条记录过滤后的购买链接和规范化标题
+    （按文件顺序，没有购买链接的记录不进入索引）"""
+
+    def __init__(self, records: list):
+        self.links = []
+        self.titles = []
+        self.by_url = {}
+        self.by_title = {}
+        self.postings = {}
+        for rec in records:
+            buy_urls = rec.get('buy_button_urls') or rec.get('where_to_buy_urls') or []
+            links = []
+            for u in buy_urls:
+                if u and u not in links and _is_purchase_link(u):
+                    links.append(u)
+                    if len(links) >= MAX_LINKS_PER_RECORD:
+                        break
+            if not links:
+                continue
+            rid = len(self.links)
+            self.links.append(links)
+            rec_url = (rec.get('url') or rec.get('source_url') or '').strip()
+            if rec_url:
+                self.by_url.setdefault(rec_url, []).append(rid)
+            title = normalize_title(rec.get('title'))
+            self.titles.append(title)
+            if title:
+                self.by_title.setdefault(title, []).append(rid)
+                for token in set(title.split()):
+                    self.postings.setdefault(token, []).append(rid)
+
+    def __len__(self):
+        return len(self.links)
+
+    @classmethod
+    def from_jsonl(cls, path: str) -> "BuyLinkIndex":
+        records = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        index = cls(records)
+        print(f"[BuyLinks] indexed {len(index)} records with purchase links from {path}")
+        return index
+
+    def _title_matches(self, title: str) -> set:
+        tokens = title.split()
+        matched = set()
+        # 记录标题包含于候选标题：枚举候选标题的连续词片段
+        for i in range(len(tokens)):
+            for j in range(i + 1, len(tokens) + 1):
+                matched.update(self.by_title.get(" ".join(tokens[i:j]), ()))
+        # 候选标题包含于记录标题：从最稀有的词的倒排表出发逐条验证
+        postings = [self.postings.get(t, ()) for t in set(tokens)]
+        rarest = min(postings, key=len)
+        padded = f" {title} "
+        for rid in rarest:
+            if rid not in matched and padded in f" {self.titles[rid]} ":
+                matched.add(rid)
+        return matched
+
+    def match(self, meta_url: str | None = None, meta_title: str | None = None, doc: str = "") -> list:
+        """返回一个候选的购买链接（匹配记录按文件顺序合并、去重）"""
+        matched = set()
+        if meta_url:
+            matched.update(self.by_url.get(meta_url.strip(), ()))
+        for u in _doc_url.findall(doc or ""):
+            for key in _url_keys(u):
+                matched.update(self.by_url.get(key, ()))
+        title = normalize_title(meta_title)
+        if title:
+            matched.update(self._title_matches(title))
+        links = []
+        for rid in sorted(matched):
+            for u in self.links[rid]:
+                if u not in links:
+                    links.append(u)
+        return links
+
+    def lookup(self, docs: list, metadatas: list | None) -> dict:
+        """{idx: [url, ...]}，idx 是 docs/metadatas 列表中的位置索引"""
+        results = {}
+        for i, doc in enumerate(docs):
+            md = (metadatas[i] if metadatas and i < len(metadatas) else None) or {}
+            results[i] = self.match(
+                meta_url=md.get('source_url') or md.get('url') or md.get('source') or md.get('sourceUrl'),
+                meta_title=md.get('title') or md.get('book'),
+                doc=doc,
+            )
+        return results
+
+
+def get_buy_link_index(path: str) -> BuyLinkIndex | None:
+    """进程内常驻的购买链接索引；文件被重写后自动重新构建，文件不存在时返回 None。"""
+    key = os.path.abspath(path)
+    try:
+        version = os.path.getmtime(key)
+    except OSError:
+        return None
+    with _lock:
+        entry = _indexes.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, BuyLinkIndex.from_jsonl(key))
+            _indexes[key] = entry
+        return entry[1]
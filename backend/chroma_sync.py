@@ -0,0 +1,117 @@
+"""
+增量同步到 ChromaDB
+- 每个 chunk 的 id 由内容派生（book + 文本 + 同文本出现序号，见 chunk_dataset.chunk_ids），
+  文本变化即 id 变化，与文件顺序无关
+- 本地 manifest 记录集合中已有的 {id: fingerprint}，fingerprint 覆盖 metadata 和向量
+- 只 upsert 新增/变化的 chunk，delete 已删除的 chunk；先写后删，检索期间集合始终可用
+- 同步后把整个集合内容的哈希写入集合 metadata（CONTENT_VERSION_KEY），
+  API 用它判断集合是否变化（RetrievalService.version），只改 metadata 的增量同步也会改变版本
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+CONTENT_VERSION_KEY = "content_version"
+
+
+def manifest_path(folder: str, collection_name: str) -> str:
+    return os.path.join(folder, f"chroma-manifest-{collection_name}.json")
+
+
+def fingerprint(metadata: dict, vector) -> str:
+    # 文本已经编码在内容派生的 id 里，这里只需要覆盖 metadata 和向量
+    h = hashlib.sha256()
+    h.update(json.dumps(metadata, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    h.update(np.asarray(vector, dtype=np.float32).tobytes())
+    return h.hexdigest()[:24]
+
+
+def content_version(entries: dict) -> str:
+    """{id: fingerprint} 的哈希：集合中任一 chunk 的文本、metadata 或向量变化都会改变它"""
+    h = hashlib.sha256()
+    for _id in sorted(entries):
+        h.update(f"{_id}\t{entries[_id]}\n".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def stamp_version(collection, version: str) -> None:
+    """把内容版本写入集合 metadata（版本未变化时不写）"""
+    metadata = dict(collection.metadata or {})
+    if metadata.get(CONTENT_VERSION_KEY) == version:
+        return
+    metadata[CONTENT_VERSION_KEY] = version
+    # hnsw:* 只能在创建集合时设置，modify 时带上会被 Chroma 拒绝
+    collection.modify(metadata={k: v for k, v in metadata.items() if not k.startswith("hnsw:")})
+    print(f"[Sync] collection content version: {version}")
+
+
+def load_manifest(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("entries", {})
+
+
+def save_manifest(path: str, collection_name: str, entries: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"collection": collection_name, "entries": entries}, f)
+    os.replace(tmp, path)
+
+
+def _existing_entries(collection, manifest: dict) -> dict:
+    """manifest 与集合实际条数不一致时（例如 Chroma 数据卷被重建），以集合里的 id 为准。
+    fingerprint 未知的条目记为 None，会被重新 upsert。"""
+    count = collection.count()
+    if count == len(manifest):
+        return manifest
+    print(f"[Sync] manifest has {len(manifest)} entries but collection has {count}, rebuilding from collection ids")
+    existing = {}
+    for offset in range(0, count, 5000):
+        got = collection.get(include=[], limit=5000, offset=offset)
+        for _id in got["ids"]:
+            existing[_id] = manifest.get(_id)
+    return existing
+
+
+def sync_collection(collection, ids: list, metadatas: list, vectors, get_documents,
+                    manifest_file: str, batch_size: int = 500) -> dict:
+    """把 (ids, metadatas, vectors) 增量同步到集合。
+
+    vectors 可以是 np.memmap；get_documents(rows) 只在有行需要写入时才被调用，
+    所以集合已是最新时完全不需要读取 chunk 文本。
+    """
+    existing = _existing_entries(collection, load_manifest(manifest_file))
+
+    desired = {}
+    to_upsert = []
+    for i, _id in enumerate(ids):
+        fp = fingerprint(metadatas[i], vectors[i])
+        desired[_id] = fp
+        if existing.get(_id) != fp:
+            to_upsert.append(i)
+    to_delete = [_id for _id in existing if _id not in desired]
+
+    print(f"[Sync] {len(ids)} chunks: {len(to_upsert)} to upsert, {len(to_delete)} to delete, "
+          f"{len(ids) - len(to_upsert)} unchanged")
+
+    for start in range(0, len(to_upsert), batch_size):
+        rows = to_upsert[start:start + batch_size]
+        collection.upsert(
+            ids=[ids[i] for i in rows],
+            documents=get_documents(rows),
+            metadatas=[metadatas[i] for i in rows],
+            embeddings=np.asarray([vectors[i] for i in rows], dtype=np.float32).tolist(),
+        )
+        print(f"[Sync] upserted {min(start + batch_size, len(to_upsert))}/{len(to_upsert)}")
+
+    for start in range(0, len(to_delete), batch_size):
+        collection.delete(ids=to_delete[start:start + batch_size])
+    if to_delete:
+        print(f"[Sync] deleted {len(to_delete)} stale chunks")
+
+    save_manifest(manifest_file, collection.name, desired)
+    stamp_version(collection, content_version(desired))
+    return {"upserted": len(to_upsert), "deleted": len(to_delete), "unchanged": len(ids) - len(to_upsert)}
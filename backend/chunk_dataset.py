@@ -0,0 +1,133 @@
+"""
+分片列式数据集 (Parquet)
+取代逐产品的 chunks-*.jsonl 小文件：少量 part-NNNNN.parquet 分片，每个分片包含所有列，
+读取时支持列投影（例如只读 id 列，不碰 chunk 文本）。
+
+目录结构:
+    <dataset>/part-00000.parquet
+    <dataset>/part-00001.parquet
+    ...
+"""
+import os
+import glob
+import shutil
+import hashlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_ROWS_PER_SHARD = 100_000
+ROW_GROUP_SIZE = 10_000
+
+# chunk 数据集的列
+CHUNK_SCHEMA = pa.schema([
+    ("book", pa.string()),
+    ("chunk_index", pa.int32()),
+    ("chunk", pa.string()),
+])
+
+
+def chunk_ids(books: list, documents: list, seen: dict | None = None) -> list:
+    """稳定的内容派生 id（book + 文本），同一产品里重复出现的相同文本用出现序号区分。
+
+    seen 用于跨多次调用累计出现次数（分批写入同一个数据集时传同一个 dict）。
+    """
+    seen = {} if seen is None else seen
+    ids = []
+    for book, doc in zip(books, documents):
+        base = hashlib.sha256(f"{book}\0{doc}".encode("utf-8")).hexdigest()[:24]
+        n = seen.get(base, 0)
+        seen[base] = n + 1
+        ids.append(base if n == 0 else f"{base}-{n}")
+    return ids
+
+
+def shard_paths(path: str) -> list:
+    return sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+
+
+def dataset_exists(path: str) -> bool:
+    return bool(shard_paths(path))
+
+
+class ShardedWriter:
+    """按行批量写 Parquet 分片，每 rows_per_shard 行切一个新分片。
+
+    写入先落到 <path>.tmp 目录，close() 时整体替换旧数据集。
+    """
+
+    def __init__(self, path: str, schema: pa.Schema, rows_per_shard: int = DEFAULT_ROWS_PER_SHARD):
+        self.path = path
+        self.schema = schema
+        self.rows_per_shard = rows_per_shard
+        self.count = 0
+        self._tmp = path.rstrip(os.sep) + ".tmp"
+        if os.path.exists(self._tmp):
+            shutil.rmtree(self._tmp)
+        os.makedirs(self._tmp)
+        self._buffer = []
+        self._writer = None
+        self._shard = 0
+        self._shard_rows = 0
+
+    def write(self, rows: list) -> None:
+        """rows: list[dict]；schema 里没有的键被忽略，缺失的列写 null。
+
+        行先缓冲，攒满一个 row group 再写出，避免大量很小的 row group 拖慢读取。
+        """
+        self._buffer.extend(rows)
+        while len(self._buffer) >= ROW_GROUP_SIZE:
+            self._flush(ROW_GROUP_SIZE)
+
+    def _flush(self, n: int) -> None:
+        while n > 0 and self._buffer:
+            if self._writer is None:
+                shard_file = os.path.join(self._tmp, f"part-{self._shard:05d}.parquet")
+                self._writer = pq.ParquetWriter(shard_file, self.schema)
+            take = min(n, self.rows_per_shard - self._shard_rows)
+            part, self._buffer = self._buffer[:take], self._buffer[take:]
+            self._writer.write_table(pa.Table.from_pylist(part, schema=self.schema))
+            self._shard_rows += len(part)
+            self.count += len(part)
+            n -= len(part)
+            if self._shard_rows >= self.rows_per_shard:
+                self._writer.close()
+                self._writer = None
+                self._shard += 1
+                self._shard_rows = 0
+
+    def close(self) -> None:
+        self._flush(len(self._buffer))
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def read_table(path: str, columns: list | None = None) -> pa.Table:
+    """读取整个数据集；columns 指定时只解码这些列。"""
+    tables = [pq.read_table(p, columns=columns) for p in shard_paths(path)]
+    if not tables:
+        raise FileNotFoundError(f"No parquet shards found in {path}")
+    return pa.concat_tables(tables)
+
+
+def read_columns(path: str, columns: list) -> dict:
+    """返回 {列名: list}。"""
+    return read_table(path, columns=columns).to_pydict()
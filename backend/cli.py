@@ -21,9 +21,7 @@ import hashlib
 import chromadb
 import numpy as np
 import tempfile
-from urllib.parse import urlparse
-from sklearn.neighbors import NearestNeighbors
-from sentence_transformers import SentenceTransformer
+import contextlib
 
 # Simple JSONL helpers used by EWG commands
 def load_jsonl(path: str):
@@ -35,10 +33,13 @@ def load_jsonl(path: str):
             yield json.loads(line)
 
 
-def write_jsonl(path: str, items):
+def write_jsonl(path: str, items) -> int:
+    n = 0
     with open(path, 'w', encoding='utf-8') as f:
         for it in items:
             f.write(json.dumps(it, ensure_ascii=False) + '\n')
+            n += 1
+    return n
 
 # Vertex AI
 from google import genai
@@ -65,6 +66,17 @@ except Exception:
     from langchain_text_splitters import CharacterTextSplitter, RecursiveCharacterTextSplitter
 
 from semantic_splitter import SemanticChunker
+from ewg_chunker import iter_ewg_chunks
+from vector_store import (VectorStoreWriter, convert_jsonl_embeddings, convert_npz_index, open_store,
+                          store_exists)
+from vector_index import INDEX_KINDS, get_index, load_index
+from embedding_engine import EmbeddingEngine, EMBEDDING_CONCURRENCY, RateLimiter, get_client
+from local_embeddings import (LOCAL_EMBEDDING_BACKEND, LOCAL_EMBEDDING_MODEL, MULTIPROCESS_MIN_TEXTS, embed_local,
+                              multiprocess_pool)
+from embedding_cache import EmbeddingCache, cache_key
+from chroma_sync import manifest_path, sync_collection
+from buy_links import get_buy_link_index
+from chunk_dataset import CHUNK_SCHEMA, ShardedWriter, dataset_exists, read_columns
 import agent_tools
 
 # Setup
@@ -76,6 +88,8 @@ EMBEDDING_MODEL = "text-embedding-004"
 EMBEDDING_DIMENSION = int(os.environ.get('EMBEDDING_DIMENSION', 256))
 GENERATIVE_MODEL = "gemini-2.0-flash-001"
 OPENAI_EMBEDDING_MODEL = os.environ.get('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+# openai | vertex | local；留空时按原来的规则自动选择（有 OPENAI_API_KEY 或维度>768 用 OpenAI，否则 Vertex）
+EMBEDDING_PROVIDER = os.environ.get('EMBEDDING_PROVIDER', '')
 OPENAI_CHAT_MODEL = os.environ.get('OPENAI_CHAT_MODEL', 'gpt-3.5-turbo')
 
 
@@ -91,6 +105,31 @@ OUTPUT_FOLDER = os.path.join(INPUT_ROOT, "outputs")
 STRUCTURED_FOLDER = os.path.join(INPUT_ROOT, "structured")
 RAW_FOLDER = os.path.join(INPUT_ROOT, "raw")
 
+# 持久化 embedding 缓存（设置为 off 关闭）
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE", os.path.join(OUTPUT_FOLDER, "embedding_cache.sqlite"))
+
+# 向量存储的磁盘精度（float16 体积减半，检索精度损失可以忽略）
+VECTOR_DTYPE = os.environ.get("VECTOR_DTYPE", "float32")
+
+
+def vector_store_path(method="char-split", provider=None) -> str:
+    # 本地模型的向量维度/空间与远程 provider 不同，单独存放
+    suffix = "-local" if provider == "local" else ""
+    return os.path.join(OUTPUT_FOLDER, f"vectors-{method}{suffix}")
+
+
+def collection_name_for(method="char-split", provider=None) -> str:
+    suffix = "-local" if provider == "local" else ""
+    return f"{method}{suffix}-collection"
+
+
+def chunk_dataset_path(method="char-split") -> str:
+    return os.path.join(OUTPUT_FOLDER, f"chunks-{method}")
+
+
+def legacy_embeddings_pattern(method="char-split") -> str:
+    return os.path.join(OUTPUT_FOLDER, f"embeddings-{method}-*.jsonl")
+
 FULL_ORIGINAL_JSONL = os.environ.get(
     "FULL_ORIGINAL_JSONL",
     "/input-datasets/raw/ewg_face_full.jsonl"
@@ -155,8 +194,7 @@ def generate_query_embedding(query):
         key = os.environ.get('OPENAI_API_KEY')
         model = os.environ.get('OPENAI_EMBEDDING_MODEL', OPENAI_EMBEDDING_MODEL)
         if OPENAI_HAS_NEW_API and OpenAIClient is not None:
-            client = OpenAIClient(api_key=key)
-            resp = client.embeddings.create(model=model, input=query)
+            resp = _openai_client().embeddings.create(model=model, input=query)
             return resp.data[0].embedding
         else:
             openai.api_key = key
@@ -174,190 +212,149 @@ def generate_query_embedding(query):
 
 
 def find_buy_links_for_candidates(docs: list, metadatas: list | None, full_jsonl: str = "ewg_face_full.jsonl") -> dict:
-    """给定检索到的文档文本和可选的 metadata，尝试在完整的 jsonl 数据集中查找对应的产品记录并返回购买链接字典。
+    """给定检索到的文档文本和可选的 metadata，在完整的 jsonl 数据集中查找对应的产品记录并返回购买链接字典。
 
     返回结构：{idx: [url1, url2, ...]}，idx 是 docs/metadatas 列表中的位置索引。
-    匹配策略（逐步）：
+    匹配策略（结果合并）：
       1. metadata 中的 source_url 或 url 精确匹配 full jsonl 的 url 字段；
-      2. metadata 中的 title 与 full jsonl 的 title 相等或相互包含；
-      3. 在文档文本中查找以 https:// 或 http:// 开头的 ewg 链接并匹配 full jsonl 的 url。
-    这个函数是轻量的线性扫描（在文件较大时可能较慢），但避免修改现有索引流程，作为快速修复首选。
+      2. 在文档文本中查找 http(s) 链接，链接以 full jsonl 的 url 开头；
+      3. metadata 中的 title 与 full jsonl 的 title 相等或相互包含（按完整的词，不区分大小写）。
+    full jsonl 只在第一次调用（或文件更新后）读取并建索引，见 buy_links.BuyLinkIndex。
     """
-    results = {i: [] for i in range(len(docs))}
-    # 快速收集候选匹配值
-    candidates = []
-    for i, doc in enumerate(docs):
-        cand = {
-            'idx': i,
-            'meta_url': None,
-            'meta_title': None,
-            'found_urls_in_doc': []
-        }
-        if metadatas and i < len(metadatas) and metadatas[i]:
-            md = metadatas[i]
-            cand['meta_url'] = md.get('source_url') or md.get('url') or md.get('source') or md.get('sourceUrl')
-            cand['meta_title'] = md.get('title') or md.get('book')
-        # find any http(s) urls in doc
-        try:
-            import re as _re
-            urls = _re.findall(r"https?://[^\s'\)\"]+", doc)
-            cand['found_urls_in_doc'] = urls
-        except Exception:
-            cand['found_urls_in_doc'] = []
-        candidates.append(cand)
-
+    index = get_buy_link_index(full_jsonl)
     # 如果 full jsonl 不存在，直接返回空
-    if not os.path.exists(full_jsonl):
-        return results
+    if index is None:
+        return {i: [] for i in range(len(docs))}
+    return index.lookup(docs, metadatas)
 
-    def _is_purchase_link(u: str) -> bool:
-        try:
-            p = urlparse(u)
-            domain = (p.netloc or '').lower()
-            path = (p.path or '').lower()
-            # 排除 site-internal links (ewg) 和 ingredient pages
-            if 'ewg.org' in domain:
-                # 如果是 ewg 的 product 页面，通常不是购买链接，排除之
-                if '/skindeep/products/' in path:
-                    return False
-                # 排除 ingredient 页面
-                if '/skindeep/ingredients/' in path:
-                    return False
-                # 排除常见站点导航/帮助页
-                if any(x in path for x in ['/about', '/privacy', '/news', '/apps', '/skindeep/learn']):
-                    return False
-                return False
-            # 排除社交媒体 / app store / tracking 等非购买目的域名
-            black_domains = ['facebook.com', 'twitter.com', 'instagram.com', 'youtube.com', 'play.google.com', 'apps.apple.com', 'linkedin.com']
-            for bd in black_domains:
-                if bd in domain:
-                    return False
-            # 排除 mailto/tel/javascript already handled earlier
-            # 最终：接受外部域名作为可能的购买链接
-            return bool(domain)
-        except Exception:
-            return False
-
-    # 扫描 full jsonl 并匹配
-    for rec in load_jsonl(full_jsonl):
-        rec_url = rec.get('url') or rec.get('source_url') or ''
-        rec_title = (rec.get('title') or '')
-        # 优先使用 buy_button_urls/where_to_buy_urls
-        buy_urls = rec.get('buy_button_urls') or rec.get('where_to_buy_urls') or []
-        for cand in candidates:
-            i = cand['idx']
-            matched = False
-            # 1) 精确 url 匹配
-            if cand['meta_url'] and rec_url and cand['meta_url'].strip() == rec_url.strip():
-                matched = True
-            # 2) doc 内找到的 url 匹配
-            if not matched and cand['found_urls_in_doc']:
-                for u in cand['found_urls_in_doc']:
-                    if rec_url and u.strip().startswith(rec_url.strip()):
-                        matched = True
-                        break
-            # 3) title 包含匹配（case-insensitive）
-            if not matched and cand['meta_title'] and rec_title:
-                try:
-                    if cand['meta_title'].strip().lower() in rec_title.strip().lower() or rec_title.strip().lower() in cand['meta_title'].strip().lower():
-                        matched = True
-                except Exception:
-                    pass
-
-            if matched and buy_urls:
-                # 过滤并合并到结果，去重，限制数量（最多 5 个）
-                count = 0
-                for u in buy_urls:
-                    if not u:
-                        continue
-                    if not _is_purchase_link(u):
-                        continue
-                    if u not in results[i]:
-                        results[i].append(u)
-                        count += 1
-                    if count >= 5:
-                        break
-
-    return results
-
-
-def generate_text_embeddings(chunks, dimensionality: int = 256, batch_size=250, max_retries=5, retry_delay=5):
-    # 如果请求1536维（OpenAI维度）且没有设置OpenAI key，则报错
-    if dimensionality == 1536 and not os.environ.get('OPENAI_API_KEY'):
-        raise ValueError(
-            f"Embeddings with dimensionality={dimensionality} require OpenAI API. "
-            "Please set OPENAI_API_KEY environment variable or regenerate index with Vertex AI (256-768 dims)."
+
+def _openai_client():
+    return get_client("openai", lambda: OpenAIClient(api_key=os.environ.get('OPENAI_API_KEY')))
+
+
+def _openai_embed_batch(model):
+    def embed_batch(batch):
+        if OPENAI_HAS_NEW_API and OpenAIClient is not None:
+            resp = _openai_client().embeddings.create(model=model, input=batch)
+            return [item.embedding for item in resp.data]
+        openai.api_key = os.environ.get('OPENAI_API_KEY')
+        resp = openai.Embedding.create(model=model, input=batch)
+        return [d['embedding'] for d in resp['data']]
+    return embed_batch
+
+
+def _vertex_embed_batch(dimensionality):
+    def embed_batch(batch):
+        response = llm_client.models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=batch,
+            config=types.EmbedContentConfig(
+                output_dimensionality=dimensionality),
         )
+        return [embedding.values for embedding in response.embeddings]
+    return embed_batch
 
+
+_embedding_cache = None
+
+
+def get_embedding_cache() -> EmbeddingCache | None:
+    global _embedding_cache
+    if EMBEDDING_CACHE_PATH.lower() in ("", "off", "0", "false"):
+        return None
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+    return _embedding_cache
+
+
+def resolve_embedding_provider(provider=None, dimensionality: int = 256) -> str:
+    provider = provider or EMBEDDING_PROVIDER
+    if provider:
+        return provider
     # 如果dimensionality>768，强制使用OpenAI（Vertex AI最大支持768维）
     # 或者如果OPENAI_API_KEY已设置，也使用OpenAI
-    use_openai = dimensionality > 768 or os.environ.get('OPENAI_API_KEY')
-
-    # If OPENAI_API_KEY is set or high dimensionality required, use OpenAI embeddings
-    if use_openai:
-        key = os.environ.get('OPENAI_API_KEY')
-        model = os.environ.get('OPENAI_EMBEDDING_MODEL', OPENAI_EMBEDDING_MODEL)
-        all_embeddings = []
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i+batch_size]
-            retry_count = 0
-            while retry_count <= max_retries:
-                try:
-                    if OPENAI_HAS_NEW_API and OpenAIClient is not None:
-                        client = OpenAIClient(api_key=key)
-                        resp = client.embeddings.create(model=model, input=batch)
-                        batch_emb = [item.embedding for item in resp.data]
-                    else:
-                        openai.api_key = key
-                        resp = openai.Embedding.create(model=model, input=batch)
-                        batch_emb = [d['embedding'] for d in resp['data']]
-                    all_embeddings.extend(batch_emb)
-                    break
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count > max_retries:
-                        print(f"Failed to generate OpenAI embeddings after {max_retries} attempts. Last error: {e}")
-                        raise
-                    wait_time = retry_delay * (2 ** (retry_count - 1))
-                    print(f"OpenAI embedding error: {e}. Retrying in {wait_time}s (attempt {retry_count})")
-                    time.sleep(wait_time)
-        return all_embeddings
+    if dimensionality > 768 or os.environ.get('OPENAI_API_KEY'):
+        return "openai"
+    return "vertex"
 
-    # Default: use Vertex embeddings
-    # Max batch size is 250 for Vertex AI
-    all_embeddings = []
 
-    for i in range(0, len(chunks), batch_size):
-        batch = chunks[i:i+batch_size]
+def embedding_identity(provider=None, dimensionality: int = 256, model=None) -> dict:
+    """生成向量所用的 provider/model，写进向量存储 header 和 Chroma 集合 metadata。"""
+    provider = resolve_embedding_provider(provider, dimensionality)
+    if provider == "local":
+        return {"embedding_provider": "local", "embedding_model": model or LOCAL_EMBEDDING_MODEL,
+                "embedding_backend": LOCAL_EMBEDDING_BACKEND}
+    if provider == "openai":
+        return {"embedding_provider": "openai",
+                "embedding_model": os.environ.get('OPENAI_EMBEDDING_MODEL', OPENAI_EMBEDDING_MODEL)}
+    return {"embedding_provider": "vertex", "embedding_model": EMBEDDING_MODEL}
 
-        # Retry logic with exponential backoff
-        retry_count = 0
-        while retry_count <= max_retries:
-            try:
-                response = llm_client.models.embed_content(
-                    model=EMBEDDING_MODEL,
-                    contents=batch,
-                    config=types.EmbedContentConfig(
-                        output_dimensionality=dimensionality),
-                )
-                all_embeddings.extend(
-                    [embedding.values for embedding in response.embeddings])
-                break
 
-            except errors.APIError as e:
-                retry_count += 1
-                if retry_count > max_retries:
-                    print(
-                        f"Failed to generate embeddings after {max_retries} attempts. Last error: {str(e)}")
-                    raise
+def embedding_config_for_collection(collection) -> dict:
+    """根据集合 metadata 决定查询时用哪个 embedding 后端，返回 generate_text_embeddings 的关键字参数。
 
-                # Calculate delay with exponential backoff
-                wait_time = retry_delay * (2 ** (retry_count - 1))
-                print(
-                    f"API error (code: {e.code}): {e.message}. Retrying in {wait_time} seconds (attempt {retry_count}/{max_retries})...")
-                time.sleep(wait_time)
+    没有记录 provider 的旧集合沿用 OpenAI 1536 维。
+    """
+    md = collection.metadata or {}
+    if md.get("embedding_provider") == "local":
+        return {"provider": "local", "model": md.get("embedding_model"), "dimensionality": 0}
+    return {"provider": md.get("embedding_provider", "openai"), "dimensionality": int(md.get("embedding_dim", 1536))}
+
+
+def generate_text_embeddings(chunks, dimensionality: int = 256, batch_size=250, max_retries=5, retry_delay=5,
+                             concurrency: int = EMBEDDING_CONCURRENCY, use_cache: bool = True,
+                             provider: str | None = None, model: str | None = None):
+    provider = resolve_embedding_provider(provider, dimensionality)
+    chunks = list(chunks)
+
+    if provider == "local":
+        # 本地 sentence-transformers：维度由模型决定，自己在内部分批，一次把所有文本交给它
+        model_name = model or LOCAL_EMBEDDING_MODEL
+        cache_model = f"local/{model_name}/{LOCAL_EMBEDDING_BACKEND}"
+        dimensionality = 0
+        batch_size = max(len(chunks), 1)
+        engine = EmbeddingEngine(
+            "local", lambda batch: embed_local(batch, model_name), concurrency=1,
+            max_retries=0, limiter=RateLimiter())
+
+    elif provider == "openai":
+        # 如果请求1536维（OpenAI维度）且没有设置OpenAI key，则报错
+        if not os.environ.get('OPENAI_API_KEY'):
+            raise ValueError(
+                f"Embeddings with dimensionality={dimensionality} require OpenAI API. "
+                "Please set OPENAI_API_KEY environment variable or regenerate index with Vertex AI (256-768 dims)."
+            )
+        model = os.environ.get('OPENAI_EMBEDDING_MODEL', OPENAI_EMBEDDING_MODEL)
+        cache_model = f"openai/{model}"
+        engine = EmbeddingEngine(
+            "openai", _openai_embed_batch(model), concurrency=concurrency,
+            max_retries=max_retries, retry_delay=retry_delay)
 
-    return all_embeddings
+    else:
+        # Default: use Vertex embeddings
+        # Max batch size is 250 for Vertex AI
+        cache_model = f"vertex/{EMBEDDING_MODEL}"
+        batch_size = min(batch_size, 250)
+        engine = EmbeddingEngine(
+            "vertex", _vertex_embed_batch(dimensionality), concurrency=concurrency,
+            max_retries=max_retries, retry_delay=retry_delay, retry_on=(errors.APIError,))
+
+    cache = get_embedding_cache() if use_cache else None
+    if cache is None:
+        return engine.embed(chunks, batch_size=batch_size)
+
+    # 先查缓存，只把未命中的文本发给 API
+    keys = [cache_key(text, cache_model, dimensionality) for text in chunks]
+    found = cache.get_many(keys)
+    miss_idx = [i for i, k in enumerate(keys) if k not in found]
+    if miss_idx:
+        miss_embeddings = engine.embed([chunks[i] for i in miss_idx], batch_size=batch_size)
+        cache.put_many([(keys[i], emb) for i, emb in zip(miss_idx, miss_embeddings)])
+        for i, emb in zip(miss_idx, miss_embeddings):
+            found[keys[i]] = emb
+    if len(chunks) > 1:
+        print(f"[EmbeddingCache] {len(chunks) - len(miss_idx)} hits, {len(miss_idx)} misses")
+    return [found[k] for k in keys]
 
 
 def load_text_embeddings(df, collection, batch_size=500):
@@ -407,104 +404,157 @@ def chunk(method="char-split"):
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
     # Get the list of text file
-    txt_files = glob.glob(os.path.join(BOOKS_FOLDER, "*.txt"))
+    text_files = sorted(glob.glob(os.path.join(BOOKS_FOLDER, "*.txt")))
     print("Number of files to process:", len(text_files))
 
-    # Process
-    for text_file in text_files:
-        print("Processing file:", text_file)
-        filename = os.path.basename(text_file)
-        book_name = filename.split(".")[0]
-
-        with open(text_file) as f:
-            input_text = f.read()
-
-        text_chunks = None
-        if method == "char-split":
-            chunk_size = 350
-            chunk_overlap = 20
-            # Init the splitter
-            text_splitter = CharacterTextSplitter(
-                chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator='', strip_whitespace=False)
-
-            # Perform the splitting
-            text_chunks = text_splitter.create_documents([input_text])
-            text_chunks = [doc.page_content for doc in text_chunks]
-            print("Number of chunks:", len(text_chunks))
-
-        elif method == "recursive-split":
-            chunk_size = 350
-            # Init the splitter
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=chunk_size)
-
-            # Perform the splitting
-            text_chunks = text_splitter.create_documents([input_text])
-            text_chunks = [doc.page_content for doc in text_chunks]
-            print("Number of chunks:", len(text_chunks))
-
-        elif method == "semantic-split":
-            # Init the splitter
-            text_splitter = SemanticChunker(
-                embedding_function=generate_text_embeddings)
-            # Perform the splitting
-            text_chunks = text_splitter.create_documents([input_text])
-
-            text_chunks = [doc.page_content for doc in text_chunks]
-            print("Number of chunks:", len(text_chunks))
-
-        if text_chunks is not None:
-            # Save the chunks
-            data_df = pd.DataFrame(text_chunks, columns=["chunk"])
-            data_df["book"] = book_name
-            print("Shape:", data_df.shape)
-            print(data_df.head())
-
-            out_path = os.path.join(OUTPUT_FOLDER, f"chunks-{method}-{book_name}.jsonl")
-            data_df.to_json(out_path, orient="records", lines=True, force_ascii=False)
-            print(f"Saved chunks to {out_path}")
-
-
-def embed(method="char-split"):
-    print("embed()")
-
-    # Get the list of chunk files
-    jsonl_files = glob.glob(os.path.join(
-        OUTPUT_FOLDER, f"chunks-{method}-*.jsonl"))
-    print("Number of files to process:", len(jsonl_files))
+    # 所有 book 的 chunk 写进少量 Parquet 分片，而不是每个 book 一个 jsonl
+    out_path = chunk_dataset_path(method)
+    # 中途出错时丢弃 .tmp 分片目录，已有的数据集保持不变
+    with ShardedWriter(out_path, CHUNK_SCHEMA) as writer:
+        # Process
+        for text_file in text_files:
+            print("Processing file:", text_file)
+            filename = os.path.basename(text_file)
+            book_name = filename.split(".")[0]
+
+            with open(text_file) as f:
+                input_text = f.read()
+
+            text_chunks = None
+            if method == "char-split":
+                chunk_size = 350
+                chunk_overlap = 20
+                # Init the splitter
+                text_splitter = CharacterTextSplitter(
+                    chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator='', strip_whitespace=False)
+
+                # Perform the splitting
+                text_chunks = text_splitter.create_documents([input_text])
+                text_chunks = [doc.page_content for doc in text_chunks]
+                print("Number of chunks:", len(text_chunks))
+
+            elif method == "recursive-split":
+                chunk_size = 350
+                # Init the splitter
+                text_splitter = RecursiveCharacterTextSplitter(
+                    chunk_size=chunk_size)
+
+                # Perform the splitting
+                text_chunks = text_splitter.create_documents([input_text])
+                text_chunks = [doc.page_content for doc in text_chunks]
+                print("Number of chunks:", len(text_chunks))
+
+            elif method == "semantic-split":
+                # Init the splitter
+                text_splitter = SemanticChunker(
+                    embedding_function=generate_text_embeddings)
+                # Perform the splitting
+                text_chunks = text_splitter.create_documents([input_text])
+
+                text_chunks = [doc.page_content for doc in text_chunks]
+                print("Number of chunks:", len(text_chunks))
+
+            if text_chunks is not None:
+                # Save the chunks
+                writer.write([
+                    {"book": book_name, "chunk_index": i, "chunk": c}
+                    for i, c in enumerate(text_chunks)
+                ])
+
+    print(f"Saved {writer.count} chunks to {out_path}")
+
+
+def iter_chunk_rows(method="char-split"):
+    """按 book 顺序产出 (book, chunk_index, chunk)。
+
+    优先读取 Parquet 分片数据集；没有时回退到旧的 chunks-{method}-*.jsonl 文件。
+    """
+    dataset = chunk_dataset_path(method)
+    if dataset_exists(dataset):
+        cols = read_columns(dataset, ["book", "chunk_index", "chunk"])
+        print("Number of chunks to process:", len(cols["chunk"]))
+        yield from zip(cols["book"], cols["chunk_index"], cols["chunk"])
+        return
 
-    # Process
+    jsonl_files = sorted(glob.glob(os.path.join(
+        OUTPUT_FOLDER, f"chunks-{method}-*.jsonl")))
+    print("Number of legacy files to process:", len(jsonl_files))
     for jsonl_file in jsonl_files:
-        print("Processing file:", jsonl_file)
-
         data_df = pd.read_json(jsonl_file, lines=True)
-        print("Shape:", data_df.shape)
-        print(data_df.head())
-
-        chunks = data_df["chunk"].values
-        chunks = chunks.tolist()
-        if method == "semantic-split":
-            embeddings = generate_text_embeddings(
-                chunks, EMBEDDING_DIMENSION, batch_size=15)
-        else:
-            embeddings = generate_text_embeddings(
-                chunks, EMBEDDING_DIMENSION, batch_size=100)
-        data_df["embedding"] = embeddings
-
-        time.sleep(5)
-
-        # Save
-        print("Shape:", data_df.shape)
-        print(data_df.head())
+        for i, (book, chunk_text) in enumerate(zip(data_df["book"].tolist(), data_df["chunk"].tolist())):
+            yield book, i, chunk_text
 
-        out_file = jsonl_file.replace("chunks-", "embeddings-")
-        data_df.to_json(out_file, orient="records", lines=True, force_ascii=False)
 
-
-def load(method="char-split"):
+def embed(method="char-split", dtype=VECTOR_DTYPE, provider=None):
+    print("embed()")
+    provider = resolve_embedding_provider(provider, EMBEDDING_DIMENSION)
+
+    batch_size = 15 if method == "semantic-split" else 100
+    # 攒够一个窗口再并发发送，才能让多个 batch 同时在途
+    window = batch_size * EMBEDDING_CONCURRENCY * 4
+    if provider == "local":
+        # 本地模型：窗口要足够大，进程池的每个 worker 才能分到完整的 batch
+        window = max(window, MULTIPROCESS_MIN_TEXTS)
+
+    store_path = vector_store_path(method, provider)
+    pending_records = []
+    pending_chunks = []
+    total = 0
+    start_time = time.time()
+
+    def flush(writer):
+        nonlocal total
+        if not pending_chunks:
+            return
+        embeddings = generate_text_embeddings(pending_chunks, EMBEDDING_DIMENSION, batch_size=batch_size,
+                                              provider=provider)
+        writer.add(pending_records, embeddings)
+        total += len(pending_chunks)
+        elapsed = time.time() - start_time
+        print(f"Embedded {total} chunks ({total / max(elapsed, 1e-6):.1f} chunks/s)")
+        pending_records.clear()
+        pending_chunks.clear()
+
+    # 所有向量写进同一个连续矩阵文件，不再逐产品写 embeddings-*.jsonl
+    # 本地模型在整个建库期间共用一个多进程池（其他 provider 不需要）
+    pool = multiprocess_pool() if provider == "local" else contextlib.nullcontext()
+    with pool, VectorStoreWriter(store_path, dtype=dtype,
+                                 meta=embedding_identity(provider, EMBEDDING_DIMENSION)) as writer:
+        for book, i, chunk_text in iter_chunk_rows(method):
+            pending_records.append({"book": book, "chunk_index": i, "chunk": chunk_text})
+            pending_chunks.append(chunk_text)
+            if len(pending_chunks) >= window:
+                flush(writer)
+        flush(writer)
+
+    elapsed = time.time() - start_time
+    print(f"Saved {writer.count} embeddings to {store_path} in {elapsed:.1f}s "
+          f"({writer.count / max(elapsed, 1e-6):.1f} chunks/s)")
+    if get_embedding_cache() is not None:
+        print("[EmbeddingCache]", get_embedding_cache().stats())
+
+
+def convert_embeddings(method="char-split", dtype=VECTOR_DTYPE):
+    """一次性把旧的 embeddings-{method}-*.jsonl 迁移到向量存储。"""
+    print("convert_embeddings()")
+    convert_jsonl_embeddings(legacy_embeddings_pattern(method), vector_store_path(method), dtype=dtype)
+
+
+def build_index(method="char-split", kind="hnsw", provider=None):
+    """为向量存储构建并保存进程内检索索引（API 以 VECTOR_BACKEND=<kind> 启动时直接加载）"""
+    provider = resolve_embedding_provider(provider, EMBEDDING_DIMENSION)
+    store_path = vector_store_path(method, provider)
+    start_time = time.time()
+    index = load_index(store_path, kind, rebuild=True)
+    print(f"[VectorIndex] {kind} index over {index.count} vectors saved in {store_path} "
+          f"({time.time() - start_time:.1f}s)")
+
+
+def load(method="char-split", incremental=False, provider=None):
     print("load()")
 
-    collection_name = f"{method}-collection"
+    provider = resolve_embedding_provider(provider, EMBEDDING_DIMENSION)
+    collection_name = collection_name_for(method, provider)
     print("Creating/using collection:", collection_name)
     # Clear Cache
     chromadb.api.client.SharedSystemClient.clear_system_cache()
@@ -512,50 +562,48 @@ def load(method="char-split"):
     # Connect to chroma DB
     client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
 
-    # Get a collection object from an existing collection, by name. If it doesn't exist, create it.
-    collection_name = f"{method}-collection"
-    print("Creating collection:", collection_name)
-
-    try:
-        # Clear out any existing items in the collection
-        client.delete_collection(name=collection_name)
-        print(f"Deleted existing collection '{collection_name}'")
-    except Exception:
-        print(f"Collection '{collection_name}' did not exist. Creating new.")
-
-    collection = client.create_collection(
-        name=collection_name, metadata={"hnsw:space": "cosine"})
-    print(f"Created new empty collection '{collection_name}'")
-    print("Collection:", collection)
-
-    # Get the list of embedding files
-    jsonl_files = glob.glob(os.path.join(
-        OUTPUT_FOLDER, f"embeddings-{method}-*.jsonl"))
-    print("Number of files to process:", len(jsonl_files))
-
-    for jf in jsonl_files:
-        print("Loading file:", jf)
-        df = pd.read_json(jf, lines=True)
+    # 从向量存储读取（不存在时自动迁移旧的 JSONL 文件）
+    legacy = legacy_embeddings_pattern(method) if provider != "local" else None
+    store = open_store(vector_store_path(method, provider), legacy, dtype=VECTOR_DTYPE)
+    if store is None:
+        print(f"No vector store found at {vector_store_path(method, provider)}. Run --embed first.")
+        return
+    print(f"Loading {store.count} vectors from {store.path}")
 
-        # 假设 df 里有这些列: 'chunk', 'embedding', 'doc_id'/'source'/'title'/whatever metadata
-        # 如果你的列名不同就按你的列名来
-        documents = df["chunk"].astype(str).tolist()
-        embeddings = df["embedding"].tolist()
+    # 集合 metadata 记录 embedding 后端，查询时据此选择同一个后端（见 embedding_config_for_collection）
+    collection_metadata = {"hnsw:space": "cosine", "embedding_dim": store.dim}
+    collection_metadata.update(store.meta or embedding_identity(provider, EMBEDDING_DIMENSION))
 
-        # 作为唯一ID，可以组合 文件名 + 行号
-        ids = [f"{os.path.basename(jf)}::{i}" for i in range(len(df))]
+    manifest_file = manifest_path(OUTPUT_FOLDER, collection_name)
+    if incremental:
+        # 增量模式：保留现有集合，只写入差异
+        collection = client.get_or_create_collection(
+            name=collection_name, metadata=collection_metadata)
+    else:
+        try:
+            # Clear out any existing items in the collection
+            client.delete_collection(name=collection_name)
+            print(f"Deleted existing collection '{collection_name}'")
+        except Exception:
+            print(f"Collection '{collection_name}' did not exist. Creating new.")
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
 
-        # metadata: 你可以根据 df 里有没有 'product_name' 'brand' 等列来传
-        metadatas = df.drop(columns=["chunk", "embedding"], errors="ignore").to_dict(orient="records")
+        collection = client.create_collection(
+            name=collection_name, metadata=collection_metadata)
+        print(f"Created new empty collection '{collection_name}'")
+    print("Collection:", collection)
 
-        # 批量 upsert
-        collection.add(
-            ids=ids,
-            documents=documents,
-            embeddings=embeddings,
-            metadatas=metadatas
-        )
-        print(f"Inserted {len(df)} rows from {jf}")
+    # 只按列读取 id/book；chunk 文本只在有行需要写入时才读取
+    stats = sync_collection(
+        collection,
+        ids=store.ids,
+        metadatas=[{"book": b} for b in store.column("book")],
+        vectors=store.vectors,
+        get_documents=lambda rows: [str(store.column("chunk")[i] or "") for i in rows],
+        manifest_file=manifest_file,
+    )
+    print(f"Finished loading collection '{collection_name}':", stats)
 
 
 def query(method="char-split", user_query: str | None = None):
@@ -738,46 +786,18 @@ def ewg_chunk(
     out_chunks: str = os.path.join(OUTPUT_FOLDER, "ewg_chunks.jsonl"),
     chunk_size: int = 800,
     chunk_stride: int = 200,
+    workers: int = 0,
 ):
     print('[EWG] chunking', in_jsonl, '->', out_chunks)
-    items = []
-    for rec in load_jsonl(in_jsonl):
-        # build canonical text similar to parse_label_info.make_chunks_from_record
-        parts = []
-        if rec.get('title'):
-            parts.append(f"Title: {rec.get('title')}")
-        if rec.get('brand'):
-            parts.append(f"Brand: {rec.get('brand')}")
-        if rec.get('category'):
-            parts.append(f"Category: {rec.get('category')}")
-        ls = rec.get('label_sections', {})
-        for k in ['ingredients','directions','warnings']:
-            v = ls.get(k, {}).get('text') if ls.get(k) else None
-            if v:
-                parts.append(f"{k.capitalize()}: {v}")
-        if rec.get('ingredient_concern'):
-            parts.append(f"Ingredient concerns: {rec.get('ingredient_concern')}")
-        text = '\n'.join(parts).strip()
-        if not text:
-            continue
-        L = len(text)
-        start = 0
-        while start < L:
-            end = min(start + chunk_size, L)
-            chunk_text = text[start:end].strip()
-            if chunk_text:
-                items.append({'text': chunk_text, 'source_url': rec.get('url'), 'title': rec.get('title')})
-            if end == L:
-                break
-            start += chunk_size - chunk_stride
-    write_jsonl(out_chunks, items)
-    print('[EWG] wrote', len(items), 'chunks')
+    # 生成器流水线：边读边切边写，不在内存里攒 items；workers>1 时按记录分片到进程池
+    n = write_jsonl(out_chunks, iter_ewg_chunks(in_jsonl, chunk_size, chunk_stride, workers=workers))
+    print('[EWG] wrote', n, 'chunks')
 
 
 def ewg_embed(
     chunks_jsonl: str = os.path.join(OUTPUT_FOLDER, "ewg_chunks.jsonl"),
-    out_index: str = os.path.join(OUTPUT_FOLDER, "ewg_index.npz"),
-    out_meta: str = os.path.join(OUTPUT_FOLDER, "ewg_meta.jsonl"),
+    out_index: str = os.path.join(OUTPUT_FOLDER, "ewg_index"),
+    dtype: str = VECTOR_DTYPE,
 ):
     # 如果你用 Vertex 的 embedding，就要 GCP creds；如果你用 OpenAI embedding，只要 OPENAI_API_KEY。
     try:
@@ -785,28 +805,20 @@ def ewg_embed(
     except Exception as e:
         print("[EWG] warning: could not ensure gcp creds:", e)
 
-    # 首先检查是否已有embeddings文件（优先使用char-split）
-    embedding_pattern = os.path.join(OUTPUT_FOLDER, "embeddings-char-split-*.jsonl")
-    existing_embedding_files = sorted(glob.glob(embedding_pattern))
-
-    if existing_embedding_files:
-        print(f"[EWG] Found {len(existing_embedding_files)} existing embedding files, loading them...")
-        chunks = []
-        all_embeddings = []
-
-        for emb_file in existing_embedding_files:
-            data = list(load_jsonl(emb_file))
-            for item in data:
-                # embedding文件格式: chunk, book, embedding
-                chunks.append({
-                    "text": item.get("chunk", ""),
-                    "book": item.get("book", ""),
-                    "metadata": {"book": item.get("book", "")}
-                })
-                all_embeddings.append(item.get("embedding", []))
-
-        print(f"[EWG] Loaded {len(chunks)} chunks with pre-computed embeddings")
-        arr = np.array(all_embeddings, dtype=np.float32)
+    # OpenAI vs Vertex 的区分逻辑你已经有了，继续保留：
+    if os.environ.get("OPENAI_API_KEY"):
+        out_index_effective = out_index + "_openai"
+    else:
+        out_index_effective = out_index
+
+    # 首先检查是否已有向量存储（优先使用char-split；旧的 embeddings-*.jsonl 会自动迁移）
+    source = open_store(vector_store_path("char-split"), legacy_embeddings_pattern("char-split"), dtype=dtype)
+
+    if source is not None:
+        print(f"[EWG] Found existing vector store {source.path} ({source.count} chunks), copying...")
+        with VectorStoreWriter(out_index_effective, dtype=dtype) as writer:
+            for records, vectors in source.iter_batches():
+                writer.add(records, vectors)
 
     else:
         # 如果没有embeddings，则读取chunks并生成
@@ -815,6 +827,10 @@ def ewg_embed(
         if os.path.exists(chunks_jsonl):
             chunks = list(load_jsonl(chunks_jsonl))
             print(f"[EWG] loaded chunks from {chunks_jsonl}")
+        elif dataset_exists(chunk_dataset_path("char-split")):
+            cols = read_columns(chunk_dataset_path("char-split"), ["book", "chunk"])
+            chunks = [{"book": b, "chunk": c} for b, c in zip(cols["book"], cols["chunk"])]
+            print(f"[EWG] loaded {len(chunks)} chunks from {chunk_dataset_path('char-split')}")
         else:
             # 读取所有 chunks-char-split-*.jsonl 文件
             chunk_pattern = os.path.join(OUTPUT_FOLDER, "chunks-char-split-*.jsonl")
@@ -825,49 +841,57 @@ def ewg_embed(
                 chunks.extend(list(load_jsonl(cf)))
             print(f"[EWG] loaded {len(chunks)} chunks from multiple files")
 
-        texts = [c["text"] for c in chunks]
+        texts = [c.get("text", c.get("chunk", "")) for c in chunks]
         print("[EWG] embedding", len(texts), "chunks")
 
+        start_time = time.time()
         embeddings = generate_text_embeddings(texts, EMBEDDING_DIMENSION)
-        arr = np.array(embeddings, dtype=np.float32)
-
-    # OpenAI vs Vertex 的区分逻辑你已经有了，继续保留：
-    if os.environ.get("OPENAI_API_KEY") and out_index.endswith(".npz"):
-        out_index_effective = out_index.replace(".npz", "_openai.npz")
-    else:
-        out_index_effective = out_index
-
-    np.savez(out_index_effective, embeddings=arr)
-    write_jsonl(out_meta, chunks)
-
-    print("[EWG] saved index", out_index_effective, "and meta", out_meta)
+        elapsed = time.time() - start_time
+        print(f"[EWG] embedded {len(texts)} chunks in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-6):.1f} chunks/s)")
+        if get_embedding_cache() is not None:
+            print("[EWG] embedding cache:", get_embedding_cache().stats())
+        records = []
+        for i, (c, text) in enumerate(zip(chunks, texts)):
+            book = c.get("book") or c.get("title") or ""
+            rec = {"book": book, "chunk_index": i, "chunk": text}
+            if c.get("source_url"):
+                rec["source_url"] = c["source_url"]
+            records.append(rec)
+        with VectorStoreWriter(out_index_effective, dtype=dtype) as writer:
+            writer.add(records, embeddings)
+
+    print("[EWG] saved index", out_index_effective)
+
+
+
+def ewg_retrieve(questions: list, index_path: str = os.path.join(OUTPUT_FOLDER, "ewg_index"), top_k: int = 5) -> list:
+    """一次 embedding 调用 + 一次矩阵乘法检索一批问题，返回每个问题的 top_k chunk 文本。"""
+    # 旧版 ewg_embed 的输出（<index>.npz + ewg_meta.jsonl）第一次使用时迁移为向量存储
+    legacy_npz = index_path + ".npz"
+    legacy_meta = os.path.join(os.path.dirname(index_path), "ewg_meta.jsonl")
+    if not store_exists(index_path) and os.path.exists(legacy_npz) and os.path.exists(legacy_meta):
+        print(f"[EWG] migrating legacy index {legacy_npz} -> {index_path}")
+        convert_npz_index(legacy_npz, legacy_meta, index_path)
+    # 索引在进程内常驻，只有第一次调用（或向量存储被重写后）才会加载
+    index = get_index(index_path)
+    print(f"[EWG] Index dimension: {index.dim}")
 
+    # 根据索引维度选择合适的embedding生成方式
+    # 1536维通常是OpenAI的text-embedding-3-large或text-embedding-ada-002
+    # 256维是Vertex AI的text-embedding-004（带dimensionality参数）
+    # 临时查询不写入持久的 embedding 缓存，缓存只保存语料 chunk 的向量
+    q_embs = generate_text_embeddings(questions, dimensionality=index.dim, use_cache=False)
+    _, ids = index.search(q_embs, top_k=top_k)
+    chunks = index.store.column("chunk")
+    return [[chunks[i] for i in row] for row in ids]
 
 
 def ewg_query(
     question: str,
-    index_npz: str = os.path.join(OUTPUT_FOLDER, "ewg_index.npz"),
-    metadata_jsonl: str = os.path.join(OUTPUT_FOLDER, "ewg_meta.jsonl"),
+    index_path: str = os.path.join(OUTPUT_FOLDER, "ewg_index"),
     top_k: int = 5,
 ):
-    data = np.load(index_npz, allow_pickle=True)
-    embeddings = data["embeddings"]
-    meta = list(load_jsonl(metadata_jsonl))
-
-    nn = NearestNeighbors(n_neighbors=top_k, metric="cosine")
-    nn.fit(embeddings)
-
-    # 自动检测索引的embedding维度
-    index_dimension = embeddings.shape[1]
-    print(f"[EWG] Index dimension: {index_dimension}")
-
-    # 根据索引维度选择合适的embedding生成方式
-    # 1536维通常是OpenAI的text-embedding-3-large或text-embedding-ada-002
-    # 256维是Vertex AI的text-embedding-004（带dimensionality参数）
-    q_emb = generate_text_embeddings([question], dimensionality=index_dimension)[0]
-    ids = nn.kneighbors([q_emb], n_neighbors=top_k, return_distance=False)[0]
-
-    contexts = [meta[i]["text"] for i in ids]
+    contexts = ewg_retrieve([question], index_path=index_path, top_k=top_k)[0]
     print("\n--- Top contexts ---")
     for i, c in enumerate(contexts):
         print(f"[{i}]", c[:400].replace("\n", " "), "...")
@@ -1042,10 +1066,19 @@ def main(args=None):
         chunk(method=args.chunk_type)
 
     if args.embed:
-        embed(method=args.chunk_type)
+        embed(method=args.chunk_type, dtype=getattr(args, 'vector_dtype', VECTOR_DTYPE),
+              provider=getattr(args, 'embedding_provider', None))
+
+    if getattr(args, 'convert_embeddings', False):
+        convert_embeddings(method=args.chunk_type, dtype=getattr(args, 'vector_dtype', VECTOR_DTYPE))
 
     if args.load:
-        load(method=args.chunk_type)
+        load(method=args.chunk_type, incremental=getattr(args, 'incremental', False),
+             provider=getattr(args, 'embedding_provider', None))
+
+    if getattr(args, 'build_index', None):
+        build_index(method=args.chunk_type, kind=args.build_index,
+                    provider=getattr(args, 'embedding_provider', None))
 
     if args.query:
         query(method=args.chunk_type, user_query=args.query_text)
@@ -1065,7 +1098,9 @@ def main(args=None):
     if hasattr(args, 'ewg_embed') and args.ewg_embed:
         ewg_embed()
     if hasattr(args, 'ewg_query') and args.ewg_query:
-        ewg_query(question=args.ewg_query)
+        questions = args.ewg_query if isinstance(args.ewg_query, list) else [args.ewg_query]
+        for question in questions:
+            ewg_query(question=question)
 
 if __name__ == "__main__":
     # Generate the inputs arguments parser
@@ -1083,6 +1118,12 @@ if __name__ == "__main__":
         metavar=("IN","OUT"),
         help="Chunk an EWG JSONL: provide input jsonl and output chunks jsonl",
     )
+    parser.add_argument(
+        "--ewg-query",
+        nargs="+",
+        metavar="QUESTION",
+        help="Answer one or more questions from the EWG index (index is loaded once for all questions)",
+    )
     parser.add_argument(
         "--ewg-chunk-size",
         type=int,
@@ -1095,16 +1136,38 @@ if __name__ == "__main__":
         default=200,
         help="Chunk stride for --ewg-chunk (default 200)",
     )
+    parser.add_argument(
+        "--ewg-workers",
+        type=int,
+        default=0,
+        help="Worker processes for --ewg-chunk (default 0 = single process)",
+    )
     parser.add_argument(
         "--embed",
         action="store_true",
         help="Generate embeddings",
     )
+    parser.add_argument(
+        "--convert-embeddings",
+        action="store_true",
+        help="Migrate legacy embeddings-<chunk_type>-*.jsonl files into the binary vector store",
+    )
+    parser.add_argument(
+        "--vector-dtype",
+        default=VECTOR_DTYPE,
+        choices=["float32", "float16"],
+        help="On-disk precision for the vector store (default float32)",
+    )
     parser.add_argument(
         "--load",
         action="store_true",
         help="Load embeddings to vector db",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="With --load: upsert only new/changed chunks and delete removed ones instead of rebuilding the collection",
+    )
     parser.add_argument(
         "--query",
         action="store_true",
@@ -1125,6 +1188,18 @@ if __name__ == "__main__":
         action="store_true",
         help="Chat with LLM Agent",
     )
+    parser.add_argument(
+        "--build-index",
+        choices=INDEX_KINDS,
+        default=None,
+        help="Build and save an in-process search index (exact | hnsw | ivfpq) for the vector store",
+    )
+    parser.add_argument(
+        "--embedding-provider",
+        default=EMBEDDING_PROVIDER or None,
+        choices=["openai", "vertex", "local"],
+        help="Embedding backend for --embed/--load; 'local' builds a separate <chunk_type>-local-collection",
+    )
     parser.add_argument("--chunk_type", default="char-split",
                         help="char-split | recursive-split | semantic-split")
     parser.add_argument(
@@ -1146,6 +1221,7 @@ if __name__ == "__main__":
     if args.ewg_chunk:
         in_path, out_path = args.ewg_chunk
         print('[CLI] Running ewg_chunk', in_path, '->', out_path)
-        ewg_chunk(in_path, out_path, chunk_size=args.ewg_chunk_size, chunk_stride=args.ewg_chunk_stride)
+        ewg_chunk(in_path, out_path, chunk_size=args.ewg_chunk_size, chunk_stride=args.ewg_chunk_stride,
+                  workers=args.ewg_workers)
 
     main(args)
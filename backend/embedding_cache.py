@@ -0,0 +1,78 @@
+"""
+持久化、内容寻址的 embedding 缓存
+key = sha256(model, dimensionality, text)，向量以 float32 BLOB 存在 SQLite 里。
+embed()/ewg_embed()/SemanticChunker 都经过 generate_text_embeddings，
+所以文本没变的 chunk 重跑时不会再调用 provider。
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+# SQLite 单条语句的参数个数有限制，按批查询
+_LOOKUP_BATCH = 500
+
+
+def cache_key(text: str, model: str, dimensionality: int) -> str:
+    h = hashlib.sha256()
+    h.update(f"{model}\0{dimensionality}\0".encode("utf-8"))
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get_many(self, keys: list) -> dict:
+        """返回 {key: list[float]}，只包含命中的 key。"""
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique), _LOOKUP_BATCH):
+                part = unique[i:i + _LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+            hits = sum(1 for k in keys if k in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, items) -> None:
+        """items: [(key, vector), ...]"""
+        rows = [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
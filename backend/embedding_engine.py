@@ -0,0 +1,130 @@
+"""
+并发 embedding 引擎
+- 每个 provider 只创建一个客户端并在所有批次间复用（底层 HTTP 连接池保持 keep-alive）
+- 线程池同时保持 N 个 batch 在途，输出顺序与输入顺序一致
+- 按 requests/tokens-per-minute 预算限流，所有并发批次共享同一个预算
+"""
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时在途的 batch 数
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", 4))
+# 每分钟请求数 / token 数预算，0 表示不限
+EMBEDDING_RPM = int(os.environ.get("EMBEDDING_RPM", 0))
+EMBEDDING_TPM = int(os.environ.get("EMBEDDING_TPM", 0))
+
+_clients = {}
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_client(provider: str, factory):
+    """返回 provider 的共享客户端，第一次调用时用 factory() 创建。"""
+    with _lock:
+        if provider not in _clients:
+            _clients[provider] = factory()
+        return _clients[provider]
+
+
+def estimate_tokens(texts) -> int:
+    # 粗略估计（英文约 4 字符/token），只用于限流，不需要精确
+    return sum(len(t) // 4 + 1 for t in texts)
+
+
+class RateLimiter:
+    """60 秒滑动窗口内的请求数和 token 数限流，线程安全。"""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._events = deque()  # (timestamp, tokens)
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0) -> None:
+        if not self.rpm and not self.tpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= 60:
+                    _, n = self._events.popleft()
+                    self._tokens -= n
+                requests_ok = not self.rpm or len(self._events) < self.rpm
+                # 单个 batch 超过整个 token 预算时，窗口清空后仍然放行，避免永久阻塞
+                tokens_ok = not self.tpm or not self._events or self._tokens + tokens <= self.tpm
+                if requests_ok and tokens_ok:
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                wait = 60 - (now - self._events[0][0])
+            time.sleep(max(wait, 0.05))
+
+
+def get_limiter(provider: str, rpm: int = EMBEDDING_RPM, tpm: int = EMBEDDING_TPM) -> RateLimiter:
+    """每个 provider 一个限流器，同一进程内的所有调用共享预算。"""
+    with _lock:
+        if provider not in _limiters:
+            _limiters[provider] = RateLimiter(rpm=rpm, tpm=tpm)
+        return _limiters[provider]
+
+
+class EmbeddingEngine:
+    """把文本切成 batch 并发发送给 embed_batch，按原顺序拼回结果。
+
+    embed_batch: callable(list[str]) -> list[list[float]]，只负责一次 API 调用
+    retry_on:    需要指数退避重试的异常类型
+    limiter:     默认使用 provider 共享的限流器
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        embed_batch,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        max_retries: int = 5,
+        retry_delay: float = 5,
+        retry_on: tuple = (Exception,),
+        limiter: RateLimiter | None = None,
+    ):
+        self.provider = provider
+        self.embed_batch = embed_batch
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_on = retry_on
+        # 本地模型等不需要限流的 provider 可以传入一个不设上限的 RateLimiter()
+        self.limiter = limiter if limiter is not None else get_limiter(provider)
+
+    def _run_batch(self, batch: list) -> list:
+        retry_count = 0
+        while True:
+            self.limiter.acquire(estimate_tokens(batch))
+            try:
+                return self.embed_batch(batch)
+            except self.retry_on as e:
+                retry_count += 1
+                if retry_count > self.max_retries:
+                    print(f"Failed to generate {self.provider} embeddings after {self.max_retries} attempts. Last error: {e}")
+                    raise
+                wait_time = self.retry_delay * (2 ** (retry_count - 1))
+                print(f"{self.provider} embedding error: {e}. Retrying in {wait_time}s (attempt {retry_count}/{self.max_retries})")
+                time.sleep(wait_time)
+
+    def embed(self, texts: list, batch_size: int = 250) -> list:
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        if not batches:
+            return []
+        if self.concurrency == 1 or len(batches) == 1:
+            results = [self._run_batch(b) for b in batches]
+        else:
+            # pool.map 按提交顺序返回结果，保证输出顺序与输入一致
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as pool:
+                results = list(pool.map(self._run_batch, batches))
+        all_embeddings = []
+        for r in results:
+            all_embeddings.extend(r)
+        return all_embeddings
@@ -0,0 +1,92 @@
+"""
+EWG 记录的流式切块
+读 JSONL -> 拼接规范文本 -> 滑动窗口切块 -> 边生成边写出，内存占用与输入大小无关。
+可选进程池模式：按记录分片到多个核心，输出顺序与单进程模式完全一致。
+
+这个模块只依赖标准库，进程池的 worker 不需要导入 cli.py（及其模型客户端）。
+"""
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+
+def build_ewg_text(rec: dict) -> str:
+    """build canonical text similar to parse_label_info.make_chunks_from_record"""
+    parts = []
+    if rec.get('title'):
+        parts.append(f"Title: {rec.get('title')}")
+    if rec.get('brand'):
+        parts.append(f"Brand: {rec.get('brand')}")
+    if rec.get('category'):
+        parts.append(f"Category: {rec.get('category')}")
+    ls = rec.get('label_sections', {})
+    for k in ['ingredients', 'directions', 'warnings']:
+        v = ls.get(k, {}).get('text') if ls.get(k) else None
+        if v:
+            parts.append(f"{k.capitalize()}: {v}")
+    if rec.get('ingredient_concern'):
+        parts.append(f"Ingredient concerns: {rec.get('ingredient_concern')}")
+    return '\n'.join(parts).strip()
+
+
+def ewg_record_chunks(rec: dict, chunk_size: int = 800, chunk_stride: int = 200) -> list:
+    text = build_ewg_text(rec)
+    items = []
+    L = len(text)
+    start = 0
+    while start < L:
+        end = min(start + chunk_size, L)
+        chunk_text = text[start:end].strip()
+        if chunk_text:
+            items.append({'text': chunk_text, 'source_url': rec.get('url'), 'title': rec.get('title')})
+        if end == L:
+            break
+        start += chunk_size - chunk_stride
+    return items
+
+
+def _chunk_lines(lines: list, chunk_size: int, chunk_stride: int) -> list:
+    # worker 端解析 JSON，主进程只负责读行和写出
+    out = []
+    for line in lines:
+        out.extend(ewg_record_chunks(json.loads(line), chunk_size, chunk_stride))
+    return out
+
+
+def _iter_lines(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def iter_ewg_chunks(in_jsonl: str, chunk_size: int = 800, chunk_stride: int = 200,
+                    workers: int = 0, shard_size: int = 256):
+    """按输入顺序逐个产出 chunk dict。
+
+    workers > 1 时把每 shard_size 条记录作为一个任务交给进程池；
+    最多同时保留 workers * 2 个未完成的分片，因此内存占用是常数，
+    并且总是按提交顺序取回结果，输出顺序是确定的。
+    """
+    if chunk_stride >= chunk_size:
+        raise ValueError("chunk_stride must be smaller than chunk_size")
+
+    lines = _iter_lines(in_jsonl)
+    if workers <= 1:
+        for line in lines:
+            yield from ewg_record_chunks(json.loads(line), chunk_size, chunk_stride)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < workers * 2:
+                shard = list(islice(lines, shard_size))
+                if not shard:
+                    break
+                pending.append(pool.submit(_chunk_lines, shard, chunk_size, chunk_stride))
+            if not pending:
+                break
+            yield from pending.popleft().result()
@@ -0,0 +1,98 @@
+"""
+本地 CPU embedding 后端（sentence-transformers）
+- 每个进程只加载一次模型（API 的每个 worker 各一份）
+- 批量 CPU 推理；可选 ONNX / int8 量化模型（需要 optimum[onnxruntime]）
+- 离线建库时用多进程池把 chunk embedding 铺满所有核心：multiprocess_pool() 在整个建库期间
+  保持同一个进程池，期间所有 embed_local 调用共用它
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from sentence_transformers import SentenceTransformer
+
+LOCAL_EMBEDDING_MODEL = os.environ.get("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# torch | onnx | onnx-int8
+LOCAL_EMBEDDING_BACKEND = os.environ.get("LOCAL_EMBEDDING_BACKEND", "torch")
+# onnx-int8 使用的量化模型文件（相对模型仓库根目录）
+LOCAL_EMBEDDING_ONNX_FILE = os.environ.get("LOCAL_EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.environ.get("LOCAL_EMBEDDING_BATCH_SIZE", 64))
+# 大批量离线 embedding 使用的进程数，0 = os.cpu_count()
+LOCAL_EMBEDDING_WORKERS = int(os.environ.get("LOCAL_EMBEDDING_WORKERS", 0))
+# 少于这个数量的文本不值得启动多进程池（查询时永远走单进程）
+MULTIPROCESS_MIN_TEXTS = 2000
+
+_models = {}
+_lock = threading.Lock()
+# multiprocess_pool() 期间共用的进程池：(model_name, backend, pool)
+_active_pool = None
+
+
+def get_model(model_name: str = LOCAL_EMBEDDING_MODEL, backend: str = LOCAL_EMBEDDING_BACKEND) -> SentenceTransformer:
+    key = (model_name, backend)
+    with _lock:
+        if key not in _models:
+            print(f"[LocalEmbedding] loading {model_name} ({backend})")
+            if backend == "torch":
+                model = SentenceTransformer(model_name, device="cpu")
+            elif backend == "onnx":
+                model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+            elif backend == "onnx-int8":
+                model = SentenceTransformer(
+                    model_name, device="cpu", backend="onnx",
+                    model_kwargs={"file_name": LOCAL_EMBEDDING_ONNX_FILE})
+            else:
+                raise ValueError(f"Unknown LOCAL_EMBEDDING_BACKEND {backend!r}, expected torch | onnx | onnx-int8")
+            _models[key] = model
+        return _models[key]
+
+
+def local_embedding_dimension(model_name: str = LOCAL_EMBEDDING_MODEL, backend: str = LOCAL_EMBEDDING_BACKEND) -> int:
+    return get_model(model_name, backend).get_sentence_embedding_dimension()
+
+
+@contextmanager
+def multiprocess_pool(model_name: str = LOCAL_EMBEDDING_MODEL, backend: str = LOCAL_EMBEDDING_BACKEND,
+                      workers: int = LOCAL_EMBEDDING_WORKERS):
+    """离线建库用：启动一次多进程池，with 块内同一模型的 embed_local 调用都使用它，退出时停止。
+    只有一个核心时什么也不做。"""
+    global _active_pool
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or _active_pool is not None:
+        yield
+        return
+    model = get_model(model_name, backend)
+    pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+    print(f"[LocalEmbedding] started {workers} worker processes")
+    _active_pool = (model_name, backend, pool)
+    try:
+        yield
+    finally:
+        _active_pool = None
+        model.stop_multi_process_pool(pool)
+
+
+def embed_local(texts: list, model_name: str = LOCAL_EMBEDDING_MODEL, backend: str = LOCAL_EMBEDDING_BACKEND,
+                batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE, workers: int = LOCAL_EMBEDDING_WORKERS) -> list:
+    """返回 L2 归一化后的向量列表（list[list[float]]）。"""
+    if not texts:
+        return []
+    model = get_model(model_name, backend)
+    active = _active_pool
+    workers = workers or os.cpu_count() or 1
+    if active is not None and active[:2] == (model_name, backend) and len(texts) > batch_size:
+        # 建库期间常驻的进程池，每次调用不再启动/停止进程
+        vectors = model.encode_multi_process(
+            texts, active[2], batch_size=batch_size, normalize_embeddings=True)
+    elif workers > 1 and len(texts) >= MULTIPROCESS_MIN_TEXTS:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+        try:
+            vectors = model.encode_multi_process(
+                texts, pool, batch_size=batch_size, normalize_embeddings=True)
+        finally:
+            model.stop_multi_process_pool(pool)
+    else:
+        vectors = model.encode(
+            texts, batch_size=batch_size, normalize_embeddings=True,
+            convert_to_numpy=True, show_progress_bar=False)
+    return vectors.tolist()
@@ -2,28 +2,86 @@
 重新加载数据到ChromaDB，包含购买链接
 """
 import os
+import re
 import sys
 import json
+import bisect
+import unicodedata
 import chromadb
-import glob
 
 # 添加backend目录到路径
 sys.path.insert(0, os.path.dirname(__file__))
-from cli import load_jsonl
+from vector_store import open_store
+from chroma_sync import manifest_path, sync_collection
 
 # ChromaDB配置
 CHROMADB_HOST = os.getenv("CHROMADB_HOST", "chromadb")
 CHROMADB_PORT = int(os.getenv("CHROMADB_PORT", "8000"))
 
 # 数据路径
-STRUCTURED_DATA = "/app/backend/input-datasets/structured/ewg_face_label_structured.jsonl"
+STRUCTURED_DATA = os.getenv("STRUCTURED_DATA", "/app/backend/input-datasets/structured/ewg_face_label_structured.jsonl")
 EMBEDDINGS_FOLDER = "/app/backend/input-datasets/outputs"
+VECTOR_STORE = os.path.join(EMBEDDINGS_FOLDER, "vectors-char-split")
+
+# EWG 成分关注等级，写入 metadata 的 concern_level（0 表示没有数据）
+CONCERN_LEVELS = {"low": 1, "moderate": 2, "high": 3}
+
+def concern_level(item):
+    """产品成分关注等级：ingredient_concern_map 中出现的最高等级"""
+    concern_map = item.get('ingredient_concern_map') or {}
+    return max((CONCERN_LEVELS.get(str(k).lower(), 0) for k in concern_map), default=0)
+
+_name_token = re.compile(r"[a-z0-9]+")
+
+def normalize_product_name(name):
+    """小写字母数字词序列：忽略标点、'/'、非 ASCII 字符（book 名来自被清理过的文件名）"""
+    return " ".join(_name_token.findall(unicodedata.normalize("NFKC", name or "").casefold()))
+
+class ProductTitleIndex:
+    """把 book 派生的产品名对应到结构化数据的 title。
+
+    book 名来自文件名，可能去掉了 '/'、非 ASCII 字符，在第一个 '.' 处或约 80 个字符处被截断：
+    先按规范化后的名称精确匹配，否则取以它为前缀的 title（只有唯一候选时才匹配，避免合并不同产品）
+    """
+
+    def __init__(self, titles):
+        self._exact = {}
+        for title in titles:
+            if title:
+                self._exact.setdefault(normalize_product_name(title), title)
+        self._keys = sorted(self._exact)
+
+    def match(self, name):
+        """返回对应的 title，没有（或有多个候选）时返回 None"""
+        key = normalize_product_name(name)
+        if not key:
+            return None
+        if key in self._exact:
+            return self._exact[key]
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i].startswith(key):
+            if i + 1 < len(self._keys) and self._keys[i + 1].startswith(key):
+                return None
+            return self._exact[self._keys[i]]
+        return None
+
+class ProductMap(dict):
+    """title -> 产品元数据；resolve 把 book 派生的产品名对应到 title"""
+
+    _titles = None
+
+    def resolve(self, name):
+        if name in self:
+            return name
+        if self._titles is None:
+            self._titles = ProductTitleIndex(self)
+        return self._titles.match(name)
 
 def load_structured_data():
     """加载原始EWG数据，构建产品名到元数据的映射"""
     print(f"Loading structured data from {STRUCTURED_DATA}...")
 
-    product_map = {}
+    product_map = ProductMap()
 
     with open(STRUCTURED_DATA, 'r') as f:
         for line in f:
@@ -44,7 +102,8 @@ def load_structured_data():
                 'category': item.get('category', ''),
                 'amazon_url': amazon_url,
                 'ewg_url': ewg_url,
-                'has_website_button': item.get('has_website_button', False)
+                'has_website_button': item.get('has_website_button', False),
+                'concern_level': concern_level(item)
             }
 
     print(f"Loaded {len(product_map)} products with metadata")
@@ -70,115 +129,145 @@ def extract_product_name_from_filename(filename):
 
     return base
 
-def reload_chromadb_with_links():
-    """重新加载ChromaDB，包含购买链接"""
-    print("Starting ChromaDB reload with purchase links...")
-
-    # 加载原始产品数据
-    product_map = load_structured_data()
-
-    # 连接ChromaDB
-    print(f"Connecting to ChromaDB at {CHROMADB_HOST}:{CHROMADB_PORT}...")
-    client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
-
-    # 删除旧集合（如果存在）
-    try:
-        client.delete_collection(name="char-split-collection")
-        print("Deleted existing collection")
-    except:
-        print("No existing collection to delete")
-
-    # 创建新集合
-    collection = client.create_collection(
-        name="char-split-collection",
-        metadata={"hnsw:space": "cosine"}
-    )
-    print("Created new collection: char-split-collection")
+def extract_product_name_from_book(book):
+    """
+    从 book 字段提取产品名
+    例如: 0000-Cliganic 100% Pure & Natural Neem Oil -> Cliganic 100% Pure & Natural Neem Oil
+    """
+    parts = (book or '').split('-', 1)
+    if len(parts) == 2 and parts[0].isdigit():
+        return parts[1]
+    return book or ''
 
-    # 加载所有embedding文件
-    embedding_pattern = os.path.join(EMBEDDINGS_FOLDER, "embeddings-char-split-*.jsonl")
-    embedding_files = sorted(glob.glob(embedding_pattern))
+def product_metadata(book, product_map):
+    """一个产品的 chunk metadata（只添加非空值），Chroma 集合和进程内索引共用"""
+    product_name = extract_product_name_from_book(book)
+    title = product_map.resolve(product_name) if isinstance(product_map, ProductMap) else None
+    product_meta = product_map.get(title or product_name, {})
 
-    print(f"Found {len(embedding_files)} embedding files")
+    # 构建完整的metadata（只添加非空值）
+    metadata = {
+        "book": book or "Unknown"
+    }
 
-    total_loaded = 0
-    products_with_links = 0
-    products_without_links = 0
+    # 添加产品名（如果有）
+    if product_name:
+        metadata["product_name"] = product_name
 
-    for idx, emb_file in enumerate(embedding_files):
-        # 从文件名提取产品名
-        product_name = extract_product_name_from_filename(emb_file)
+    # 产品 id：对应的结构化数据 title，与倒排索引的产品键相同（见 retrieval.product_key）
+    if title:
+        metadata["product_id"] = title
 
-        # 加载embedding数据
-        data = list(load_jsonl(emb_file))
+    # 添加品牌（如果有）
+    if product_meta.get('brand'):
+        metadata["brand"] = product_meta.get('brand')
 
-        # 查找对应的产品元数据
-        product_meta = product_map.get(product_name, {})
+    # 添加分类（如果有）
+    if product_meta.get('category'):
+        metadata["category"] = product_meta.get('category')
 
-        if product_meta.get('amazon_url'):
-            products_with_links += 1
-        else:
-            products_without_links += 1
+    # 添加Amazon URL（如果有）
+    if product_meta.get('amazon_url'):
+        metadata["amazon_url"] = product_meta.get('amazon_url')
 
-        # 准备批量插入数据
-        documents = []
-        metadatas = []
-        embeddings = []
-        ids = []
+    # 添加EWG URL（如果有）
+    if product_meta.get('ewg_url'):
+        metadata["ewg_url"] = product_meta.get('ewg_url')
 
-        for i, item in enumerate(data):
-            doc_id = f"{idx:04d}-{i:04d}"
+    # 过滤字段总是写入，检索时可以直接作为 where 条件
+    metadata["has_buy_link"] = bool(product_meta.get('amazon_url'))
+    metadata["concern_level"] = int(product_meta.get('concern_level', 0))
 
-            documents.append(item.get("chunk", ""))
+    return metadata
 
-            # 构建完整的metadata（只添加非空值）
-            metadata = {
-                "book": item.get("book", "Unknown")
-            }
+def reload_chromadb_with_links(incremental=False):
+    """重新加载ChromaDB，包含购买链接
 
-            # 添加产品名（如果有）
-            if product_name:
-                metadata["product_name"] = product_name
+    incremental=True 时不删除集合，只 upsert 新增/变化的 chunk 并删除已移除的 chunk
+    """
+    print("Starting ChromaDB reload with purchase links...")
 
-            # 添加品牌（如果有）
-            if product_meta.get('brand'):
-                metadata["brand"] = product_meta.get('brand')
+    # 加载原始产品数据
+    product_map = load_structured_data()
 
-            # 添加分类（如果有）
-            if product_meta.get('category'):
-                metadata["category"] = product_meta.get('category')
+    # 连接ChromaDB
+    print(f"Connecting to ChromaDB at {CHROMADB_HOST}:{CHROMADB_PORT}...")
+    client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
 
-            # 添加Amazon URL（如果有）
-            if product_meta.get('amazon_url'):
-                metadata["amazon_url"] = product_meta.get('amazon_url')
+    # 打开向量存储（不存在时自动迁移旧的 embeddings-char-split-*.jsonl）
+    store = open_store(VECTOR_STORE, os.path.join(EMBEDDINGS_FOLDER, "embeddings-char-split-*.jsonl"))
+    if store is None:
+        print(f"No vector store found at {VECTOR_STORE}")
+        return
+
+    # 记录 embedding 后端，查询时用同一个后端生成查询向量
+    collection_metadata = {"hnsw:space": "cosine", "embedding_dim": store.dim,
+                           "embedding_provider": "openai", **store.meta}
+
+    manifest_file = manifest_path(EMBEDDINGS_FOLDER, "char-split-collection")
+    if incremental:
+        collection = client.get_or_create_collection(
+            name="char-split-collection",
+            metadata=collection_metadata
+        )
+        print("Using existing collection: char-split-collection (incremental)")
+    else:
+        # 删除旧集合（如果存在）
+        try:
+            client.delete_collection(name="char-split-collection")
+            print("Deleted existing collection")
+        except:
+            print("No existing collection to delete")
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+
+        # 创建新集合
+        collection = client.create_collection(
+            name="char-split-collection",
+            metadata=collection_metadata
+        )
+        print("Created new collection: char-split-collection")
+
+    groups = store.groups()
+
+    print(f"Found {len(groups)} products ({store.count} chunks) in {VECTOR_STORE}")
 
-            # 添加EWG URL（如果有）
-            if product_meta.get('ewg_url'):
-                metadata["ewg_url"] = product_meta.get('ewg_url')
+    products_with_links = 0
+    products_without_links = 0
 
-            metadatas.append(metadata)
+    metadatas = []
 
-            embeddings.append(item.get("embedding", []))
-            ids.append(doc_id)
+    for book, offset, count in groups:
+        metadata = product_metadata(book, product_map)
 
-        # 批量插入
-        if documents:
-            collection.add(
-                documents=documents,
-                metadatas=metadatas,
-                embeddings=embeddings,
-                ids=ids
-            )
-            total_loaded += len(documents)
+        if metadata.get('amazon_url'):
+            products_with_links += 1
+        else:
+            products_without_links += 1
 
-        if (idx + 1) % 100 == 0:
-            print(f"Progress: {idx + 1}/{len(embedding_files)} files ({total_loaded} chunks)")
+        # 同一产品的所有 chunk 共享同一份 metadata
+        metadatas.extend([metadata] * count)
+
+    # 按内容派生的 id 写入；向量直接从 memmap 读取，chunk 文本只在需要写入时按列读取
+    stats = sync_collection(
+        collection,
+        ids=store.ids,
+        get_documents=lambda rows: [store.column("chunk")[i] or "" for i in rows],
+        metadatas=metadatas,
+        vectors=store.vectors,
+        manifest_file=manifest_file,
+    )
 
     print(f"\n=== Reload Complete ===")
-    print(f"Total chunks loaded: {total_loaded}")
+    print(f"Chunks upserted: {stats['upserted']}, deleted: {stats['deleted']}, unchanged: {stats['unchanged']}")
     print(f"Products with Amazon links: {products_with_links}")
     print(f"Products without links: {products_without_links}")
     print(f"Collection count: {collection.count()}")
 
 if __name__ == "__main__":
-    reload_chromadb_with_links()
+    import argparse
+    parser = argparse.ArgumentParser(description="Reload ChromaDB with purchase links")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Upsert only new/changed chunks and delete removed ones instead of rebuilding the collection")
+    args = parser.parse_args()
+    reload_chromadb_with_links(incremental=args.incremental)
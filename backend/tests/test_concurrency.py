@@ -0,0 +1,130 @@
+"""
+并发测试：/api/search 和 /api/chat 的阻塞调用（embedding provider、向量库）在线程池中执行，
+GPT 调用是异步的，所以并发请求的这些调用应该同时进行，而不是一个接一个。
+
+embedding、检索和 OpenAI 客户端都换成固定延迟的假实现，记录同时在进行的调用数的峰值；
+断言的是重叠本身（峰值 > 1），不依赖绝对耗时，负载高的 CI 机器上也稳定。不需要外部服务：
+    cd backend && python -m pytest -q tests/test_concurrency.py
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from api.main import app
+from api.routes import chat, search
+from api.services.search_cache import search_response_cache
+
+CONCURRENCY = 8
+# 阻塞的 embedding 调用（在工作线程里 sleep）和异步的 GPT 调用的模拟延迟
+EMBED_DELAY = 0.3
+GPT_DELAY = 0.3
+
+
+class InFlight:
+    """同时在进行的调用数及其峰值（线程安全）"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+
+embed_calls = InFlight()
+gpt_calls = InFlight()
+
+
+def slow_embed_query(query, collection):
+    with embed_calls:
+        time.sleep(EMBED_DELAY)
+    return [0.0, 1.0]
+
+
+class FakeRetrieval:
+    """RetrievalService 的替身：检索本身很快，不返回任何结果"""
+
+    def version(self, name=None):
+        return "test"
+
+    def collection(self, name=None):
+        return SimpleNamespace(name="test", metadata={})
+
+    def product_query(self, query_embedding, top_k, **kwargs):
+        return []
+
+    def query(self, query_embeddings, n_results, **kwargs):
+        return {"documents": [[]], "metadatas": [[]], "distances": [[]]}
+
+
+class FakeCompletions:
+    async def create(self, **kwargs):
+        with gpt_calls:
+            await asyncio.sleep(GPT_DELAY)
+        message = SimpleNamespace(content="ok")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")])
+
+
+@pytest.fixture(autouse=True)
+def fake_backends(monkeypatch):
+    global embed_calls, gpt_calls
+    embed_calls, gpt_calls = InFlight(), InFlight()
+    # ASGITransport 不运行 lifespan，直接放入假的检索服务
+    monkeypatch.setattr(app.state, "retrieval", FakeRetrieval(), raising=False)
+    monkeypatch.setattr(app.state, "lexical", None, raising=False)
+    monkeypatch.setattr(search, "embed_query", slow_embed_query)
+    monkeypatch.setattr(chat, "embed_query", slow_embed_query)
+    monkeypatch.setattr(chat, "USE_OPENAI", True)
+    monkeypatch.setattr(chat, "OPENAI_CLIENT", SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions())))
+    search_response_cache.clear()
+    yield
+    search_response_cache.clear()
+
+
+async def send_all(send, n: int) -> None:
+    """同时发出 n 个请求并等待全部完成"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(*(send(client, i) for i in range(n)))
+    assert all(r.status_code == 200 for r in responses), [r.text for r in responses]
+
+
+def assert_overlaps(calls: InFlight, what: str) -> None:
+    # 串行执行时峰值恒为 1
+    assert 1 < calls.peak <= CONCURRENCY, (
+        f"at most {calls.peak} {what} call(s) were in flight across {CONCURRENCY} concurrent requests")
+
+
+def test_concurrent_search_does_not_serialize():
+    async def send(client, i):
+        # 每个请求的查询不同，不会命中响应缓存
+        return await client.get("/api/search", params={"q": f"moisturizer {i}", "hybrid": "false"})
+
+    asyncio.run(send_all(send, CONCURRENCY))
+    assert_overlaps(embed_calls, "embedding")
+
+
+def test_concurrent_chat_does_not_serialize():
+    async def send(client, i):
+        return await client.post("/api/chat/", json={"message": f"dry skin question {i}"})
+
+    asyncio.run(send_all(send, CONCURRENCY))
+    assert_overlaps(embed_calls, "embedding")
+    assert_overlaps(gpt_calls, "GPT")
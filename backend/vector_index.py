@@ -0,0 +1,303 @@
+"""
+常驻内存的向量检索索引（Chroma 之外的进程内检索）
+- exact: 向量做 L2 归一化后以 float32 常驻内存，余弦相似度 = 一次矩阵乘法，
+         top-k 用 argpartition 选出候选，只对 k 个候选排序；支持一批查询同时检索
+- hnsw:  hnswlib 图索引，查询时可调 ef（越大召回越高、越慢）
+- ivfpq: faiss IVF-PQ 压缩索引，查询时可调 nprobe；候选用精确向量重排
+- 索引文件保存在向量存储目录下，下次启动直接加载；向量存储被重写后自动重建
+- get_index(path, kind) 在进程内按路径缓存索引，CLI 和 API 都可以常驻持有
+
+所有索引都提供 search(queries, top_k, mask=None, **params) -> (scores, ids)，scores 为余弦相似度。
+mask 是预计算的行级布尔位图（metadata 过滤）：精确索引直接屏蔽不满足条件的行，
+开销与不过滤相同；hnsw / ivfpq 带过滤时改用精确索引，保证过滤后仍返回 top_k 条。
+"""
+import os
+import math
+import threading
+
+import numpy as np
+
+from vector_store import HEADER_FILE, VectorStore
+
+# 可选依赖：只有选择对应的索引类型时才需要
+try:
+    import hnswlib
+except Exception:
+    hnswlib = None
+try:
+    import faiss
+except Exception:
+    faiss = None
+
+INDEX_KINDS = ("exact", "hnsw", "ivfpq")
+NORMALIZED_FILE = "normalized-float32.npy"
+HNSW_FILE = "index-hnsw.bin"
+IVFPQ_FILE = "index-ivfpq.faiss"
+
+# 默认的构建/查询参数
+HNSW_M = int(os.environ.get("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF = int(os.environ.get("HNSW_EF", 64))
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 8))
+# IVF-PQ 取 top_k * IVF_RERANK 个候选，再用精确向量重排
+IVF_RERANK = int(os.environ.get("IVF_RERANK", 10))
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def l2_normalize(vectors) -> np.ndarray:
+    arr = np.array(vectors, dtype=np.float32, copy=True)
+    if arr.ndim == 1:
+        arr = arr[None, :]
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    arr /= norms
+    return arr
+
+
+def top_k_rows(scores: np.ndarray, top_k: int) -> tuple:
+    """对每一行取最大的 top_k 个分数，返回 (scores, ids)，按分数降序。"""
+    n = scores.shape[1]
+    k = min(top_k, n)
+    if k <= 0:
+        empty = np.zeros((scores.shape[0], 0))
+        return empty.astype(np.float32), empty.astype(np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), (scores.shape[0], n))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class ExactIndex:
+    """精确余弦检索。
+
+    vectors: 已归一化的 (count, dim) float32 矩阵
+    store:   可选的 VectorStore，用于把行号映射回 id / manifest 记录
+    """
+    kind = "exact"
+
+    def __init__(self, vectors: np.ndarray, store: VectorStore | None = None):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.store = store
+
+    @property
+    def count(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    @classmethod
+    def from_store(cls, store: VectorStore) -> "ExactIndex":
+        return cls(l2_normalize(store.vectors) if store.count else np.zeros((0, store.dim), np.float32), store)
+
+    def _queries(self, queries) -> np.ndarray:
+        q = l2_normalize(queries)
+        if q.shape[1] != self.dim:
+            raise ValueError(f"Query dimension {q.shape[1]} does not match index dimension {self.dim}")
+        return q
+
+    def search(self, queries, top_k: int = 5, mask: np.ndarray | None = None, **params) -> tuple:
+        """queries: (dim,) 或 (n, dim)。返回 (scores, ids)，形状都是 (n, k)。"""
+        scores = self._queries(queries) @ self.vectors.T
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+            top_k = min(top_k, int(mask.sum()))
+        return top_k_rows(scores, top_k)
+
+    def rerank(self, queries: np.ndarray, candidates: np.ndarray, top_k: int) -> tuple:
+        """用精确向量给候选行号重新打分（-1 表示空位）。"""
+        valid = candidates >= 0
+        safe = np.where(valid, candidates, 0)
+        scores = np.einsum("nd,nkd->nk", queries, self.vectors[safe])
+        scores[~valid] = -np.inf
+        top_scores, pos = top_k_rows(scores, top_k)
+        return top_scores, np.take_along_axis(safe, pos, axis=1)
+
+    def save(self, path: str) -> None:
+        tmp = path + ".tmp.npy"
+        np.save(tmp, self.vectors)
+        os.replace(tmp, path)
+
+
+class HNSWIndex:
+    """hnswlib 图索引（内积空间，向量已归一化）。ef 可在每次查询时指定。"""
+    kind = "hnsw"
+
+    def __init__(self, exact: ExactIndex, index):
+        self.exact = exact
+        self.store = exact.store
+        self.index = index
+        self._ef = None
+        self._search_lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return self.exact.count
+
+    @property
+    def dim(self) -> int:
+        return self.exact.dim
+
+    @classmethod
+    def build(cls, exact: ExactIndex, m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION) -> "HNSWIndex":
+        _require(hnswlib, "hnsw", "hnswlib")
+        index = hnswlib.Index(space="ip", dim=exact.dim)
+        index.init_index(max_elements=max(exact.count, 1), ef_construction=ef_construction, M=m)
+        if exact.count:
+            index.add_items(exact.vectors, np.arange(exact.count))
+        return cls(exact, index)
+
+    @classmethod
+    def load(cls, exact: ExactIndex, path: str) -> "HNSWIndex":
+        _require(hnswlib, "hnsw", "hnswlib")
+        index = hnswlib.Index(space="ip", dim=exact.dim)
+        index.load_index(path, max_elements=max(exact.count, 1))
+        return cls(exact, index)
+
+    def save(self, path: str) -> None:
+        tmp = path + ".tmp"
+        self.index.save_index(tmp)
+        os.replace(tmp, path)
+
+    def search(self, queries, top_k: int = 5, ef: int | None = None, mask: np.ndarray | None = None,
+               **params) -> tuple:
+        if mask is not None:
+            return self.exact.search(queries, top_k, mask=mask)
+        q = self.exact._queries(queries)
+        k = min(top_k, self.count)
+        if k <= 0:
+            return top_k_rows(np.zeros((q.shape[0], 0), np.float32), top_k)
+        # ef 是索引级别的状态，修改和查询放在同一把锁里，避免并发请求互相覆盖
+        ef = max(ef or HNSW_EF, k)
+        with self._search_lock:
+            if ef != self._ef:
+                self.index.set_ef(ef)
+                self._ef = ef
+            labels, distances = self.index.knn_query(q, k=k)
+        return (1.0 - distances).astype(np.float32), labels.astype(np.int64)
+
+
+class IVFPQIndex:
+    """faiss IVF-PQ 索引，nprobe 可在每次查询时指定，PQ 近似分数用精确向量重排。"""
+    kind = "ivfpq"
+
+    def __init__(self, exact: ExactIndex, index):
+        self.exact = exact
+        self.store = exact.store
+        self.index = index
+
+    @property
+    def count(self) -> int:
+        return self.exact.count
+
+    @property
+    def dim(self) -> int:
+        return self.exact.dim
+
+    @staticmethod
+    def default_params(count: int, dim: int) -> dict:
+        nlist = max(1, min(int(4 * math.sqrt(max(count, 1))), count // 39 or 1))
+        # 子向量数必须整除维度，每个子向量至少 8 维
+        m = max(d for d in range(1, min(64, dim // 8 or 1) + 1) if dim % d == 0)
+        # faiss 建议每个码本中心至少 39 个训练样本
+        nbits = max(1, min(8, int(math.log2(max(count // 39, 2)))))
+        return {"nlist": nlist, "m": m, "nbits": nbits}
+
+    @classmethod
+    def build(cls, exact: ExactIndex, nlist: int | None = None, m: int | None = None,
+              nbits: int | None = None) -> "IVFPQIndex":
+        _require(faiss, "ivfpq", "faiss-cpu")
+        params = cls.default_params(exact.count, exact.dim)
+        nlist, m, nbits = nlist or params["nlist"], m or params["m"], nbits or params["nbits"]
+        quantizer = faiss.IndexFlatIP(exact.dim)
+        index = faiss.IndexIVFPQ(quantizer, exact.dim, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT)
+        if exact.count:
+            index.train(exact.vectors)
+            index.add(exact.vectors)
+        return cls(exact, index)
+
+    @classmethod
+    def load(cls, exact: ExactIndex, path: str) -> "IVFPQIndex":
+        _require(faiss, "ivfpq", "faiss-cpu")
+        return cls(exact, faiss.read_index(path))
+
+    def save(self, path: str) -> None:
+        tmp = path + ".tmp"
+        faiss.write_index(self.index, tmp)
+        os.replace(tmp, path)
+
+    def search(self, queries, top_k: int = 5, nprobe: int | None = None, mask: np.ndarray | None = None,
+               **params) -> tuple:
+        if mask is not None:
+            return self.exact.search(queries, top_k, mask=mask)
+        q = self.exact._queries(queries)
+        k = min(top_k, self.count)
+        if k <= 0:
+            return top_k_rows(np.zeros((q.shape[0], 0), np.float32), top_k)
+        search_params = faiss.SearchParametersIVF(nprobe=min(nprobe or IVF_NPROBE, self.index.nlist))
+        _, candidates = self.index.search(q, min(k * IVF_RERANK, self.count), params=search_params)
+        return self.exact.rerank(q, candidates, k)
+
+
+def _require(module, kind: str, package: str) -> None:
+    if module is None:
+        raise ValueError(f"Index kind {kind!r} requires the optional package {package!r} (pip install {package})")
+
+
+def _fresh(path: str, store_path: str) -> bool:
+    # header 在每次重写的最后才替换，比它旧的索引文件都是基于上一代数据构建的
+    header_file = os.path.join(store_path, HEADER_FILE)
+    return (os.path.exists(path) and os.path.exists(header_file)
+            and os.path.getmtime(path) >= os.path.getmtime(header_file))
+
+
+def load_exact_index(store_path: str) -> ExactIndex:
+    """打开向量存储的精确索引；缓存的归一化矩阵过期或不存在时重新构建并保存。"""
+    store = VectorStore(store_path)
+    cached = os.path.join(store_path, NORMALIZED_FILE)
+    if _fresh(cached, store_path):
+        vectors = np.load(cached)
+        if vectors.shape == (store.count, store.dim):
+            return ExactIndex(vectors, store)
+    index = ExactIndex.from_store(store)
+    if store.count:
+        index.save(cached)
+    return index
+
+
+def load_index(store_path: str, kind: str = "exact", rebuild: bool = False, **build_params):
+    """打开（必要时构建并保存）指定类型的索引。
+
+    hnsw / ivfpq 同时持有精确索引：前者用于维度校验，后者用于重排。
+    """
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown index kind {kind!r}, expected one of {INDEX_KINDS}")
+    exact = load_exact_index(store_path)
+    if kind == "exact":
+        return exact
+    cls, filename = (HNSWIndex, HNSW_FILE) if kind == "hnsw" else (IVFPQIndex, IVFPQ_FILE)
+    path = os.path.join(store_path, filename)
+    if not rebuild and _fresh(path, store_path):
+        return cls.load(exact, path)
+    print(f"[VectorIndex] building {kind} index over {exact.count} vectors in {store_path}")
+    index = cls.build(exact, **build_params)
+    index.save(path)
+    return index
+
+
+def get_index(store_path: str, kind: str = "exact"):
+    """进程内常驻的索引；向量存储被重写后自动重新加载。"""
+    key = (os.path.abspath(store_path), kind)
+    version = os.path.getmtime(os.path.join(key[0], HEADER_FILE))
+    with _lock:
+        entry = _indexes.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, load_index(key[0], kind))
+            _indexes[key] = entry
+        return entry[1]
@@ -0,0 +1,293 @@
+"""
+紧凑的二进制向量存储
+用一个连续的 float32/float16 矩阵文件 + 行对齐的 manifest 替代逐产品的
+embeddings-*.jsonl 文件，读取时通过 np.memmap 打开，无需解析任何 JSON 浮点数。
+
+目录结构:
+    <store>/header.json     {"dim": ..., "dtype": ..., "count": ..., "meta": {...}, "data": "data-<n>"}
+                            meta 记录生成向量的 embedding provider/model，data 指向当前的数据目录
+    <store>/data-<n>/vectors.bin   count x dim 的行主序矩阵（即向量列）
+    <store>/data-<n>/manifest/     Parquet 分片，列: id, book, chunk_index, offset, chunk, source_url
+                                   第 i 行对应矩阵第 i 行（offset == i），可按列投影读取
+
+每次重写都写进一个新的 data-<n> 目录，最后一次 os.replace 写入 header 切换过去：读取方读到的
+header 总是指向一个完整、不再改变的数据目录。上一代数据目录保留（已打开的读取方还会按需读取
+它的 manifest），更早的在写入时删除。没有 data 字段的旧存储直接从 <store>/ 读取。
+"""
+import os
+import json
+import glob
+import shutil
+
+import numpy as np
+import pyarrow as pa
+
+from chunk_dataset import ShardedWriter, chunk_ids, read_columns, read_table
+
+HEADER_FILE = "header.json"
+VECTORS_FILE = "vectors.bin"
+MANIFEST_DIR = "manifest"
+SUPPORTED_DTYPES = ("float32", "float16")
+
+MANIFEST_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("book", pa.string()),
+    ("chunk_index", pa.int32()),
+    ("offset", pa.int64()),
+    ("chunk", pa.string()),
+    ("source_url", pa.string()),
+])
+
+
+def store_exists(path: str) -> bool:
+    return os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+def _read_header(path: str) -> dict | None:
+    try:
+        with open(os.path.join(path, HEADER_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _data_dirs(path: str) -> list:
+    """按代数升序的 data-<n> 目录名"""
+    names = [n for n in os.listdir(path) if n.startswith("data-") and n[5:].isdigit()]
+    return sorted(names, key=lambda n: int(n[5:]))
+
+
+class VectorStoreWriter:
+    """按批追加向量和 manifest 记录。
+
+    每行的 id 由 (book, chunk) 内容派生，写入时统一分配，调用方传入的 id 会被忽略。
+    向量和 manifest 写进新的 data-<n>.tmp 目录，close() 时把目录改名为 data-<n>，
+    再原子替换 header 指向它，所以读取方永远不会把新旧两代的 header、矩阵和 manifest 混在一起。
+    """
+
+    def __init__(self, path: str, dtype: str = "float32", meta: dict | None = None):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype!r}, expected one of {SUPPORTED_DTYPES}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.count = 0
+        self.meta = meta or {}
+        generations = [int(n[5:]) for n in _data_dirs(path)]
+        self._data = f"data-{max(generations, default=0) + 1}"
+        self._tmp = os.path.join(path, self._data + ".tmp")
+        if os.path.exists(self._tmp):
+            shutil.rmtree(self._tmp)
+        os.makedirs(self._tmp)
+        self._vf = open(os.path.join(self._tmp, VECTORS_FILE), "wb")
+        self._manifest = ShardedWriter(os.path.join(self._tmp, MANIFEST_DIR), MANIFEST_SCHEMA)
+        self._seen_ids = {}
+
+    def add(self, records: list, embeddings) -> None:
+        arr = np.asarray(embeddings, dtype=np.float32)
+        if len(records) == 0:
+            return
+        if arr.ndim != 2 or arr.shape[0] != len(records):
+            raise ValueError(f"Expected {len(records)} embeddings, got array of shape {arr.shape}")
+        if self.dim is None:
+            self.dim = int(arr.shape[1])
+        elif arr.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension mismatch: store has {self.dim}, batch has {arr.shape[1]}")
+
+        self._vf.write(arr.astype(self.dtype).tobytes())
+        ids = chunk_ids([r.get("book", "") for r in records], [r.get("chunk", "") for r in records],
+                        seen=self._seen_ids)
+        rows = []
+        for rec, _id in zip(records, ids):
+            row = dict(rec)
+            row["id"] = _id
+            row["offset"] = self.count
+            rows.append(row)
+            self.count += 1
+        self._manifest.write(rows)
+
+    def close(self) -> None:
+        self._vf.close()
+        self._manifest.close()
+        os.replace(self._tmp, os.path.join(self.path, self._data))
+        previous = (_read_header(self.path) or {}).get("data", ".")
+        header = {"dim": self.dim or 0, "dtype": self.dtype.name, "count": self.count, "meta": self.meta,
+                  "data": self._data}
+        header_tmp = os.path.join(self.path, HEADER_FILE + ".tmp")
+        with open(header_tmp, "w", encoding="utf-8") as f:
+            json.dump(header, f)
+        # 唯一的切换点
+        os.replace(header_tmp, os.path.join(self.path, HEADER_FILE))
+        self._cleanup(keep={self._data, previous})
+
+    def _cleanup(self, keep: set) -> None:
+        """删除当前和上一代之外的数据目录（以及不再被引用的旧版平铺文件）"""
+        for name in _data_dirs(self.path):
+            if name not in keep:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        if "." not in keep:
+            legacy_vectors = os.path.join(self.path, VECTORS_FILE)
+            if os.path.exists(legacy_vectors):
+                os.remove(legacy_vectors)
+            shutil.rmtree(os.path.join(self.path, MANIFEST_DIR), ignore_errors=True)
+
+    def abort(self) -> None:
+        self._vf.close()
+        self._manifest.abort()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class VectorStore:
+    """只读打开一个向量存储。
+
+    - vectors: (count, dim) 的 np.memmap，按需分页，不会整体读入内存
+    - column(name): 按列投影读取 manifest，只读 id 和向量时不会解码 chunk 文本
+    - records: 完整的 manifest 记录列表（第一次访问时才读取）
+    """
+
+    def __init__(self, path: str):
+        # header 只读一次：之后的矩阵和 manifest 读取都来自它指向的同一个数据目录
+        with open(os.path.join(path, HEADER_FILE), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        self.path = path
+        self.data_path = os.path.join(path, header.get("data", "."))
+        self.dim = int(header["dim"])
+        self.dtype = np.dtype(header["dtype"])
+        self.count = int(header["count"])
+        self.meta = header.get("meta", {})
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(self.data_path, VECTORS_FILE), dtype=self.dtype, mode="r",
+                shape=(self.count, self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=self.dtype)
+        self._records = None
+        self._columns = {}
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.data_path, MANIFEST_DIR)
+
+    def column(self, name: str) -> list:
+        """读取单列（结果缓存），其它列不会被解码。"""
+        if name not in self._columns:
+            if self._records is not None:
+                self._columns[name] = [r.get(name) for r in self._records]
+            elif self.count:
+                self._columns[name] = read_columns(self.manifest_path, [name])[name]
+            else:
+                self._columns[name] = []
+        return self._columns[name]
+
+    @property
+    def records(self) -> list:
+        if self._records is None:
+            self._records = read_table(self.manifest_path).to_pylist() if self.count else []
+        return self._records
+
+    @property
+    def ids(self) -> list:
+        return self.column("id")
+
+    def as_float32(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """返回 [start, stop) 行的 float32 副本（float16 存储时会做上转换）。"""
+        return np.asarray(self.vectors[start:stop], dtype=np.float32)
+
+    def groups(self) -> list:
+        """按 book 分组，返回 [(book, offset, count), ...]，顺序与存储顺序一致。"""
+        groups = []
+        for offset, book in enumerate(self.column("book")):
+            if groups and groups[-1][0] == book:
+                b, off, n = groups[-1]
+                groups[-1] = (b, off, n + 1)
+            else:
+                groups.append((book, offset, 1))
+        return groups
+
+    def iter_batches(self, batch_size: int = 500):
+        """按行批量产出 (records, float32 向量)。"""
+        for start in range(0, self.count, batch_size):
+            stop = min(start + batch_size, self.count)
+            yield self.records[start:stop], self.as_float32(start, stop)
+
+
+def convert_jsonl_embeddings(pattern: str, out_path: str, dtype: str = "float32") -> VectorStore:
+    """一次性把旧的 embeddings-*.jsonl 文件迁移为向量存储。
+
+    旧文件每行格式: {"chunk": ..., "book": ..., "embedding": [...]}
+    """
+    files = sorted(glob.glob(pattern))
+    print(f"[VectorStore] converting {len(files)} embedding files -> {out_path}")
+    skipped = 0
+    with VectorStoreWriter(out_path, dtype=dtype) as writer:
+        for n, path in enumerate(files):
+            records = []
+            embeddings = []
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    item = json.loads(line)
+                    emb = item.get("embedding")
+                    if not emb:
+                        skipped += 1
+                        continue
+                    book = item.get("book", "")
+                    i = len(records)
+                    records.append({
+                        "book": book,
+                        "chunk_index": i,
+                        "chunk": item.get("chunk", ""),
+                    })
+                    embeddings.append(emb)
+            writer.add(records, embeddings)
+            if (n + 1) % 500 == 0:
+                print(f"[VectorStore] {n + 1}/{len(files)} files ({writer.count} rows)")
+    if skipped:
+        print(f"[VectorStore] skipped {skipped} rows without an embedding")
+    store = VectorStore(out_path)
+    print(f"[VectorStore] wrote {store.count} x {store.dim} {store.dtype.name} vectors")
+    return store
+
+
+def convert_npz_index(index_npz: str, meta_jsonl: str, out_path: str, dtype: str = "float32") -> VectorStore:
+    """把旧的 ewg_index.npz + ewg_meta.jsonl 迁移为向量存储。"""
+    arr = np.load(index_npz, allow_pickle=True)["embeddings"]
+    records = []
+    with open(meta_jsonl, "r", encoding="utf-8") as f:
+        for i, line in enumerate(l for l in f if l.strip()):
+            item = json.loads(line)
+            book = item.get("book") or item.get("title") or ""
+            records.append({
+                "book": book,
+                "chunk_index": i,
+                "chunk": item.get("text", item.get("chunk", "")),
+            })
+    with VectorStoreWriter(out_path, dtype=dtype) as writer:
+        writer.add(records, arr)
+    return VectorStore(out_path)
+
+
+def open_store(path: str, legacy_pattern: str | None = None, dtype: str = "float32") -> VectorStore | None:
+    """打开向量存储；不存在但找到旧的 JSONL 文件时先自动迁移。都没有则返回 None。"""
+    if store_exists(path):
+        return VectorStore(path)
+    if legacy_pattern and glob.glob(legacy_pattern):
+        print(f"[VectorStore] {path} not found, migrating legacy files {legacy_pattern}")
+        return convert_jsonl_embeddings(legacy_pattern, path, dtype=dtype)
+    return None